@@ -96,6 +96,7 @@ run {
                    ~"(.*)_R[0-9][_.].*fastq.gz" * [ trim_fastq + align_bwa + index_bam + cleanup_trim_fastq ] +
                    merge_bams +
                    dedup + 
+                   preliminary_qc + // warn early from a subsample of reads if coverage looks too low
                    cleanup_initial_bams +
                    realignIntervals + realign + index_bam +
                    bsqr_recalibration + index_bam +
@@ -109,7 +110,7 @@ run {
                              add_to_database, 
                              augment_condel + annotate_significance
                          ]  +
-                         [ calc_coverage_stats + check_ontarget_perc, calculate_qc_statistics ] + [ summary_report, exon_qc_report, gap_report ],
+                         [ calc_coverage_stats + check_ontarget_perc ] + [ summary_report, exon_qc_report, gap_report ],
                          gatk_depth_of_coverage,
                          insert_size_metrics
                        ]
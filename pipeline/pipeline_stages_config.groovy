@@ -269,10 +269,11 @@ update_gene_lists = {
 
     // builds additional genes from sample metadata file, then adds any new ones to the flagship
     // creates files: ../design/cohort.add.genes.txt, cohort.addonce.sample.genes.txt, cohort.notfound.genes.txt
+    // and ../design/cohort.added.genes.txt, the genes added to the cohort's gene list, used by update_summary_report and update_gap_report
     exec """
         mkdir -p "../design"
 
-        python $SCRIPTS/find_new_genes.py --reference "$BASE/designs/genelists/exons.bed" --exclude "$BASE/designs/genelists/incidentalome.genes.txt" --target ../design < $sample_metadata_file
+        python $SCRIPTS/find_new_genes.py --reference "$BASE/designs/genelists/exons.bed" --exclude "$BASE/designs/genelists/incidentalome.genes.txt" --target ../design --meta $sample_metadata_file
 
         python $SCRIPTS/update_gene_lists.py --source ../design --target "$BASE/designs" --log "$BASE/designs/genelists/changes.genes.log"
     """
@@ -328,9 +329,12 @@ create_synonymous_target = {
 
 build_capture_stats = {
     output.dir = "qc"
+
+    var REFERENCE_CACHE : "$BASE/designs/cache"
+
     produce( "exon_coverage_stats.txt" ) {
         exec """
-            python $SCRIPTS/calculate_exon_coverage.py --capture $EXOME_TARGET --exons $BASE/designs/genelists/exons.bed > qc/exon_coverage_stats.txt
+            python $SCRIPTS/calculate_exon_coverage.py --capture $EXOME_TARGET --exons $BASE/designs/genelists/exons.bed --cache $REFERENCE_CACHE > qc/exon_coverage_stats.txt
         """
     }
 }
@@ -883,30 +887,21 @@ annotate_snpeff = {
 }
 
 calc_coverage_stats = {
-    doc "Calculate coverage across a target region using Bedtools"
+    doc "Calculate coverage across a target region, on target reads and fragment statistics in one pass over the bam"
     output.dir="qc"
 
     var MIN_ONTARGET_PERCENTAGE : 50
 
-    transform("bam") to([file(target_bed_file).name+".cov.txt", file(target_bed_file).name+".cov.gz", "exome.txt", "ontarget.txt"]) {
-        // only calculate coverage for bases overlapping the capture
-        def safe_tmp_dir = [TMPDIR, UUID.randomUUID().toString()].join( File.separator )
-
-        // coverage calculation for qc_report.py
+    transform("bam") to([file(target_bed_file).name+".cov.txt", file(target_bed_file).name+".cov.gz", "exome.txt", "ontarget.txt", "fragments.tsv", "distributions.tsv", "chromosomes.tsv", file(target_bed_file).name+".cov.store"]) {
+        // one pass over the bam for coverage of bases overlapping the capture, on target reads and fragment statistics
         exec """
-          mkdir -p "$safe_tmp_dir"
-        
-          $BEDTOOLS/bin/bedtools intersect -a $target_bed_file.${sample}.bed -b $EXOME_TARGET > "$safe_tmp_dir/intersect.bed"
-
-          $BEDTOOLS/bin/coverageBed -d -abam $input.bam -b "$safe_tmp_dir/intersect.bed" > $output.txt
+          python $SCRIPTS/bam_qc.py --bam $input.bam --exome $EXOME_TARGET --target $target_bed_file.${sample}.bed --ontarget_bed $COMBINED_TARGET
+              --target_cov $output.txt --exome_cov $output3.txt --ontarget $output4.txt
+              --fragments $output.fragments.tsv --distributions $output.distributions.tsv --chromosomes $output.chromosomes.tsv
 
           gzip < $output.txt > $output2.gz
 
-          $BEDTOOLS/bin/coverageBed -d -abam $input.bam -b $EXOME_TARGET > $output3.txt
-        
-          $SAMTOOLS/samtools view -L $COMBINED_TARGET $input.bam | wc | awk '{ print \$1 }' > $output4.txt
-
-          rm -r "$safe_tmp_dir"
+          python $SCRIPTS/coverage_store.py --convert $output.txt --output $output.store
         """
      }
 
@@ -928,19 +923,44 @@ check_ontarget_perc = {
     }
 }
 
+preliminary_qc = {
+
+    doc "Estimate coverage from a subsample of reads, to warn soon after dedup of samples likely to fail check_coverage"
+
+    output.dir = "qc"
+
+    var PRELIMINARY_QC_FRACTION : 0.05
+
+    def medianCovHigh
+    transform("bam") to("preliminary_qc.tsv") {
+        exec """
+            python $SCRIPTS/bam_qc.py --bam $input.bam --exome $EXOME_TARGET --target $target_bed_file.${sample}.bed --ontarget_bed $COMBINED_TARGET
+                --sample_fraction $PRELIMINARY_QC_FRACTION --coverage_summary $output.tsv
+        """
+
+        // HACK to ensure file sync on distributed file system
+        file(output.dir).listFiles()
+        medianCovHigh = (int)file(output.tsv).readLines()*.split("\t").find { it[0] == "median_coverage_high" }[1].toFloat()
+    }
+
+    // only warns: the sample continues to check_coverage, which uses all reads
+    check {
+        exec "[ $medianCovHigh -ge $MEDIAN_COVERAGE_THRESHOLD ]"
+    } otherwise {
+        send text {"Sample $sample is likely to fail check_coverage: median coverage estimated from $PRELIMINARY_QC_FRACTION of reads is below $MEDIAN_COVERAGE_THRESHOLD"} to channel: cpipe_operator 
+    }
+}
+
 check_coverage = {
 
     output.dir = "qc"
 
     def medianCov
-    transform("cov.gz") to("cov.stats.median", "cov.stats.csv") {
+    transform("cov.store") to("cov.stats.median", "cov.stats.csv") {
 
-        R {"""
-            bam.cov = read.table(pipe("gunzip -c $input.cov.gz"), col.names=c("chr","start","end", "gene", "offset", "cov"))
-            meds = aggregate(bam.cov$cov, list(bam.cov$gene), median)
-            write.csv(data.frame(Gene=meds[,1],MedianCov=meds$x), "$output.csv", quote=F, row.names=F)
-            writeLines(as.character(median(bam.cov$cov)), "$output.median")
-        """}
+        exec """
+            python $SCRIPTS/coverage_store.py --gene_medians $output.csv --median $output.median $input.cov.store
+        """
 
         // HACK to ensure file sync on distributed file system
         file(output.dir).listFiles()
@@ -1164,9 +1184,9 @@ gatk_depth_of_coverage = {
 calculate_qc_statistics = {
     doc "Calculate additional qc statistics"
     output.dir="qc"
-    transform("bam") to("fragments.tsv") {
+    transform("bam") to("fragments.tsv", "distributions.tsv") {
         exec """
-            $SAMTOOLS/samtools view $input.bam | python $SCRIPTS/calculate_qc_statistics.py > $output.tsv
+            python $SCRIPTS/calculate_qc_statistics.py --bam $input.bam --distributions $output.distributions.tsv > $output.fragments.tsv
         """
     }
 }
@@ -1230,7 +1250,9 @@ annotate_significance = {
     doc "Add clinical significance category annotations as defined by Melbourne Genomics"
         var MAF_THRESHOLD_RARE : 0.01,
             MAF_THRESHOLD_VERY_RARE : 0.0005,
-            CONDEL_THRESHOLD : 0.7
+            CONDEL_THRESHOLD : 0.7, // default condel of PRIORITY_THRESHOLD_SETS, Priority_Index always uses 0.7
+            PRIORITY_THRESHOLD_SETS : "", // comma separated name:rare:very_rare:condel, each adding a Priority_Index_<name> column
+            SIGNIFICANCE_WORKERS : 1 // processes classifying chunks of the file in parallel
 
         output.dir="variants"
         from("con.csv") {
@@ -1240,7 +1262,8 @@ annotate_significance = {
                 --rare $MAF_THRESHOLD_RARE
                 --very_rare $MAF_THRESHOLD_VERY_RARE
                 --condel $CONDEL_THRESHOLD
-                --synonymous $COMBINED_SYNONYMOUS
+                --workers $SIGNIFICANCE_WORKERS
+                --synonymous $COMBINED_SYNONYMOUS ${PRIORITY_THRESHOLD_SETS.tokenize(",").collect { "--threshold_set " + it }.join(" ")}
                 > $output.csv
                 """
         }
@@ -1328,7 +1351,7 @@ gap_report = {
 
     produce("${run_id}_${sample}.gap.csv") {
         exec """
-            python $SCRIPTS/gap_annotator.py --min_coverage_ok $LOW_COVERAGE_THRESHOLD --min_gap_width $LOW_COVERAGE_WIDTH --coverage $input.cov.txt --db $BASE/designs/genelists/refgene.txt > $output.csv
+            python $SCRIPTS/gap_annotator.py --min_coverage_ok $LOW_COVERAGE_THRESHOLD --min_gap_width $LOW_COVERAGE_WIDTH --coverage $input.cov.gz --db $BASE/designs/genelists/refgene.txt > $output.csv
         """
     }
 }
@@ -1338,9 +1361,9 @@ summary_report = {
 
     output.dir="results"
 
-    produce("${run_id}_${sample}.summary.htm", "${run_id}_${sample}.summary.md", "${run_id}_${sample}.summary.karyotype.tsv") {
+    produce("${run_id}_${sample}.summary.htm", "${run_id}_${sample}.summary.md", "${run_id}_${sample}.summary.karyotype.tsv", "${run_id}_${sample}.summary.genes.hist") {
         exec """
-            python $SCRIPTS/qc_report.py --report_cov $input.cov.txt --exome_cov $input.exome.txt --ontarget $input.ontarget.txt ${inputs.metrics.withFlag("--metrics")} --study $sample --meta $sample_metadata_file --threshold 20 --classes GOOD:95:GREEN,PASS:80:ORANGE,FAIL:0:RED --gc $target_gene_file --gene_cov qc/exon_coverage_stats.txt --write_karyotype $output.tsv --fragments $input.fragments.tsv --padding $INTERVAL_PADDING_CALL,$INTERVAL_PADDING_INDEL,$INTERVAL_PADDING_SNV > $output.md
+            python $SCRIPTS/qc_report.py --report_cov $input.cov.store --gene_cache $output.hist --exome_cov $input.exome.txt --ontarget $input.ontarget.txt ${inputs.metrics.withFlag("--metrics")} --study $sample --meta $sample_metadata_file --threshold 20 --classes GOOD:95:GREEN,PASS:80:ORANGE,FAIL:0:RED --gc $target_gene_file --gene_cov qc/exon_coverage_stats.txt --write_karyotype $output.tsv --chromosomes $input.chromosomes.tsv --fragments $input.fragments.tsv --fragment_distributions $input.distributions.tsv --padding $INTERVAL_PADDING_CALL,$INTERVAL_PADDING_INDEL,$INTERVAL_PADDING_SNV > $output.md
 
             python $SCRIPTS/markdown2.py --extras tables < $output.md | python $SCRIPTS/prettify_markdown.py > $output.htm
         """
@@ -1351,6 +1374,71 @@ summary_report = {
     }
 }
 
+update_summary_report = {
+    doc """Update the summary report of a sample for genes added to its profile by update_gene_lists,
+           reusing the per gene coverage cached by summary_report and whole exome coverage instead of the bam"""
+
+    requires sample_metadata_file : "File describing meta data for pipeline run (usually, samples.txt)"
+
+    var REPORT_REMOVED_GENES : "" // gene list of genes removed from the profile since the report was written
+
+    output.dir="results"
+
+    produce("${run_id}_${sample}.update.summary.htm", "${run_id}_${sample}.update.summary.md", "${run_id}_${sample}.update.summary.karyotype.tsv", "${run_id}_${sample}.update.summary.genes.hist") {
+        exec """
+            cp results/${run_id}_${sample}.summary.genes.hist $output.hist
+
+            python $SCRIPTS/qc_report.py --gene_cache $output.hist --add_genes ../design/${target_name}.added.genes.txt ${REPORT_REMOVED_GENES ? "--remove_genes " + REPORT_REMOVED_GENES : ""} --gene_bed $BASE/designs/genelists/exons.bed --exome_cov $input.exome.txt --ontarget $input.ontarget.txt ${inputs.metrics.withFlag("--metrics")} --study $sample --meta $sample_metadata_file --threshold 20 --classes GOOD:95:GREEN,PASS:80:ORANGE,FAIL:0:RED --gc $target_gene_file --gene_cov qc/exon_coverage_stats.txt --write_karyotype $output.tsv --chromosomes $input.chromosomes.tsv --fragments $input.fragments.tsv --fragment_distributions $input.distributions.tsv --padding $INTERVAL_PADDING_CALL,$INTERVAL_PADDING_INDEL,$INTERVAL_PADDING_SNV > $output.md
+
+            python $SCRIPTS/markdown2.py --extras tables < $output.md | python $SCRIPTS/prettify_markdown.py > $output.htm
+        """
+    }
+}
+
+update_gap_report = {
+    doc """Update the gap report of a sample for genes added to its profile by update_gene_lists,
+           keeping the gaps of other genes and finding gaps in added genes from whole exome coverage"""
+
+    output.dir="results"
+
+    var LOW_COVERAGE_THRESHOLD : 15,
+        LOW_COVERAGE_WIDTH : 1,
+        REPORT_REMOVED_GENES : "" // gene list of genes removed from the profile since the report was written
+
+    produce("${run_id}_${sample}.update.gap.csv") {
+        exec """
+            python $SCRIPTS/gap_annotator.py --min_coverage_ok $LOW_COVERAGE_THRESHOLD --min_gap_width $LOW_COVERAGE_WIDTH --coverage $input.exome.txt --previous results/${run_id}_${sample}.gap.csv --add_genes ../design/${target_name}.added.genes.txt ${REPORT_REMOVED_GENES ? "--remove_genes " + REPORT_REMOVED_GENES : ""} --gene_bed $BASE/designs/genelists/exons.bed --db $BASE/designs/genelists/refgene.txt > $output.csv
+        """
+    }
+}
+
+batch_summary_report = {
+
+    doc """
+        Summary reports for all the samples of an analysis profile in one process, sharing the metadata, 
+        gene categories and capture, with a matrix of the median coverage of each gene across samples.
+        Writes the same files as summary_report for each sample.
+        """
+
+    requires sample_metadata_file : "File describing meta data for pipeline run (usually, samples.txt)"
+
+    var SUMMARY_REPORT_WORKERS : 4
+
+    output.dir="results"
+
+    def target_samples = sample_info.grep { it.value.target == target_name }*.value*.sample
+
+    produce(target_name + ".summary_batch.tsv", target_name + ".gene_coverage_matrix.tsv") {
+        exec """
+            printf "study\\toutput\\treport_cov\\texome_cov\\tontarget\\tmetrics\\tchromosomes\\tfragments\\tfragment_distributions\\n" > $output1.tsv
+
+            for s in ${target_samples.join(" ")}; do printf "%s\\t%s\\t%s\\t%s\\t%s\\t%s\\t%s\\t%s\\t%s\\n" \$s results/${run_id}_\$s.summary qc/\$s.*.cov.store qc/\$s.*.exome.txt qc/\$s.*.ontarget.txt align/\$s.*.metrics qc/\$s.*.chromosomes.tsv qc/\$s.*.fragments.tsv qc/\$s.*.distributions.tsv >> $output1.tsv; done
+
+            python $SCRIPTS/qc_report.py --batch $output1.tsv --workers $SUMMARY_REPORT_WORKERS --matrix $output2.tsv --meta $sample_metadata_file --threshold 20 --classes GOOD:95:GREEN,PASS:80:ORANGE,FAIL:0:RED --gc $target_gene_file --gene_cov qc/exon_coverage_stats.txt --padding $INTERVAL_PADDING_CALL,$INTERVAL_PADDING_INDEL,$INTERVAL_PADDING_SNV
+        """
+    }
+}
+
 summary_pdf = {
 
     requires sample_metadata_file : "File describing meta data for pipeline run (usually, samples.txt)"
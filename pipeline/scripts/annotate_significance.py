@@ -56,14 +56,28 @@
 ####################################################################################
 
 import argparse
+import bisect
 import collections
 import csv
 import datetime
+import itertools
 import logging as log
+import multiprocessing
+import re
+import StringIO
 import sys
 
 log.basicConfig(level=log.INFO)
 
+# Number of rows read and classified at once
+CHUNK_ROWS = 10000
+
+# Approximate size in bytes of the input given to each worker with --workers
+CHUNK_BYTES = 8 * 1024 * 1024
+
+# MAF and Condel thresholds used to calculate a priority index
+Thresholds = collections.namedtuple('Thresholds', ['rare', 'very_rare', 'condel'])
+
 class Annovar:
     """
     Helper class to map Annovar column names to their fields parsed from CSV,
@@ -76,6 +90,10 @@ class Annovar:
     # Column names of Annovar file
     columns = []
 
+    # Index of each column name, and of each population frequency field, set by init_columns()
+    column_index = {}
+    maf_columns = []
+
     # Default MAF threshold for considering a variant 'rare'
     MAF_THRESHOLD = 0.01
 
@@ -85,6 +103,9 @@ class Annovar:
     # Default Condel Threshold
     CONDEL_THRESHOLD = 0.7
 
+    # Condel score of a conserved variant for the main Priority_Index, which CONDEL_THRESHOLD does not change
+    CONSERVED_CONDEL = 0.7
+
     # Categories of variants as specified by Annovar, mapped to functional categories
     # defined for Melbourne Genomics
     ANNOVAR_EXONIC_FUNCS = {
@@ -100,22 +121,32 @@ class Annovar:
     # compatibility with different versions of Annovar
     POPULATION_FREQ_FIELDS = ["esp6500siv2_all", "1000g2014oct_all","exac03"]
 
+    # Sets of the functional categories, for membership tests
+    TRUNCATING = frozenset(ANNOVAR_EXONIC_FUNCS["truncating"])
+    MISSENSE = frozenset(ANNOVAR_EXONIC_FUNCS["missense"])
+    NONCODING = frozenset(ANNOVAR_EXONIC_FUNCS["noncoding"])
+    SPLICING = frozenset(["splicing","exonic;splicing"])
+
     def __init__(self, line, synonymous=None):
         self.line = line
         self.synonymous = synonymous
+        self.mafs = None # population frequencies as floats, parsed on first use
 
-    def priority(self):
+    def priority(self, thresholds=None, verbose=True):
         """
             Main logic describing how to map any given variant to a clinical significance
             priority index. See the main header for the definition of these categories.
 
             Note: unknown categories are returned as 9 - that is, extremely high.
+
+            thresholds defaults to the class thresholds. Variants that are not filtered
+            or fail to be categorized are logged if verbose.
         """
 
         if self.is_missense(): # nonframeshift...
-           if self.is_rare():
-               if self.is_novel() or self.is_very_rare():
-                   if self.is_conserved():
+           if self.is_rare(thresholds):
+               if self.is_novel(thresholds) or self.is_very_rare(thresholds):
+                   if self.is_conserved(thresholds):
                        return 4 # Missense, novel and conserved => category 4
                    else:
                        return 3 # Missesnse, novel but not highly conserved => category 3
@@ -129,9 +160,9 @@ class Annovar:
             # With regard to priority 5 truncating variants:
             #  novel should stay in priority 5
             #  rare should be priority 2
-            if self.is_novel():
+            if self.is_novel(thresholds):
                 return 5
-            elif self.is_rare():
+            elif self.is_rare(thresholds):
                 log.debug("%s:%s is rare" % (self.Chr,self.Start))
                 return 2
             else:
@@ -142,12 +173,14 @@ class Annovar:
 
         elif self.ExonicFunc == "synonymous SNV":
             # From Natalie, 18/11/15
-            if '{0},{1}'.format( self.Chr, self.Start ) in self.synonymous:
-                if self.is_novel():
-                    log.info( "variant %s:%s %s/%s func=%s not filtered due to exon boundary proximity" % (self.Chr, self.Start, self.Ref, self.Obs, self.ExonicFunc) )
+            if self.synonymous.contains( self.Chr, self.Start ):
+                if self.is_novel(thresholds):
+                    if verbose:
+                        log.info( "variant %s:%s %s/%s func=%s not filtered due to exon boundary proximity" % (self.Chr, self.Start, self.Ref, self.Obs, self.ExonicFunc) )
                     return 5
-                elif self.is_rare():
-                    log.info( "variant %s:%s %s/%s func=%s not filtered due to exon boundary proximity" % (self.Chr, self.Start, self.Ref, self.Obs, self.ExonicFunc) )
+                elif self.is_rare(thresholds):
+                    if verbose:
+                        log.info( "variant %s:%s %s/%s func=%s not filtered due to exon boundary proximity" % (self.Chr, self.Start, self.Ref, self.Obs, self.ExonicFunc) )
                     return 2
                 else:
                     return 0
@@ -156,111 +189,326 @@ class Annovar:
         elif self.ExonicFunc == "unknown":
              return 0
         else:
-            log.warn( "variant %s:%s %s/%s func=%s failed to be categorized" % (self.Chr, self.Start, self.Ref, self.Alt, self.ExonicFunc) )
+            if verbose:
+                log.warn( "variant %s:%s %s/%s func=%s failed to be categorized" % (self.Chr, self.Start, self.Ref, self.Alt, self.ExonicFunc) )
             return 9
         
     def is_noncoding(self):
-        return self.Func in self.ANNOVAR_EXONIC_FUNCS["noncoding"]
+        return self.Func in self.NONCODING
 
     def is_missense(self):
-        return self.ExonicFunc in self.ANNOVAR_EXONIC_FUNCS["missense"]
+        return self.ExonicFunc in self.MISSENSE
 
     def is_truncating(self):
-        return self.ExonicFunc in self.ANNOVAR_EXONIC_FUNCS["truncating"] or self.Func in ["splicing","exonic;splicing"]
+        return self.ExonicFunc in self.TRUNCATING or self.Func in self.SPLICING
 
-    def is_rare(self):
+    def is_rare(self, thresholds=None):
         # Return true iff at least one database has the variant at > the MAF_THRESHOLD
-        log.debug("MAF values for %s:%s are %s", self.Chr, self.Start, map(lambda f: self.maf_value(f),self.POPULATION_FREQ_FIELDS))
-        return not any(map(lambda f: self.maf_value(f)>self.MAF_THRESHOLD, self.POPULATION_FREQ_FIELDS))
+        if log.getLogger().isEnabledFor(log.DEBUG):
+            log.debug("MAF values for %s:%s are %s", self.Chr, self.Start, self.maf_values())
+        threshold = (thresholds or self.default_thresholds()).rare
+        return not any([maf > threshold for maf in self.maf_values()])
 
-    def is_very_rare(self):
+    def is_very_rare(self, thresholds=None):
         # Return true iff at least one database has the variant at > the MAF_THRESHOLD_VERY_RARE
-        return not any(map(lambda f: self.maf_value(f)>self.MAF_THRESHOLD_VERY_RARE, self.POPULATION_FREQ_FIELDS))
+        threshold = (thresholds or self.default_thresholds()).very_rare
+        return not any([maf > threshold for maf in self.maf_values()])
 
-    def is_novel(self):
+    def is_novel(self, thresholds=None):
         # return true iff the variant has no MAF in any database AND no DBSNP ID
-        return not any(map(lambda f: self.maf_value(f) > 0.0, self.POPULATION_FREQ_FIELDS)) and (self.snp138 in ["","."])
+        return not any([maf > 0.0 for maf in self.maf_values()]) and (self.snp138 in ["","."])
 
-    def is_conserved(self):
+    def is_conserved(self, thresholds=None):
         # Clarification 27/5/2014:
         # ONLY if condel score is missing, then it can categorised as a 3 if CONSERVED by Annovar
         condel_str = self.Condel 
         if condel_str != "":
-            return float(condel_str) >= 0.7
+            return float(condel_str) >= (thresholds.condel if thresholds is not None else self.CONSERVED_CONDEL)
         else:
             return self.phastConsElements46way != ""
 
+    @staticmethod
+    def default_thresholds():
+        return Thresholds(Annovar.MAF_THRESHOLD, Annovar.MAF_THRESHOLD_VERY_RARE, Annovar.CONDEL_THRESHOLD)
+
     @staticmethod
     def init_columns(cols):
         Annovar.columns = cols #+ ["MapQ","QD"]
+        # the first of repeated names is used, as for list.index
+        Annovar.column_index = dict([(name, idx) for idx, name in reversed(list(enumerate(cols)))])
+        Annovar.maf_columns = [Annovar.column_index.get(Annovar.maf_column(name)) for name in Annovar.POPULATION_FREQ_FIELDS]
 
-    def maf_value(self, name):
+    @staticmethod
+    def maf_column(name):
         # Trying to be compatible with multiple versions of Annovar, each having different
         # names for this column
-        if name == "exac03" and "ExAC_Freq" in self.columns:
+        if name == "exac03" and "ExAC_Freq" in Annovar.column_index:
             name = "ExAC_Freq"
-        if name == "exac03" and "ExAC_ALL" in self.columns:
+        if name == "exac03" and "ExAC_ALL" in Annovar.column_index:
             name = "ExAC_ALL"
-        value = self.line[self.columns.index(name)]
+        return name
+
+    @staticmethod
+    def parse_maf(value):
         if value == "" or value ==".":
             return 0
         else:
             return float(value)
 
+    def maf_value(self, name):
+        return self.parse_maf(self.line[self.index_of(self.maf_column(name))])
+
+    def maf_values(self):
+        # Population frequencies of POPULATION_FREQ_FIELDS, parsed once for each line
+        if self.mafs is None:
+            if None in self.maf_columns:
+                raise ValueError("{0} is not in the header".format(self.POPULATION_FREQ_FIELDS[self.maf_columns.index(None)]))
+            self.mafs = [self.parse_maf(self.line[idx]) for idx in self.maf_columns]
+        return self.mafs
+
+    def index_of(self, name):
+        if name not in self.column_index:
+            raise ValueError("{0} is not in the header".format(name))
+        return self.column_index[name]
+
     def __getattr__(self,name):
-        return self.line[self.columns.index(name)]
+        if name.startswith('__'): # not a column
+            raise AttributeError(name)
+        return self.line[self.index_of(name)]
     
     def set_value(self,name,value):
-        self.line[self.columns.index(name)]=value
+        self.line[self.index_of(name)]=value
+        self.mafs = None
     
-def process_annovar( annovar, output, synonymous=None ):
+class Regions:
+    """
+    Positions covered by the intervals of a bed file, held as sorted, merged
+    intervals for each chromosome.
+    """
+
+    def __init__(self, bed=()):
+        intervals = collections.defaultdict(list)
+        for line in bed:
+            fields = line.strip().split('\t')
+            if len(fields) > 2:
+                intervals[fields[0]].append((int(fields[1]), int(fields[2])))
+        self.starts = {}
+        self.ends = {}
+        for chrom in intervals:
+            starts, ends = [], []
+            for start, end in sorted(intervals[chrom]):
+                if end <= start:
+                    continue
+                if len(ends) > 0 and start <= ends[-1]:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            self.starts[chrom] = starts
+            self.ends[chrom] = ends
+
+    def contains(self, chrom, position):
+        # position is 0 based, as for the bed file, and may be a string
+        if chrom not in self.starts:
+            return False
+        try:
+            position = int(position)
+        except ValueError:
+            return False
+        idx = bisect.bisect_right(self.starts[chrom], position) - 1
+        return idx >= 0 and position < self.ends[chrom][idx]
+
+    def __len__(self):
+        # number of positions covered
+        return sum([end - start for chrom in self.ends for start, end in zip(self.starts[chrom], self.ends[chrom])])
+
+def classify(lines, synonymous=None, threshold_sets=()):
+    """
+        priority indexes of each of lines, parsed rows of the Annovar file, as a list of
+        the priority with the class thresholds followed by the priority with each of threshold_sets
+        lines shorter than the header are padded with empty fields
+    """
+    columns = len(Annovar.columns)
+    result = []
+    for line in lines:
+        if len(line) < columns:
+            line.extend([""] * (columns - len(line)))
+        av = Annovar(line, synonymous)
+        result.append([av.priority()] + [av.priority(thresholds, verbose=False) for _, thresholds in threshold_sets])
+    return result
+
+def parse_threshold_set(value, defaults):
+    """
+        a named set of thresholds from name:rare:very_rare:condel, where empty thresholds are taken from defaults
+    """
+    fields = value.split(':')
+    if len(fields) != 4 or re.match('^[A-Za-z0-9_]+$', fields[0]) is None:
+        raise ValueError('threshold set "{0}" should be name:rare:very_rare:condel'.format(value))
+    return (fields[0], Thresholds(*[float(field) if field != '' else default for field, default in zip(fields[1:], defaults)]))
+
+
+def write_header( line, output, threshold_sets ):
+    """
+        set the Annovar columns from the header row and write the output header
+    """
+    # Note: Annovar does not seem to provide Qual and Depth headings itself
+    if "Qual" not in line:
+        line = line + ["Qual"]
+
+    if "Depth" not in line:
+        line = line + ["Depth"]
+
+    Annovar.init_columns(line)
+
+    header_out = csv.writer(output, delimiter=',', quotechar='"', quoting=csv.QUOTE_NONE)
+    header_out.writerow(Annovar.columns + ["Priority_Index"] + ["Priority_Index_{0}".format(name) for name, _ in threshold_sets])
+    output.flush()
+
+def count_priorities( counts, chunk_priorities ):
+    """
+        add the priority indexes of a chunk to counts, a dictionary of counts for each priority column
+    """
+    for line_priorities in chunk_priorities:
+        for column, priority in zip(counts, line_priorities):
+            column[priority] += 1
+
+def process_lines( lines, output, synonymous_set, threshold_sets, counts ):
+    """
+        classify parsed rows and write them with their priority indexes
+    """
+    chunk_priorities = classify(lines, synonymous_set, threshold_sets)
+    count_priorities(counts, chunk_priorities)
+    csv_output = csv.writer(output, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+    csv_output.writerows([line + line_priorities for line, line_priorities in itertools.izip(lines, chunk_priorities)])
+
+def log_thresholds( threshold_sets ):
+    log.info( "calculating priorities with thresholds: rare {0}, very rare {1}, condel {2}".format( Annovar.MAF_THRESHOLD, Annovar.MAF_THRESHOLD_VERY_RARE, Annovar.CONDEL_THRESHOLD ) )
+    for name, thresholds in threshold_sets:
+        log.info( "calculating Priority_Index_{0} with thresholds: rare {1}, very rare {2}, condel {3}".format( name, thresholds.rare, thresholds.very_rare, thresholds.condel ) )
+
+def log_priorities( counts, threshold_sets ):
+    log.info( "priority distribution: {0}".format( counts[0] ) )
+    for (name, _), set_counts in zip(threshold_sets, counts[1:]):
+        log.info( "priority distribution for {0}: {1}".format( name, set_counts ) )
+
+def process_annovar( annovar, output, synonymous=None, threshold_sets=() ):
+    """
+        write the rows of annovar with their priority indexes to output
+        returns the counts of each priority, first for the class thresholds then for each of threshold_sets
+    """
     log.info( "started processing..." )
-    # prepare synonymous set
-    synonymous_set = set()
-    if synonymous is not None:
-      for line in synonymous:
-        fields = line.strip().split('\t')
-        if len(fields) > 2:
-          for x in xrange(int(fields[1]), int(fields[2])):
-            key = '{0},{1}'.format( fields[0], x )
-            synonymous_set.add( key )
+    # prepare synonymous regions
+    synonymous_set = Regions( synonymous or () )
     log.info( "finished reading synonymous set: {0} positions.".format( len( synonymous_set ) ) )
 
     # Read the file
     reader = csv.reader(annovar, delimiter=',', quotechar='"', doublequote=True)
 
-    # Open CSV writer to standard output, first for header (for body comes in the loop below)
-    header_out = csv.writer(output, delimiter=',', quotechar='"', quoting=csv.QUOTE_NONE)
-    is_header = True
-    priorities = collections.defaultdict( int )
-    log.info( "calculating priorities with thresholds: rare {0}, very rare {1}, condel {2}".format( Annovar.MAF_THRESHOLD, Annovar.MAF_THRESHOLD_VERY_RARE, Annovar.CONDEL_THRESHOLD ) )
+    counts = [ collections.defaultdict( int ) for _ in range( len( threshold_sets ) + 1 ) ]
+    log_thresholds( threshold_sets )
     for line in reader:
+        write_header( line, output, threshold_sets )
+
+        # classify the remaining rows a chunk at a time
+        while True:
+            lines = list(itertools.islice(reader, CHUNK_ROWS))
+            if len(lines) == 0:
+                break
+            process_lines( lines, output, synonymous_set, threshold_sets, counts )
+        break
+    log_priorities( counts, threshold_sets )
+    return counts
+
+class CountingLines(object):
+    """
+        iterate over the lines of a file, keeping the byte offset of the end of the last line read
+    """
+    def __init__(self, handle):
+        self.handle = handle
+        self.offset = 0
 
-        if is_header:
-            is_header = False
-            # Note: Annovar does not seem to provide Qual and Depth headings itself
-            if "Qual" not in line:
-                line = line + ["Qual"]
-
-            if "Depth" not in line:
-                line = line + ["Depth"]
-
-            Annovar.init_columns(line)
+    def __iter__(self):
+        return self
 
-            header_out.writerow(Annovar.columns + ["Priority_Index"])
-            output.flush()
-            csv_output = csv.writer(output, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-            continue
+    def next(self):
+        line = self.handle.next()
+        self.offset += len(line)
+        return line
 
-        av = Annovar(line, synonymous_set)
+def chunk_ranges( lines, reader, chunk_bytes ):
+    """
+        generate (start, end) byte ranges of about chunk_bytes holding whole records of reader,
+        which parses lines, a CountingLines. a range only ends after a complete record, so
+        quoted fields containing newlines are never split
+    """
+    start = lines.offset
+    for _ in reader:
+        if lines.offset - start >= chunk_bytes:
+            yield ( start, lines.offset )
+            start = lines.offset
+    if lines.offset > start:
+        yield ( start, lines.offset )
+
+# header, synonymous regions and thresholds shared by workers, set before the pool forks
+WORKER_STATE = {}
+
+def set_worker_state( filename, columns, thresholds, synonymous_set, threshold_sets ):
+    """
+        pool initializer: make the file, its columns and the thresholds available to classify_range
+    """
+    Annovar.init_columns( columns )
+    Annovar.MAF_THRESHOLD, Annovar.MAF_THRESHOLD_VERY_RARE, Annovar.CONDEL_THRESHOLD = thresholds
+    WORKER_STATE.update( { 'filename': filename, 'synonymous': synonymous_set, 'threshold_sets': threshold_sets } )
 
-        while len(line)<len(Annovar.columns):
-                line.append("")
+def classify_range( task ):
+    """
+        classify the records in a byte range of the shared file, returning the output rows as text with the priority counts
+    """
+    start, end = task
+    with open( WORKER_STATE['filename'], 'rb' ) as handle:
+        handle.seek( start )
+        data = handle.read( end - start )
+    threshold_sets = WORKER_STATE['threshold_sets']
+    lines = list( csv.reader( StringIO.StringIO( data ), delimiter=',', quotechar='"', doublequote=True ) )
+    output = StringIO.StringIO()
+    counts = [ collections.defaultdict( int ) for _ in range( len( threshold_sets ) + 1 ) ]
+    process_lines( lines, output, WORKER_STATE['synonymous'], threshold_sets, counts )
+    return output.getvalue(), counts
+
+def process_annovar_parallel( filename, output, synonymous=None, threshold_sets=(), workers=2, chunk_bytes=CHUNK_BYTES ):
+    """
+        process_annovar with a pool of workers, each classifying a byte range of the file
+        ranges are written in file order, so the output and counts match a serial run
+    """
+    log.info( "started processing with {0} workers...".format( workers ) )
+    synonymous_set = Regions( synonymous or () )
+    log.info( "finished reading synonymous set: {0} positions.".format( len( synonymous_set ) ) )
 
-        priority = av.priority()
-        priorities[priority] += 1
-        csv_output.writerow(line + [priority])
-    log.info( "priority distribution: {0}".format( priorities ) )
+    counts = [ collections.defaultdict( int ) for _ in range( len( threshold_sets ) + 1 ) ]
+    log_thresholds( threshold_sets )
+    with open( filename, 'rb' ) as handle:
+        lines = CountingLines( handle )
+        reader = csv.reader( lines, delimiter=',', quotechar='"', doublequote=True )
+        for line in reader:
+            write_header( line, output, threshold_sets )
+            # ranges are found before the pool starts, as the pool would hide errors parsing the file
+            ranges = list( chunk_ranges( lines, reader, chunk_bytes ) )
+            pool = multiprocessing.Pool( workers, initializer=set_worker_state, initargs=( filename, Annovar.columns, Annovar.default_thresholds(), synonymous_set, threshold_sets ) )
+            try:
+                for text, chunk_counts in pool.imap( classify_range, ranges ):
+                    output.write( text )
+                    for column, chunk_column in zip( counts, chunk_counts ):
+                        for priority, count in chunk_column.items():
+                            column[priority] += count
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+            break
+    log_priorities( counts, threshold_sets )
+    return counts
 
 ####################################################################################
 #
@@ -274,8 +522,10 @@ def main():
     parser.add_argument('--annovar', required=True, help='annovar file')
     parser.add_argument('--rare', required=False, help='threshold for rare')
     parser.add_argument('--very_rare', required=False, help='threshold for very rare')
-    parser.add_argument('--condel', required=False, help='threshold for condel')
+    parser.add_argument('--condel', required=False, help='threshold for condel in --threshold_set. the main Priority_Index always uses 0.7')
     parser.add_argument('--synonymous', required=False, help='bed file allowing synonymous variants')
+    parser.add_argument('--workers', required=False, type=int, default=1, help='number of processes classifying chunks of the file in parallel')
+    parser.add_argument('--threshold_set', required=False, action='append', default=[], help='also calculate Priority_Index_<name> with thresholds given as name:rare:very_rare:condel. empty thresholds are those of --rare, --very_rare and --condel. can be given several times')
     args = parser.parse_args()
 
     if args.rare:
@@ -287,10 +537,18 @@ def main():
     if args.very_rare:
         Annovar.MAF_THRESHOLD_VERY_RARE = float(args.very_rare)
 
-    if args.synonymous:
-      process_annovar( open( args.annovar, 'r' ), sys.stdout, synonymous=open( args.synonymous, 'r' ) )
+    try:
+        threshold_sets = [parse_threshold_set(value, Annovar.default_thresholds()) for value in args.threshold_set]
+    except ValueError, ex:
+        parser.error(str(ex))
+    if len(set([name for name, _ in threshold_sets])) != len(threshold_sets):
+        parser.error('threshold set names must be unique')
+
+    synonymous = open( args.synonymous, 'r' ) if args.synonymous else None
+    if args.workers > 1:
+      process_annovar_parallel( args.annovar, sys.stdout, synonymous=synonymous, threshold_sets=threshold_sets, workers=args.workers )
     else:
-      process_annovar( open( args.annovar, 'r' ), sys.stdout )
+      process_annovar( open( args.annovar, 'r' ), sys.stdout, synonymous=synonymous, threshold_sets=threshold_sets )
     
 if __name__ == "__main__":    
     main()
@@ -35,6 +35,8 @@ import os
 import datetime
 import csv
 
+import sample_metadata
+
 #################
 #parse arguments#
 #################
@@ -145,9 +147,9 @@ def make_screeningANDindividual_dictionary(metaFile):
 	'''
 
 	#file=open(metaFile, 'r')
-	file = csv.reader(open(metaFile), delimiter='\t')
+	metadata = sample_metadata.load(metaFile)
 	meta_dict={}
-	for row in file:
+	for row in metadata.csv_rows():
 		#print row
 		#print row #row is an array of the fields
 		#print len(line.strip().split()), line.strip().split()
@@ -168,7 +170,7 @@ def make_screeningANDindividual_dictionary(metaFile):
 			if meta_dict.has_key(identifier):
 				print "Is the two patients/samples the same?"
 				print meta_dict[identifier][1][0]
-				if line == meta_dict[identifier][1][0]:
+				if row == meta_dict[identifier][1][0]:
 					_sameLine =1
 					print "same"
 	    		
@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+'''
+###########################################################################
+#
+# This file is part of Cpipe.
+#
+# Cpipe is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, under version 3 of the License, subject
+# to additional terms compatible with the GNU General Public License version 3,
+# specified in the LICENSE file that is part of the Cpipe distribution.
+#
+# Cpipe is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cpipe.  If not, see <http:#www.gnu.org/licenses/>.
+#
+###########################################################################
+#
+# Purpose:
+#   Calculate per base coverage, on target reads, fragment statistics and
+#   per chromosome depth from a single pass over a bam, instead of
+#   separate coverageBed, samtools and calculate_qc_statistics passes
+# Usage:
+#   bam_qc.py --bam sample.bam --exome exome.bed --target target.bed --ontarget_bed combined.bed
+#     --target_cov sample.cov.txt --exome_cov sample.exome.txt --ontarget sample.ontarget.txt --fragments sample.fragments.tsv
+#   bam_qc.py --bam sample.bam --exome exome.bed --target target.bed --sample_fraction 0.05 --coverage_summary sample.preliminary.tsv
+#
+###########################################################################
+'''
+
+import array
+import bisect
+import collections
+import datetime
+import math
+import sys
+
+import calculate_qc_statistics
+
+CONFIDENCE_Z = calculate_qc_statistics.CONFIDENCE_Z
+
+BedInterval = collections.namedtuple('BedInterval', ['chrom', 'start', 'end', 'fields'])
+BamQC = collections.namedtuple('BamQC', ['stats', 'ontarget', 'reads'])
+
+def write_log(log, msg):
+    '''
+        write a date stamped message to log
+    '''
+    now = datetime.datetime.now().strftime('%y%m%d-%H%M%S')
+    if log is not None:
+        log.write('%s: %s\n' % (now, msg))
+
+def read_bed(bed):
+    '''
+        intervals of a bed file in file order, skipping comments and track lines
+    '''
+    result = []
+    for line in bed:
+        if line.startswith('#') or line.startswith('track') or line.startswith('browser') or line.strip() == '':
+            continue
+        fields = line.strip('\n').split('\t')
+        result.append(BedInterval(fields[0], int(fields[1]), int(fields[2]), fields))
+    return result
+
+def intersect_bed(target, exome):
+    '''
+        each target interval clipped to each overlapping exome interval, as for bedtools intersect -a target -b exome
+    '''
+    by_chrom = collections.defaultdict(list)
+    for interval in exome:
+        by_chrom[interval.chrom].append((interval.start, interval.end))
+    starts = {}
+    longest = {}
+    for chrom in by_chrom:
+        by_chrom[chrom].sort()
+        starts[chrom] = [start for start, _ in by_chrom[chrom]]
+        longest[chrom] = max([end - start for start, end in by_chrom[chrom]])
+    result = []
+    for interval in target:
+        if interval.chrom not in by_chrom:
+            continue
+        candidates = by_chrom[interval.chrom]
+        first = bisect.bisect_left(starts[interval.chrom], interval.start - longest[interval.chrom])
+        last = bisect.bisect_left(starts[interval.chrom], interval.end)
+        for start, end in candidates[first:last]:
+            if end > interval.start:
+                start, end = max(start, interval.start), min(end, interval.end)
+                result.append(BedInterval(interval.chrom, start, end, [interval.chrom, str(start), str(end)] + interval.fields[3:]))
+    return result
+
+class RegionDepth(object):
+    '''
+        per base depth over the merged regions of one chromosome
+        bases of the regions are stored contiguously, so memory follows the size of the regions rather than the chromosome
+    '''
+    def __init__(self, intervals):
+        merged = []
+        for start, end in sorted(intervals):
+            if len(merged) > 0 and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        self.starts = array.array('l', [start for start, _ in merged])
+        self.ends = array.array('l', [end for _, end in merged])
+        self.offsets = array.array('l')
+        self.size = 0
+        for start, end in merged:
+            self.offsets.append(self.size)
+            self.size += end - start
+        self.depth = array.array('i', [0]) * (self.size + 1) # depth changes until finish is called
+        self.finished = False
+
+    def position(self, pos):
+        '''
+            number of region bases before pos
+        '''
+        idx = bisect.bisect_right(self.starts, pos) - 1
+        if idx < 0:
+            return 0
+        return self.offsets[idx] + min(pos - self.starts[idx], self.ends[idx] - self.starts[idx])
+
+    def overlaps(self, start, end):
+        '''
+            does start to end include any region bases
+        '''
+        return self.position(end) > self.position(start)
+
+    def add(self, start, end):
+        '''
+            count a read covering start to end
+        '''
+        first = self.position(start)
+        last = self.position(end)
+        if last > first:
+            self.depth[first] += 1
+            self.depth[last] -= 1
+
+    def finish(self):
+        '''
+            turn depth changes into depth
+        '''
+        if self.finished:
+            return
+        running = 0
+        depth = self.depth
+        for idx in xrange(self.size):
+            running += depth[idx]
+            depth[idx] = running
+        self.finished = True
+
+    def region_depth(self, start, end):
+        '''
+            depth of each base from start to end, which must lie within one region
+        '''
+        self.finish()
+        first = self.position(start)
+        return self.depth[first:first + end - start]
+
+    def total(self):
+        '''
+            sum of depth over all region bases
+        '''
+        self.finish()
+        return sum(self.depth[:self.size])
+
+def build_depths(intervals):
+    '''
+        a RegionDepth for each chromosome of the intervals
+    '''
+    by_chrom = collections.defaultdict(list)
+    for interval in intervals:
+        by_chrom[interval.chrom].append((interval.start, interval.end))
+    return dict([(chrom, RegionDepth(by_chrom[chrom])) for chrom in by_chrom])
+
+def calculate_bam_qc(alignments, references, depths, ontarget_regions, log):
+    '''
+        read alignments once, adding coverage to depths and counting on target reads
+        alignments are as from calculate_qc_statistics.bam_alignments, references are the names of the bam references
+        reads count as covering the bases they span on the reference, as coverageBed does without -split
+        reads count as on target if they overlap ontarget_regions, as samtools view -L does
+    '''
+    stats = calculate_qc_statistics.ShardStatistics()
+    reads = collections.defaultdict(int)
+    ontarget = 0
+    depth_lookup = [depths.get(name) for name in references]
+    ontarget_lookup = [ontarget_regions.get(name) for name in references] if ontarget_regions is not None else None
+    for idx, (ref_id, pos, ref_length, flag, tlen, length, quality) in enumerate(alignments):
+        stats.add(flag, tlen, length, quality)
+        if idx % 1000000 == 0:
+            write_log(log, 'processed {0} reads...'.format(idx))
+        if ref_id < 0:
+            continue
+        mapped = flag & 0x04 == 0 and ref_length > 0
+        if mapped:
+            reads[ref_id] += 1
+            if depth_lookup[ref_id] is not None:
+                depth_lookup[ref_id].add(pos, pos + ref_length)
+        if ontarget_lookup is not None and ontarget_lookup[ref_id] is not None:
+            if ontarget_lookup[ref_id].overlaps(pos, pos + ref_length if mapped else pos + 1):
+                ontarget += 1
+    write_log(log, 'processed {0} reads on {1} references, {2} on target'.format(sum(reads.values()), len(reads), ontarget))
+    return BamQC(stats, ontarget, dict([(references[ref_id], count) for ref_id, count in reads.items()]))
+
+def write_coverage(intervals, depths, out, scale=1.):
+    '''
+        write per base coverage of each interval in the format of coverageBed -d: the bed fields, 1 based offset and depth
+        depth is multiplied by scale, to estimate coverage from a subsample of reads
+    '''
+    for interval in intervals:
+        prefix = '\t'.join(interval.fields)
+        if interval.chrom in depths:
+            depth = depths[interval.chrom].region_depth(interval.start, interval.end)
+        else:
+            depth = [0] * (interval.end - interval.start)
+        if scale != 1.:
+            depth = [int(round(value * scale)) for value in depth]
+        out.write(''.join(['{0}\t{1}\t{2}\n'.format(prefix, offset + 1, value) for offset, value in enumerate(depth)]))
+
+def write_chromosomes(references, reads, depths, out):
+    '''
+        write mapped reads, region bases, total and mean depth over the regions for each chromosome
+    '''
+    out.write('#chrom\treads\tbases\tdepth\tmean_depth\n')
+    for name in references:
+        if name in depths and depths[name].size > 0:
+            bases = depths[name].size
+            total = depths[name].total()
+            mean = 1. * total / bases
+        else:
+            bases = total = 0
+            mean = 0.
+        out.write('{0}\t{1}\t{2}\t{3}\t{4:.2f}\n'.format(name, reads.get(name, 0), bases, total, mean))
+
+def summarize_coverage(intervals, depths, result, fraction=1.):
+    '''
+        estimated mean and median coverage of intervals and on target reads, with confidence intervals when reads were subsampled
+        reads overlapping the intervals are taken as the total depth divided by the mean read length, and treated as independent
+    '''
+    histogram = collections.defaultdict(int)
+    for interval in intervals:
+        if interval.chrom in depths:
+            for value in depths[interval.chrom].region_depth(interval.start, interval.end):
+                histogram[value] += 1
+        else:
+            histogram[0] += interval.end - interval.start
+    bases = sum(histogram.values())
+    total = sum([value * count for value, count in histogram.items()])
+    stats = result.stats.result(None)
+    reads = 1. * total / stats['read_mean'] if stats['read_mean'] > 0 else 0.
+    margin = CONFIDENCE_Z * math.sqrt((1. - fraction) / reads) if reads > 0 else 0.
+    median = calculate_qc_statistics.median_of_counts(sorted(histogram.items()))
+    mean = 1. * total / bases / fraction if bases > 0 else 0.
+    median = median / fraction if median is not None else 0.
+    ontarget, ontarget_low, ontarget_high = calculate_qc_statistics.extrapolate_count(result.ontarget, fraction)
+    return collections.OrderedDict([
+        ('sample_fraction', fraction),
+        ('bases', bases),
+        ('mean_coverage', mean),
+        ('mean_coverage_low', mean * max(0., 1. - margin)),
+        ('mean_coverage_high', mean * (1. + margin)),
+        ('median_coverage', median),
+        ('median_coverage_low', median * max(0., 1. - margin)),
+        ('median_coverage_high', median * (1. + margin)),
+        ('ontarget_reads', int(round(ontarget))),
+        ('ontarget_reads_low', int(math.floor(ontarget_low))),
+        ('ontarget_reads_high', int(math.ceil(ontarget_high)))])
+
+def write_summary(summary, out):
+    '''
+        write key, value lines as parse_tsv in qc_report reads them
+    '''
+    for key, value in summary.items():
+        if isinstance(value, float):
+            out.write('{0}\t{1:.2f}\n'.format(key, value))
+        else:
+            out.write('{0}\t{1}\n'.format(key, value))
+
+def main():
+    '''
+        parse command line and execute
+    '''
+    import argparse
+    parser = argparse.ArgumentParser(description='Calculate coverage and read statistics from one pass over a bam')
+    parser.add_argument('--bam', required=True, help='bam file to read')
+    parser.add_argument('--threads', required=False, type=int, default=2, help='threads for decompressing the bam')
+    parser.add_argument('--exome', required=True, help='bed file of exome regions')
+    parser.add_argument('--target', required=False, help='bed file of target regions, intersected with the exome for --target_cov')
+    parser.add_argument('--ontarget_bed', required=False, help='bed file of regions for counting on target reads')
+    parser.add_argument('--target_cov', required=False, help='write per base coverage of the target intersected with the exome to this file')
+    parser.add_argument('--exome_cov', required=False, help='write per base coverage of the exome to this file')
+    parser.add_argument('--ontarget', required=False, help='write the number of reads overlapping ontarget_bed to this file')
+    parser.add_argument('--fragments', required=False, help='write fragment, read length and base quality statistics to this file')
+    parser.add_argument('--distributions', required=False, help='write fragment size and read length distributions to this file')
+    parser.add_argument('--qualities', required=False, help='write the base quality histogram and mean quality per cycle to this file')
+    parser.add_argument('--chromosomes', required=False, help='write reads and mean exome depth of each chromosome to this file')
+    parser.add_argument('--coverage_summary', required=False, help='write estimated mean and median coverage of the target, or the exome without --target, and on target reads to this file')
+    parser.add_argument('--sample_fraction', required=False, type=float, help='estimate everything from this fraction of reads, chosen by read name so that mates stay together')
+    args = parser.parse_args()
+    if args.sample_fraction is not None and not 0 < args.sample_fraction <= 1:
+        parser.error('--sample_fraction must be more than 0 and at most 1')
+    fraction = args.sample_fraction or 1.
+    if args.target_cov and not args.target:
+        parser.error('--target is required with --target_cov')
+    if args.ontarget and not args.ontarget_bed:
+        parser.error('--ontarget_bed is required with --ontarget')
+
+    exome = read_bed(open(args.exome, 'r'))
+    depths = build_depths(exome) # the target coverage is within the exome, so exome depths cover both
+    ontarget_regions = build_depths(read_bed(open(args.ontarget_bed, 'r'))) if args.ontarget_bed else None
+    references = calculate_qc_statistics.bam_references(open(args.bam, 'rb'))
+    alignments = calculate_qc_statistics.bam_alignments(open(args.bam, 'rb'), args.threads, fraction=args.sample_fraction)
+    result = calculate_bam_qc(alignments, references, depths, ontarget_regions, sys.stderr)
+    target = intersect_bed(read_bed(open(args.target, 'r')), exome) if args.target else None
+
+    if args.target_cov:
+        with open(args.target_cov, 'w') as out:
+            write_coverage(target, depths, out, 1. / fraction)
+    if args.exome_cov:
+        with open(args.exome_cov, 'w') as out:
+            write_coverage(exome, depths, out, 1. / fraction)
+    if args.ontarget:
+        with open(args.ontarget, 'w') as out:
+            out.write('{0}\n'.format(int(round(result.ontarget / fraction))))
+    if args.coverage_summary:
+        with open(args.coverage_summary, 'w') as out:
+            write_summary(summarize_coverage(target if target is not None else exome, depths, result, fraction), out)
+    stats = result.stats.result(sys.stderr)
+    if args.sample_fraction is not None:
+        stats = calculate_qc_statistics.extrapolate_statistics(stats, args.sample_fraction)
+    if args.fragments:
+        with open(args.fragments, 'w') as out:
+            calculate_qc_statistics.write_statistics(stats, out)
+    if args.distributions:
+        with open(args.distributions, 'w') as out:
+            calculate_qc_statistics.write_distributions(stats, out)
+    if args.qualities:
+        with open(args.qualities, 'w') as out:
+            stats['qualities'].write(out)
+    if args.chromosomes:
+        with open(args.chromosomes, 'w') as out:
+            write_chromosomes(references, result.reads, depths, out)
+
+if __name__ == '__main__':
+    main()
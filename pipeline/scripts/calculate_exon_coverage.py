@@ -17,26 +17,73 @@
 # Purpose:
 #   Generate coverage stats for genes over a capture
 # Usage:
-#   python calculate_exon_coverage --capture capture_file --exons exon_file
+#   python calculate_exon_coverage --capture capture_file --exons exon_file [--cache cache_dir]
 # Outputs:
 #   writes a tab separated file of genes and what proportion is covered by the capture
 ##############################################################################
 '''
 
+import bisect
 import collections
 import sys
 
+import reference_cache
+
+def merge_intervals(intervals):
+    '''
+        sorted, non overlapping intervals covering the same bases as intervals, a list of (start, end)
+    '''
+    result = []
+    for start, end in sorted(intervals):
+        if end <= start:
+            continue
+        if len(result) > 0 and start <= result[-1][1]:
+            result[-1][1] = max(result[-1][1], end)
+        else:
+            result.append([start, end])
+    return result
+
+class CoveredBases(object):
+    '''
+        count the bases of a region that fall within a set of merged intervals on one chromosome
+    '''
+    def __init__(self, intervals):
+        merged = merge_intervals(intervals)
+        self.starts = [start for start, _ in merged]
+        self.ends = [end for _, end in merged]
+        self.before = [0] # bases covered before each interval
+        for start, end in merged:
+            self.before.append(self.before[-1] + end - start)
+
+    def below(self, position):
+        '''
+            number of covered bases before position
+        '''
+        idx = bisect.bisect_right(self.starts, position) - 1
+        if idx < 0:
+            return 0
+        return self.before[idx] + min(position, self.ends[idx]) - self.starts[idx]
+
+    def overlap(self, start, end):
+        '''
+            number of covered bases from start to end (0 based, half open)
+        '''
+        if end <= start:
+            return 0
+        return self.below(end) - self.below(start)
+
 def calculate_coverage(capture, exons, out, log):
     '''
         calculate overlap across genes
+        bases of overlapping exons of a gene are counted for each exon
     '''
     log.write('reading capture...\n')
-    cap = set()
+    intervals = collections.defaultdict(list)
     for line in capture:
         fields = line.strip().split('\t') # chr, start, end
         if len(fields) > 2:
-            for x in xrange(int(fields[1]), int(fields[2])):
-                cap.add('{0}:{1}'.format(fields[0], x))
+            intervals[fields[0]].append((int(fields[1]), int(fields[2])))
+    cap = dict([(chrom, CoveredBases(intervals[chrom])) for chrom in intervals])
 
     log.write('reading exons...\n')
     found = collections.defaultdict(int)
@@ -45,11 +92,11 @@ def calculate_coverage(capture, exons, out, log):
         fields = line.strip().split('\t') # chr, start, end, gene
         if len(fields) > 3:
             gene = fields[3].lower()
-            for x in xrange(int(fields[1]), int(fields[2])):
-                cand = '{0}:{1}'.format(fields[0], x)
-                if cand in cap:
-                    found[gene] += 1
-                total[gene] += 1
+            start, end = int(fields[1]), int(fields[2])
+            if end > start:
+                if fields[0] in cap:
+                    found[gene] += cap[fields[0]].overlap(start, end)
+                total[gene] += end - start
 
     # write results
     log.write('writing results...\n')
@@ -66,8 +113,13 @@ def main():
     parser = argparse.ArgumentParser(description='Generate coverage report')
     parser.add_argument('--capture', required=True, help='capture file')
     parser.add_argument('--exons', required=True, help='exons')
+    parser.add_argument('--cache', required=False, help='directory of results for previously seen captures and exons')
     args = parser.parse_args()
-    calculate_coverage(open(args.capture, 'r'), open(args.exons, 'r'), sys.stdout, sys.stderr)
+    if args.cache:
+        compute = lambda out: calculate_coverage(open(args.capture, 'r'), open(args.exons, 'r'), out, sys.stderr)
+        reference_cache.cached(args.cache, 'exon_coverage_stats', reference_cache.script_version(__file__), [args.capture, args.exons], compute, sys.stdout, log=sys.stderr)
+    else:
+        calculate_coverage(open(args.capture, 'r'), open(args.exons, 'r'), sys.stdout, sys.stderr)
 
 if __name__ == '__main__':
     main()
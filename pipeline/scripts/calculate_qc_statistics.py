@@ -24,14 +24,44 @@
 #   Generate fragment statistics
 # Usage:
 #   samtools view file.bam | python calculate_qc_statistics.py > stats.out
+#   python calculate_qc_statistics.py --bam file.bam > stats.out
+#   python calculate_qc_statistics.py --bam file.bam --sample_fraction 0.05 > estimated_stats.out
 ###########################################################################
 '''
 
+import collections
 import datetime
+import itertools
+import math
+import multiprocessing
+import multiprocessing.pool
+import os
+import re
+import struct
 import sys
+import zlib
 
 BASE_QUALITY_THRESHOLD=30
 
+QUALITY_BATCH = 10000 # reads per batch of quality strings
+BGZF_BLOCKS = 64 # compressed blocks read per batch, each is at most 64kb
+BAM_MAGIC = 'BAM\1'
+BAI_PSEUDO_BIN = 37450
+UNPLACED = '*' # shard name for reads without a reference
+REFERENCE_CIGAR_OPS = frozenset([0, 2, 3, 7, 8]) # M, D, N, =, X consume the reference
+FRAGMENT_SIZE_LIMIT = 2000 # larger fragments are counted in the overflow bucket
+READ_LENGTH_LIMIT = 1000 # longer reads are counted in the overflow bucket
+PERCENTILES = (5, 25, 75, 95)
+CONFIDENCE_Z = 1.96 # 95% confidence intervals for estimates from a subsample of reads
+# bam qualities are raw phred scores, convert to sam text encoding
+PHRED_TO_SAM = ''.join([chr(min(x + 33, 255)) for x in xrange(256)])
+
+def keep_read(name, fraction):
+    '''
+        choose reads by a hash of their name, so that the choice is repeatable and mates are kept or dropped together
+    '''
+    return zlib.crc32(name) & 0xffffffff < fraction * 0x100000000
+
 def write_log(log, msg):
     '''
         write a date stamped message to log
@@ -40,85 +70,679 @@ def write_log(log, msg):
     if log is not None:
         log.write('%s: %s\n' % (now, msg))
 
-def calculate_statistics(sam, log):
+class QualityStats(object):
     '''
-        read lines from sam and calculate mean and sd
+        histogram of base qualities and total quality at each cycle
+        sam quality strings are processed in batches so that counting is done by string methods rather than per base
     '''
-    write_log(log, 'started reading sam...')
-    fragment_count = 0
-    fragment_mean = 0.0
-    fragment_std = 0.0
-    read_count = 0
-    read_mean = 0.0
-    read_std = 0.0
-    base_count = 0
-    pass_count = 0
-    for idx, line in enumerate(sam):
-        fields = line.strip('\n').split('\t')
-        flag = int(fields[1])
-        # read
-        incoming = float(len(fields[9]))
-        read_count += 1
-        if read_count == 1:
-            read_mean = incoming
-            read_std = 0.0
+    def __init__(self):
+        self.histogram = collections.defaultdict(int) # phred score -> bases
+        self.cycle_bases = [] # bases at each cycle
+        self.cycle_totals = [] # sum of phred scores at each cycle
+        self.pending = []
+
+    def add(self, quality):
+        '''
+            add the sam quality string of a read
+        '''
+        self.pending.append(quality)
+        if len(self.pending) >= QUALITY_BATCH:
+            self.flush()
+
+    def flush(self):
+        '''
+            count pending quality strings
+        '''
+        if len(self.pending) == 0:
+            return
+        batch = self.pending
+        self.pending = []
+        joined = ''.join(batch)
+        for c in set(joined):
+            self.histogram[ord(c) - 33] += joined.count(c)
+        for cycle, column in enumerate(itertools.izip_longest(*batch, fillvalue='')):
+            column = ''.join(column)
+            if cycle == len(self.cycle_bases):
+                self.cycle_bases.append(0)
+                self.cycle_totals.append(0)
+            self.cycle_bases[cycle] += len(column)
+            self.cycle_totals[cycle] += sum(bytearray(column)) - 33 * len(column)
+
+    def merge(self, other):
+        '''
+            combine with the qualities of another shard
+        '''
+        self.flush()
+        other.flush()
+        for quality, count in other.histogram.items():
+            self.histogram[quality] += count
+        for cycle, (bases, total) in enumerate(zip(other.cycle_bases, other.cycle_totals)):
+            if cycle == len(self.cycle_bases):
+                self.cycle_bases.append(0)
+                self.cycle_totals.append(0)
+            self.cycle_bases[cycle] += bases
+            self.cycle_totals[cycle] += total
+
+    def base_count(self):
+        '''
+            total bases
+        '''
+        self.flush()
+        return sum(self.histogram.values())
+
+    def bases_at_or_above(self, threshold):
+        '''
+            bases with quality of at least threshold
+        '''
+        self.flush()
+        return sum([count for quality, count in self.histogram.items() if quality >= threshold])
+
+    def cycle_means(self):
+        '''
+            mean quality at each cycle
+        '''
+        self.flush()
+        return [1. * total / bases for total, bases in zip(self.cycle_totals, self.cycle_bases)]
+
+    def write(self, out):
+        '''
+            write the quality histogram and per cycle mean quality in tab separated format
+        '''
+        self.flush()
+        for quality in sorted(self.histogram):
+            out.write('quality\t{0}\t{1}\n'.format(quality, self.histogram[quality]))
+        for cycle, (bases, mean) in enumerate(zip(self.cycle_bases, self.cycle_means())):
+            out.write('cycle\t{0}\t{1}\t{2:.2f}\n'.format(cycle + 1, bases, mean))
+
+class RunningStats(object):
+    '''
+        count, mean and sum of squared differences from the mean of a stream of values
+        shards are combined with the parallel variance formula
+    '''
+    def __init__(self, count=0, mean=0.0, m2=0.0):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+
+    def add(self, incoming):
+        '''
+            running mean and sd calculation
+        '''
+        self.count += 1
+        if self.count == 1:
+            self.mean = incoming
+            self.m2 = 0.0
         else:
-            old_mean = read_mean # old m
-            read_mean = old_mean + (incoming - old_mean) / read_count
-            read_std = read_std + (incoming - old_mean) * (incoming - read_mean)
+            old_mean = self.mean
+            self.mean = old_mean + (incoming - old_mean) / self.count
+            self.m2 = self.m2 + (incoming - old_mean) * (incoming - self.mean)
+
+    def merge(self, other):
+        '''
+            combine with the stats of another shard
+        '''
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.count / count
+        self.m2 = self.m2 + other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+
+    def sd(self):
+        '''
+            sample standard deviation
+        '''
+        return (self.m2 / (self.count - 1)) ** 0.5
+
+def value_at(counts, rank):
+    '''
+        the value at 0 based position rank of the values described by sorted (value, count) pairs
+    '''
+    for value, count in counts:
+        if rank < count:
+            return value
+        rank -= count
+    return None
+
+def median_of_counts(counts):
+    '''
+        median of the values described by sorted (value, count) pairs, or None if there are none
+    '''
+    total = sum([count for value, count in counts])
+    if total == 0:
+        return None
+    if total % 2 == 1:
+        return value_at(counts, total // 2)
+    return (value_at(counts, total // 2 - 1) + value_at(counts, total // 2)) / 2.
+
+def format_size(size):
+    '''
+        sizes are integers except for medians between two values
+    '''
+    if size is None:
+        return 0
+    if size == int(size):
+        return int(size)
+    return size
+
+class SizeHistogram(object):
+    '''
+        counts of integer sizes from 0 to limit, with larger sizes counted in a single overflow bucket
+        memory is fixed whatever the number of values, and histograms from different shards can be merged
+        overflow sizes are treated as limit + 1 when calculating median, mad and percentiles
+    '''
+    def __init__(self, limit):
+        self.limit = limit
+        self.counts = [0] * (limit + 1)
+        self.overflow = 0
+
+    def add(self, size, count=1):
+        '''
+            count a size
+        '''
+        if size > self.limit:
+            self.overflow += count
+        else:
+            self.counts[size] += count
+
+    def merge(self, other):
+        '''
+            combine with the histogram of another shard
+        '''
+        for size, count in other.items():
+            self.add(size, count)
 
-        # fragment
+    def count(self):
+        '''
+            total values
+        '''
+        return sum(self.counts) + self.overflow
+
+    def items(self):
+        '''
+            (size, count) for each non-empty bucket, with overflow as limit + 1
+        '''
+        result = [(size, count) for size, count in enumerate(self.counts) if count > 0]
+        if self.overflow > 0:
+            result.append((self.limit + 1, self.overflow))
+        return result
+
+    def value_at(self, rank):
+        '''
+            the size at 0 based position rank of the sorted values
+        '''
+        return value_at(self.items(), rank)
+
+    def median(self):
+        '''
+            median size, or None if empty
+        '''
+        return median_of_counts(self.items())
+
+    def mad(self):
+        '''
+            median absolute deviation from the median, or None if empty
+        '''
+        median = self.median()
+        if median is None:
+            return None
+        return median_of_counts(sorted([(abs(size - median), count) for size, count in self.items()]))
+
+    def percentile(self, percent):
+        '''
+            nearest rank percentile, or None if empty
+        '''
+        total = self.count()
+        if total == 0:
+            return None
+        rank = max(0, int(math.ceil(percent / 100. * total)) - 1)
+        return self.value_at(rank)
+
+    def write(self, out, name):
+        '''
+            write median, mad, percentiles and the full histogram in tab separated format
+        '''
+        out.write('{0}_count\t{1}\n'.format(name, self.count()))
+        out.write('{0}_median\t{1}\n'.format(name, format_size(self.median())))
+        out.write('{0}_mad\t{1}\n'.format(name, format_size(self.mad())))
+        for percent in PERCENTILES:
+            out.write('{0}_p{1}\t{2}\n'.format(name, percent, format_size(self.percentile(percent))))
+        out.write('{0}_overflow\t{1}\n'.format(name, self.overflow))
+        out.write('{0}_limit\t{1}\n'.format(name, self.limit))
+        out.write('{0}_histogram\t{1}\n'.format(name, ','.join(['{0}:{1}'.format(size, count) for size, count in self.items()])))
+
+class ShardStatistics(object):
+    '''
+        read length, fragment size and base quality statistics for some of the reads of a sample
+        shards can be written, read back and merged
+    '''
+    def __init__(self):
+        self.reads = RunningStats()
+        self.fragments = RunningStats()
+        self.qualities = QualityStats()
+        self.read_lengths = SizeHistogram(READ_LENGTH_LIMIT)
+        self.fragment_sizes = SizeHistogram(FRAGMENT_SIZE_LIMIT)
+
+    def add(self, flag, tlen, length, quality):
+        '''
+            include a (flag, tlen, read length, quality) record
+        '''
+        self.reads.add(float(length))
+        self.read_lengths.add(int(length))
         if flag & 0x01 > 0 and flag & 0x02 > 0 and flag & 0x04 == 0: # multiple segments, properly aligned, segment mapped
-            incoming = float(fields[8])
+            incoming = float(tlen)
             if incoming > 0: # only +ve distances
-                fragment_count += 1
-                # calculate running sd calculation
-                if fragment_count == 1:
-                    fragment_mean = incoming
-                    fragment_std = 0.0
-                else:
-                    old_mean = fragment_mean # old mean
-                    fragment_mean = old_mean + (incoming - old_mean) / fragment_count
-                    fragment_std = fragment_std + (incoming - old_mean) * (incoming - fragment_mean)
-    
+                self.fragments.add(incoming)
+                self.fragment_sizes.add(int(tlen))
         # quality (% of bases above given quality)
-        incoming = [ord(c) - 33 for c in fields[10]]
-        base_count += len(incoming)
-        pass_count += sum([1 if c >= BASE_QUALITY_THRESHOLD else 0 for c in incoming])
+        self.qualities.add(quality)
+
+    def merge(self, other):
+        '''
+            combine with another shard
+        '''
+        self.reads.merge(other.reads)
+        self.fragments.merge(other.fragments)
+        self.qualities.merge(other.qualities)
+        self.read_lengths.merge(other.read_lengths)
+        self.fragment_sizes.merge(other.fragment_sizes)
+
+    def write(self, out):
+        '''
+            write in a form that read_shard can load
+        '''
+        out.write('reads\t{0}\t{1!r}\t{2!r}\n'.format(self.reads.count, self.reads.mean, self.reads.m2))
+        out.write('fragments\t{0}\t{1!r}\t{2!r}\n'.format(self.fragments.count, self.fragments.mean, self.fragments.m2))
+        self.qualities.flush()
+        for quality in sorted(self.qualities.histogram):
+            out.write('quality\t{0}\t{1}\n'.format(quality, self.qualities.histogram[quality]))
+        for cycle, (bases, total) in enumerate(zip(self.qualities.cycle_bases, self.qualities.cycle_totals)):
+            out.write('cycle\t{0}\t{1}\t{2}\n'.format(cycle + 1, bases, total))
+        for size, count in self.read_lengths.items():
+            out.write('read_length\t{0}\t{1}\n'.format(size, count))
+        for size, count in self.fragment_sizes.items():
+            out.write('fragment_size\t{0}\t{1}\n'.format(size, count))
+
+    def result(self, log):
+        '''
+            summary statistics
+        '''
+        # reads
+        if self.reads.count > 1:
+            result = {'read_count': self.reads.count, 'read_mean': self.reads.mean, 'read_sd': self.reads.sd()}
+        else:
+            write_log(log, 'ERROR: no reads found')
+            result = {'read_count': self.reads.count, 'read_mean': 0.0, 'read_sd': 0.0}
+
+        # fragments
+        if self.fragments.count > 1:
+            result.update({'fragment_count': self.fragments.count, 'fragment_mean': self.fragments.mean, 'fragment_sd': self.fragments.sd()})
+        else:
+            write_log(log, 'ERROR: no positive mate distances found')
+            result.update({'fragment_count': self.fragments.count, 'fragment_mean': 0.0, 'fragment_sd': 0.0})
+
+        # base quality
+        result['base_count'] = self.qualities.base_count()
+        result['base_pass'] = self.qualities.bases_at_or_above(BASE_QUALITY_THRESHOLD)
+        result['qualities'] = self.qualities
+
+        # distributions
+        result['read_lengths'] = self.read_lengths
+        result['fragment_sizes'] = self.fragment_sizes
+
+        return result
+
+def read_shard(lines):
+    '''
+        load statistics written by ShardStatistics.write
+    '''
+    stats = ShardStatistics()
+    for line in lines:
+        fields = line.strip('\n').split('\t')
+        if fields[0] == 'reads':
+            stats.reads = RunningStats(int(fields[1]), float(fields[2]), float(fields[3]))
+        elif fields[0] == 'fragments':
+            stats.fragments = RunningStats(int(fields[1]), float(fields[2]), float(fields[3]))
+        elif fields[0] == 'quality':
+            stats.qualities.histogram[int(fields[1])] += int(fields[2])
+        elif fields[0] == 'cycle':
+            stats.qualities.cycle_bases.append(int(fields[2]))
+            stats.qualities.cycle_totals.append(int(fields[3]))
+        elif fields[0] == 'read_length':
+            stats.read_lengths.add(int(fields[1]), int(fields[2]))
+        elif fields[0] == 'fragment_size':
+            stats.fragment_sizes.add(int(fields[1]), int(fields[2]))
+    return stats
+
+def read_bgzf_blocks(bam):
+    '''
+        generate the compressed data of each bgzf block in bam
+    '''
+    while True:
+        header = bam.read(18)
+        if len(header) == 0:
+            break
+        if len(header) < 18 or header[:4] != '\x1f\x8b\x08\x04':
+            raise ValueError('not a bgzf file')
+        extra_length = struct.unpack('<H', header[10:12])[0]
+        block_size = struct.unpack('<H', header[16:18])[0] + 1 # assumes BC is the only extra subfield, as written by samtools
+        if extra_length != 6 or header[12:14] != 'BC':
+            raise ValueError('unexpected bgzf extra field')
+        yield bam.read(block_size - 18)[:-8] # drop crc and size
+
+def inflate(data):
+    '''
+        decompress raw deflate data from a bgzf block
+    '''
+    return zlib.decompress(data, -15)
+
+def read_bgzf(bam, threads=1):
+    '''
+        generate decompressed bgzf data, with batches of blocks decompressed by a pool of threads
+    '''
+    pool = multiprocessing.pool.ThreadPool(threads) if threads > 1 else None
+    batch = []
+    try:
+        for block in read_bgzf_blocks(bam):
+            batch.append(block)
+            if len(batch) == BGZF_BLOCKS:
+                yield ''.join(pool.map(inflate, batch) if pool else [inflate(x) for x in batch])
+                batch = []
+        if len(batch) > 0:
+            yield ''.join(pool.map(inflate, batch) if pool else [inflate(x) for x in batch])
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+def parse_bam_header(data):
+    '''
+        reference names and the length of the bam header at the start of data, or None if data does not hold the whole header
+    '''
+    if len(data) < 12:
+        return None
+    if data[:4] != BAM_MAGIC:
+        raise ValueError('not a bam file')
+    text_length = struct.unpack_from('<i', data, 4)[0]
+    position = 8 + text_length
+    if len(data) < position + 4:
+        return None
+    references = struct.unpack_from('<i', data, position)[0]
+    position += 4
+    names = []
+    for _ in xrange(references):
+        if len(data) < position + 4:
+            return None
+        name_length = struct.unpack_from('<i', data, position)[0]
+        if len(data) < position + 4 + name_length + 4:
+            return None
+        names.append(data[position + 4:position + 4 + name_length - 1])
+        position += 4 + name_length + 4
+    return names, position
 
+def bam_references(bam):
+    '''
+        reference names from the header of a bam file
+    '''
+    data = ''
+    for chunk in read_bgzf(bam):
+        data += chunk
+        header = parse_bam_header(data)
+        if header is not None:
+            return header[0]
+    raise ValueError('truncated bam header')
+
+def bam_record_offsets(bam, threads=1, start=None, reference=None):
+    '''
+        generate (data, offset) for each record of a bam file, where the record starts at offset in data after its block size
+        start is a virtual offset to start reading from instead of the first record
+        reference is the index of the reference to stop after, for reading one reference from a sorted bam
+    '''
+    data = ''
+    offset = 0
+    header_done = start is not None
+    skip = 0
+    if start is not None:
+        bam.seek(start >> 16)
+        skip = start & 0xffff
+    for chunk in read_bgzf(bam, threads):
+        data = data[offset:] + chunk[skip:]
+        offset = 0
+        skip = 0
+        if not header_done:
+            header = parse_bam_header(data)
+            if header is None:
+                continue
+            offset = header[1]
+            header_done = True
+        end = len(data)
+        while offset + 4 <= end:
+            block_size = struct.unpack_from('<i', data, offset)[0]
+            if offset + 4 + block_size > end:
+                break
+            start = offset + 4
+            if reference is not None and struct.unpack_from('<i', data, start)[0] != reference:
+                return
+            yield data, start
+            offset = start + block_size
+    if not header_done or offset != len(data):
+        raise ValueError('truncated bam file')
+
+def record_quality(data, start, name_length, cigar_ops, seq_length):
+    '''
+        read length and sam quality string of the record at start, as sam_records gives them
+    '''
+    qual_start = start + 32 + name_length + 4 * cigar_ops + (seq_length + 1) / 2
+    if seq_length == 0: # sam shows * for both sequence and quality
+        return 1, '*'
+    elif data[qual_start] == '\xff': # sam shows * for missing quality
+        return seq_length, '*'
+    else:
+        return seq_length, data[qual_start:qual_start + seq_length].translate(PHRED_TO_SAM)
+
+def bam_records(bam, threads=1, start=None, reference=None, fraction=None):
+    '''
+        generate (flag, tlen, read length, quality) for each record of a bam file, as sam_records does for sam
+        start and reference are as for bam_record_offsets
+        fraction optionally keeps only that fraction of reads, chosen by keep_read
+    '''
+    for data, start in bam_record_offsets(bam, threads, start, reference):
+        name_length, = struct.unpack_from('<B', data, start + 8)
+        if fraction is not None and not keep_read(data[start + 32:start + 31 + name_length], fraction):
+            continue
+        cigar_ops, flag, seq_length, _, _, tlen = struct.unpack_from('<HHiiii', data, start + 12)
+        length, quality = record_quality(data, start, name_length, cigar_ops, seq_length)
+        yield flag, tlen, length, quality
+
+def bam_alignments(bam, threads=1, start=None, reference=None, fraction=None):
+    '''
+        generate (reference index, 0 based position, length on the reference, flag, tlen, read length, quality) for each record of a bam file
+        the length on the reference includes deletions and skipped regions, and is 0 without a cigar
+        fraction optionally keeps only that fraction of reads, chosen by keep_read
+    '''
+    for data, start in bam_record_offsets(bam, threads, start, reference):
+        ref_id, pos, name_length = struct.unpack_from('<iiB', data, start)
+        if fraction is not None and not keep_read(data[start + 32:start + 31 + name_length], fraction):
+            continue
+        cigar_ops, flag, seq_length, _, _, tlen = struct.unpack_from('<HHiiii', data, start + 12)
+        ref_length = 0
+        if cigar_ops > 0:
+            for op in struct.unpack_from('<{0}I'.format(cigar_ops), data, start + 32 + name_length):
+                if (op & 0xf) in REFERENCE_CIGAR_OPS:
+                    ref_length += op >> 4
+        length, quality = record_quality(data, start, name_length, cigar_ops, seq_length)
+        yield ref_id, pos, ref_length, flag, tlen, length, quality
+
+def read_bai_metadata(bai):
+    '''
+        ((begin, end), (mapped, unmapped)) for each reference from the pseudo bin of a bam index, None for references without reads
+    '''
+    if bai.read(4) != 'BAI\1':
+        raise ValueError('not a bam index')
+    metadata = []
+    for _ in xrange(struct.unpack('<i', bai.read(4))[0]):
+        reference = None
+        for _ in xrange(struct.unpack('<i', bai.read(4))[0]):
+            bin_id, chunks = struct.unpack('<Ii', bai.read(8))
+            data = bai.read(16 * chunks)
+            if bin_id == BAI_PSEUDO_BIN: # the span of the reads on this reference, then mapped and unmapped read counts
+                reference = (struct.unpack('<QQ', data[:16]), struct.unpack('<QQ', data[16:32]))
+        bai.read(8 * struct.unpack('<i', bai.read(4))[0]) # linear index
+        metadata.append(reference)
+    return metadata
+
+def read_bai(bai):
+    '''
+        (begin, end) virtual offsets of the reads on each reference from a bam index, None for references without reads
+    '''
+    return [reference[0] if reference is not None else None for reference in read_bai_metadata(bai)]
+
+def read_bai_counts(bai):
+    '''
+        (mapped, unmapped) read counts of each reference from a bam index, (0, 0) for references without reads
+    '''
+    return [reference[1] if reference is not None else (0, 0) for reference in read_bai_metadata(bai)]
+
+def find_bai(bam):
+    '''
+        index filename for a bam, as file.bam.bai or file.bai
+    '''
+    for candidate in (bam + '.bai', re.sub('\\.bam$', '.bai', bam)):
+        if os.path.exists(candidate):
+            return candidate
+    raise ValueError('no index found for {0}'.format(bam))
+
+def bam_shards(bam, regions=None):
+    '''
+        (name, start, reference) for each reference with reads in a sorted and indexed bam, then UNPLACED for reads with no reference
+        regions optionally restricts the shards to these names
+    '''
+    names = bam_references(open(bam, 'rb'))
+    spans = read_bai(open(find_bai(bam), 'rb'))
+    shards = [(name, span[0], idx) for idx, (name, span) in enumerate(zip(names, spans)) if span is not None]
+    ends = [span[1] for span in spans if span is not None]
+    shards.append((UNPLACED, max(ends) if len(ends) > 0 else None, None))
+    if regions is not None:
+        unknown = set(regions).difference([name for name in names] + [UNPLACED])
+        if len(unknown) > 0:
+            raise ValueError('unknown regions: {0}'.format(', '.join(sorted(unknown))))
+        shards = [shard for shard in shards if shard[0] in regions]
+    return shards
+
+def calculate_shard(task):
+    '''
+        statistics for one shard of a bam, run in a worker process
+    '''
+    bam, name, start, reference, threads, fraction = task
+    stats = ShardStatistics()
+    for record in bam_records(open(bam, 'rb'), threads, start, reference, fraction):
+        stats.add(*record)
+    return name, stats
+
+def calculate_sharded_statistics(bam, regions, workers, threads, log, fraction=None):
+    '''
+        calculate statistics for each reference of bam in a pool of processes and merge them
+    '''
+    shards = bam_shards(bam, regions)
+    write_log(log, 'calculating {0} shards with {1} workers...'.format(len(shards), workers))
+    tasks = [(bam, name, start, reference, threads, fraction) for name, start, reference in shards]
+    result = ShardStatistics()
+    pool = multiprocessing.Pool(workers)
+    try:
+        for name, stats in pool.imap(calculate_shard, tasks):
+            write_log(log, '{0}: {1} reads'.format(name, stats.reads.count))
+            result.merge(stats)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return result
+
+def sam_records(sam, fraction=None):
+    '''
+        generate (flag, tlen, read length, quality) for each line of sam
+        fraction optionally keeps only that fraction of reads, chosen by keep_read
+    '''
+    for line in sam:
+        fields = line.strip('\n').split('\t')
+        if fraction is not None and not keep_read(fields[0], fraction):
+            continue
+        yield int(fields[1]), fields[8], len(fields[9]), fields[10]
+
+def calculate_statistics(sam, log):
+    '''
+        read lines from sam and calculate mean and sd
+    '''
+    return calculate_record_statistics(sam_records(sam), log)
+
+def calculate_record_statistics(records, log):
+    '''
+        calculate mean and sd from (flag, tlen, read length, quality) records
+    '''
+    write_log(log, 'started reading records...')
+    stats = ShardStatistics()
+    for idx, record in enumerate(records):
+        stats.add(*record)
         if idx % 100000 == 0:
-            if fragment_count > 1:
-                write_log(log, 'processed {0} pairs out of {1} lines. {2} ({3})...'.format(fragment_count, idx, fragment_mean, fragment_std / (fragment_count - 1)))
+            if stats.fragments.count > 1:
+                write_log(log, 'processed {0} pairs out of {1} lines. {2} ({3})...'.format(stats.fragments.count, idx, stats.fragments.mean, stats.fragments.m2 / (stats.fragments.count - 1)))
             else:
                 write_log(log, 'processed {0} lines...'.format(idx))
 
-    # done
+    return stats.result(log)
 
-    # reads
-    if read_count > 1:
-        result = {'read_count': read_count, 'read_mean': read_mean, 'read_sd': (read_std / (read_count - 1)) ** 0.5}
-    else:
-        write_log(log, 'ERROR: no reads found')
-        result = {'read_count': read_count, 'read_mean': 0.0, 'read_sd': 0.0}
+def extrapolate_count(count, fraction, unit=1.):
+    '''
+        estimate and confidence interval of a total from the count of a fraction of reads
+        unit is the mean count of each independently chosen group, such as 2 reads for a pair
+    '''
+    estimate = 1. * count / fraction
+    margin = CONFIDENCE_Z * math.sqrt(count * unit * (1. - fraction)) / fraction
+    return estimate, max(count, estimate - margin), estimate + margin
 
-    # fragments
-    if fragment_count > 1:
-        result.update({'fragment_count': fragment_count, 'fragment_mean': fragment_mean, 'fragment_sd': (fragment_std / (fragment_count - 1)) ** 0.5})
+def extrapolate_statistics(stats, fraction):
+    '''
+        statistics of all reads estimated from those of a fraction of the reads, with confidence intervals
+        counts are scaled up, means and proportions are estimated directly from the subsample
+        mates are chosen together, so read counts vary by pairs rather than reads, and base counts by the bases of a pair
+        bases of a read are not independent, so the confidence interval of base_pass_rate uses the number of reads
+    '''
+    result = dict(stats)
+    result['sample_fraction'] = fraction
+    paired = min(1., 2. * stats['fragment_count'] / stats['read_count']) if stats['read_count'] > 0 else 0.
+    read_length = max(1., stats['read_mean'])
+    for key, unit in (('read_count', 1. + paired), ('fragment_count', 1.), ('base_count', (1. + paired) * read_length), ('base_pass', (1. + paired) * read_length)):
+        estimate, low, high = extrapolate_count(stats[key], fraction, unit)
+        result[key] = int(round(estimate))
+        result['{0}_low'.format(key)] = int(math.floor(low))
+        result['{0}_high'.format(key)] = int(math.ceil(high))
+    for name in ('read', 'fragment'):
+        count = stats['{0}_count'.format(name)]
+        margin = CONFIDENCE_Z * stats['{0}_sd'.format(name)] / math.sqrt(count) if count > 1 else 0.
+        result['{0}_mean_low'.format(name)] = stats['{0}_mean'.format(name)] - margin
+        result['{0}_mean_high'.format(name)] = stats['{0}_mean'.format(name)] + margin
+    if stats['base_count'] > 0 and stats['read_count'] > 0:
+        rate = 1. * stats['base_pass'] / stats['base_count']
+        margin = CONFIDENCE_Z * math.sqrt(rate * (1. - rate) / stats['read_count'])
+        result['base_pass_rate_low'] = max(0., rate - margin)
+        result['base_pass_rate_high'] = min(1., rate + margin)
     else:
-        write_log(log, 'ERROR: no positive mate distances found')
-        result.update({'fragment_count': fragment_count, 'fragment_mean': 0.0, 'fragment_sd': 0.0})
-
-    # base quality
-    result['base_count'] = base_count
-    result['base_pass'] = pass_count
-
+        result['base_pass_rate_low'] = result['base_pass_rate_high'] = 0.
     return result
 
-def main(sam, out, log):
+ESTIMATE_KEYS = ('fragment_count_low', 'fragment_count_high', 'fragment_mean_low', 'fragment_mean_high', 'read_count_low', 'read_count_high', 'read_mean_low', 'read_mean_high', 'base_count_low', 'base_count_high', 'base_pass_low', 'base_pass_high', 'base_pass_rate_low', 'base_pass_rate_high')
+
+def write_statistics(stats, out):
     '''
-        calculate fragment stats and write in tab separated format
+        write stats in tab separated format
+        estimates from extrapolate_statistics are followed by the sample fraction and confidence intervals
     '''
-    stats = calculate_statistics(sam, log)
     out.write('fragment_count\t{0}\n'.format(stats['fragment_count']))
     out.write('fragment_mean\t{0}\n'.format(stats['fragment_mean']))
     out.write('fragment_sd\t{0}\n'.format(stats['fragment_sd']))
@@ -127,7 +751,67 @@ def main(sam, out, log):
     out.write('read_sd\t{0}\n'.format(stats['read_sd']))
     out.write('base_count\t{0}\n'.format(stats['base_count']))
     out.write('base_pass\t{0}\n'.format(stats['base_pass']))
+    if 'sample_fraction' in stats:
+        out.write('sample_fraction\t{0}\n'.format(stats['sample_fraction']))
+        for key in ESTIMATE_KEYS:
+            out.write('{0}\t{1}\n'.format(key, stats[key]))
 
-if __name__ == '__main__':
-    main(sys.stdin, sys.stdout, sys.stderr)
+def write_distributions(stats, out):
+    '''
+        write robust fragment size and read length statistics with their histograms in tab separated format
+    '''
+    stats['fragment_sizes'].write(out, 'fragment')
+    stats['read_lengths'].write(out, 'read')
 
+def main(sam, out, log):
+    '''
+        calculate fragment stats and write in tab separated format
+    '''
+    write_statistics(calculate_statistics(sam, log), out)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Calculate fragment, read length and base quality statistics from sam on stdin')
+    parser.add_argument('--bam', required=False, help='read this bam file directly instead of sam')
+    parser.add_argument('--threads', required=False, type=int, default=2, help='threads for decompressing the bam')
+    parser.add_argument('--qualities', required=False, help='write the base quality histogram and mean quality per cycle to this file')
+    parser.add_argument('--workers', required=False, type=int, default=1, help='with --bam, calculate each reference in its own process. needs a sorted and indexed bam')
+    parser.add_argument('--regions', required=False, nargs='+', help='with --bam, only calculate these references ({0} for reads with no reference). needs a sorted and indexed bam'.format(UNPLACED))
+    parser.add_argument('--distributions', required=False, help='write median, mad, percentiles and histogram of fragment size and read length to this file')
+    parser.add_argument('--shard_output', required=False, help='write mergeable statistics to this file, for combining with --merge')
+    parser.add_argument('--sample_fraction', required=False, type=float, help='estimate statistics from this fraction of reads, chosen by read name so that mates stay together')
+    parser.add_argument('--merge', required=False, nargs='+', help='combine files written with --shard_output instead of reading reads')
+    args = parser.parse_args()
+    if args.sample_fraction is not None and not 0 < args.sample_fraction <= 1:
+        parser.error('--sample_fraction must be more than 0 and at most 1')
+    if args.workers > 1 and not args.bam:
+        parser.error('--workers is only used with --bam')
+    if args.regions and not args.bam:
+        parser.error('--regions is only used with --bam')
+    if args.merge:
+        shard = ShardStatistics()
+        for filename in args.merge:
+            shard.merge(read_shard(open(filename, 'r')))
+    elif args.bam and (args.workers > 1 or args.regions):
+        shard = calculate_sharded_statistics(args.bam, args.regions, args.workers, args.threads, sys.stderr, args.sample_fraction)
+    else:
+        shard = ShardStatistics()
+        if args.bam:
+            records = bam_records(open(args.bam, 'rb'), args.threads, fraction=args.sample_fraction)
+        else:
+            records = sam_records(sys.stdin, args.sample_fraction)
+        for record in records:
+            shard.add(*record)
+    if args.shard_output:
+        with open(args.shard_output, 'w') as out:
+            shard.write(out)
+    stats = shard.result(sys.stderr)
+    if args.sample_fraction is not None:
+        stats = extrapolate_statistics(stats, args.sample_fraction)
+    write_statistics(stats, sys.stdout)
+    if args.qualities:
+        with open(args.qualities, 'w') as out:
+            stats['qualities'].write(out)
+    if args.distributions:
+        with open(args.distributions, 'w') as out:
+            write_distributions(stats, out)
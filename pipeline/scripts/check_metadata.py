@@ -26,6 +26,8 @@
 
 import sys
 
+import sample_metadata
+
 is_numeric = set( [ 'dna concentration', 'dna quantity', 'dna quality', 'mean coverage' ] )
 is_enumeration = { 'sex': set( [ 'Male', 'Female', 'Unknown', 'other' ] ), 'sample type': set( [ 'Normal', 'Tumour' ] ), 'consanguinity': set( [ 'No', 'Yes', 'Suspected', 'Unknown' ] ), 'ethnicity': set( [ 'Unknown', 'European', 'African', 'Asian' ] ) }
 is_date = set( [ 'dna_date', 'capture_date', 'sequencing_date' ] )
@@ -46,12 +48,12 @@ def is_valid_date( field ):
   return len(field) == 0 or len(field) == 8 and field.isdigit()
 
 def validate( fh, out, err ):
-  headers = fh.readline().strip().split('\t')
+  metadata = sample_metadata.parse( fh )
+  headers = [ header.strip() for header in metadata.header ]
   idx = -1
   warnings = []
-  for idx, line in enumerate(fh):
+  for idx, fields in enumerate(metadata.rows):
     out.write( "===== Sample {0} =====\n".format( idx ) )
-    fields = line.strip('\n').split('\t')
     for jdx, field in enumerate(fields):
       out.write( "{0:>24}: {1}\n".format( headers[jdx], field ) )
       if field.startswith( ' ' ):
@@ -26,6 +26,8 @@
 import re
 import sys
 
+import sample_metadata
+
 GENELIST_COLUMN = 'Prioritised_Genes'
 
 def correct_column( value ):
@@ -49,25 +51,13 @@ def correct_metadata( src, dest ):
     @src: file like object containing sample metadata
     @dest: file like object to receive corrected sample metadata
   '''
-  first = True
-  target_column = None
-  for line in src:
-    line = line.strip('\n')
-    if first:
-      fields = line.split( '\t' )
-      try:
-        target_column = fields.index( GENELIST_COLUMN )
-      except ValueError:
-        pass
-      first = False
-      dest.write( '%s\n' % line )
-    else:
-      if target_column is None:
-        dest.write( '%s\n' % line )
-      else:
-        fields = line.split( '\t' )
+  metadata = sample_metadata.parse( src )
+  target_column = metadata.column( GENELIST_COLUMN )
+  if target_column is not None:
+    for fields in metadata.rows:
+      if target_column < len( fields ):
         fields[target_column] = correct_column( fields[target_column] )
-        dest.write( '%s\n' % ( '\t'.join( fields ) ) )
+  metadata.write( dest, terminated=True )
 
 if __name__ == '__main__':
   correct_metadata( sys.stdin, sys.stdout )
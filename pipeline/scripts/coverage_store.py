@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+'''
+###########################################################################
+#
+# This file is part of Cpipe.
+#
+# Cpipe is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, under version 3 of the License, subject
+# to additional terms compatible with the GNU General Public License version 3,
+# specified in the LICENSE file that is part of the Cpipe distribution.
+#
+# Cpipe is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cpipe.  If not, see <http:#www.gnu.org/licenses/>.
+#
+###########################################################################
+#
+# Purpose:
+#   Store per base coverage from coverageBed -d as binary depth arrays
+#   that can be memory mapped, so that coverage is parsed once per sample
+#   and count bases by coverage in histograms, as the reports summarize them
+# Usage:
+#   coverage_store.py --convert sample.cov.txt --output sample.cov.store
+#   coverage_store.py --text sample.cov.store > sample.cov.txt
+#   coverage_store.py --gene_medians sample.cov.stats.csv --median sample.cov.stats.median sample.cov.store
+#
+# Format:
+#   header: magic, whether intervals have a gene, offset and length of the index
+#   data: a little endian uint16 or uint32 depth array for each interval, each starting on a 4 byte boundary
+#   index: a line for each interval of chrom, start, end, gene, data offset, bases, array type
+#
+###########################################################################
+'''
+
+import array
+import bisect
+import collections
+import datetime
+import gzip
+import itertools
+import mmap
+import struct
+import sys
+
+MAGIC = 'CPCOV\x01\x00\x00'
+HEADER = '<8sIQQ' # magic, has genes, index offset, index length
+HEADER_SIZE = struct.calcsize(HEADER)
+ALIGN = 4
+HISTOGRAM_CAP = 1000 # coverage above this is counted in a dictionary rather than a list
+
+StoreInterval = collections.namedtuple('StoreInterval', ['chrom', 'start', 'end', 'gene', 'offset', 'length', 'typecode'])
+
+def write_log(log, msg):
+    '''
+        write a date stamped message to log
+    '''
+    now = datetime.datetime.now().strftime('%y%m%d-%H%M%S')
+    if log is not None:
+        log.write('%s: %s\n' % (now, msg))
+
+def is_store(filename):
+    '''
+        check for the coverage store magic number
+    '''
+    with open(filename, 'rb') as handle:
+        return handle.read(len(MAGIC)) == MAGIC
+
+def is_gzipped(filename):
+    '''
+        check for the gzip magic number
+    '''
+    with open(filename, 'rb') as handle:
+        return handle.read(2) == '\x1f\x8b'
+
+def open_coverage(filename):
+    '''
+        coverageBed -d output from a plain or gzipped text file, or a coverage store, which also iterates as lines
+    '''
+    if is_store(filename):
+        return CoverageStore(filename)
+    if is_gzipped(filename):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'r')
+
+def write_depths(out, depths):
+    '''
+        write a depth array in the smallest type that holds it, returning the type
+    '''
+    typecode = 'H' if len(depths) == 0 or max(depths) < 0x10000 else 'I'
+    values = array.array(typecode, depths)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    values.tofile(out)
+    padding = -out.tell() % ALIGN
+    if padding > 0:
+        out.write('\0' * padding)
+    return typecode
+
+def convert(coverage, out, log=None):
+    '''
+        write coverage lines in the format of coverageBed -d as a coverage store to out, a file opened for binary writing
+        lines are chr, start, end, gene, offset, coverage or, without a gene, chr, start, end, offset, coverage
+        consecutive lines of the same interval become one depth array
+    '''
+    out.write(struct.pack(HEADER, MAGIC, 0, 0, 0))
+    index = []
+    has_genes = None
+    current = None
+    depths = array.array('L')
+    for idx, line in enumerate(coverage):
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) < 5:
+            write_log(log, 'skipped line {0}'.format(idx))
+            continue
+        if has_genes is None:
+            has_genes = len(fields) > 5
+        interval = (fields[0], int(fields[1]), int(fields[2]), fields[3] if has_genes else '')
+        if interval != current or int(fields[-2]) <= len(depths): # a new interval, or the same interval repeated
+            if current is not None:
+                index.append((current, out.tell(), len(depths), write_depths(out, depths)))
+            current = interval
+            depths = array.array('L')
+        offset = int(fields[-2])
+        if offset > len(depths) + 1: # bases missing from the input have no coverage
+            depths.extend([0] * (offset - len(depths) - 1))
+        depths.append(int(fields[-1]))
+        if idx % 1000000 == 0:
+            write_log(log, 'converted {0} lines...'.format(idx))
+    if current is not None:
+        index.append((current, out.tell(), len(depths), write_depths(out, depths)))
+    index_offset = out.tell()
+    text = ''.join(['{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\n'.format(chrom, start, end, gene, offset, length, typecode) for (chrom, start, end, gene), offset, length, typecode in index])
+    out.write(text)
+    out.seek(0)
+    out.write(struct.pack(HEADER, MAGIC, 1 if has_genes else 0, index_offset, len(text)))
+    write_log(log, 'converted {0} intervals'.format(len(index)))
+
+class CoverageStore(object):
+    '''
+        read only access to a memory mapped coverage store
+        depth arrays are read from the mapping as needed, so only the requested intervals are copied into memory
+    '''
+    def __init__(self, filename):
+        self.handle = open(filename, 'rb')
+        self.data = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, has_genes, index_offset, index_length = struct.unpack_from(HEADER, self.data, 0)
+        if magic != MAGIC:
+            raise ValueError('{0} is not a coverage store'.format(filename))
+        self.has_genes = has_genes == 1
+        self.intervals = []
+        for line in self.data[index_offset:index_offset + index_length].split('\n'):
+            if line == '':
+                continue
+            chrom, start, end, gene, offset, length, typecode = line.split('\t')
+            self.intervals.append(StoreInterval(chrom, int(start), int(end), gene, int(offset), int(length), typecode))
+        self.genes = collections.defaultdict(list)
+        chroms = collections.defaultdict(list)
+        for interval in self.intervals:
+            self.genes[interval.gene].append(interval)
+            chroms[interval.chrom].append(interval)
+        self.chroms = {}
+        for chrom in chroms:
+            ordered = sorted(chroms[chrom], key=lambda interval: interval.start)
+            self.chroms[chrom] = ([interval.start for interval in ordered], ordered, max([interval.end - interval.start for interval in ordered]))
+
+    def close(self):
+        '''
+            release the mapping
+        '''
+        self.data.close()
+        self.handle.close()
+
+    def depths(self, interval, first=0, last=None):
+        '''
+            depth of the bases of interval from offset first up to last (0 based) as an array
+        '''
+        if last is None or last > interval.length:
+            last = interval.length
+        first = max(0, min(first, last))
+        size = struct.calcsize(interval.typecode)
+        result = array.array(interval.typecode, self.data[interval.offset + first * size:interval.offset + last * size])
+        if sys.byteorder != 'little':
+            result.byteswap()
+        return result
+
+    def depth_at(self, interval, position):
+        '''
+            depth of one base of interval by its 0 based offset, read without copying the array
+        '''
+        return struct.unpack_from('<{0}'.format(interval.typecode), self.data, interval.offset + position * struct.calcsize(interval.typecode))[0]
+
+    def region(self, chrom, start, end):
+        '''
+            (interval, depths) for the bases of each interval overlapping start to end (0 based, half open) on chrom
+        '''
+        if chrom not in self.chroms:
+            return []
+        starts, ordered, longest = self.chroms[chrom]
+        result = []
+        for interval in ordered[bisect.bisect_left(starts, start - longest):bisect.bisect_left(starts, end)]:
+            if interval.end > start:
+                result.append((interval, self.depths(interval, max(start, interval.start) - interval.start, min(end, interval.end) - interval.start)))
+        return result
+
+    def gene(self, gene):
+        '''
+            (interval, depths) for each interval of a gene, in file order
+        '''
+        return [(interval, self.depths(interval)) for interval in self.genes.get(gene, [])]
+
+    def lines(self):
+        '''
+            generate the coverage as the lines of coverageBed -d that it was converted from
+        '''
+        for interval in self.intervals:
+            if self.has_genes:
+                prefix = '{0}\t{1}\t{2}\t{3}'.format(interval.chrom, interval.start, interval.end, interval.gene)
+            else:
+                prefix = '{0}\t{1}\t{2}'.format(interval.chrom, interval.start, interval.end)
+            for offset, depth in enumerate(self.depths(interval)):
+                yield '{0}\t{1}\t{2}\n'.format(prefix, offset + 1, depth)
+
+    def __iter__(self):
+        return self.lines()
+
+class CoverageHistogram(object):
+    '''
+        number of bases at each coverage
+        counts up to HISTOGRAM_CAP are kept in a list that grows as needed, higher coverage in a dictionary,
+        so memory depends on the range of coverage rather than the number of bases
+    '''
+    def __init__(self, items=None):
+        self.counts = []
+        self.overflow = collections.defaultdict(int)
+        if items is not None:
+            for coverage, count in items:
+                self.add(coverage, count)
+
+    def add(self, coverage, count=1):
+        '''
+            count bases with this coverage
+        '''
+        if coverage < len(self.counts):
+            self.counts[coverage] += count
+        elif coverage <= HISTOGRAM_CAP:
+            self.counts.extend([0] * (coverage + 1 - len(self.counts)))
+            self.counts[coverage] += count
+        else:
+            self.overflow[coverage] += count
+
+    def add_values(self, values):
+        '''
+            count each of a sequence of coverage values, such as the depths of a run of bases
+        '''
+        for coverage, group in itertools.groupby(sorted(values)):
+            self.add(coverage, len(list(group)))
+
+    def merge(self, other):
+        '''
+            add the counts of another histogram
+        '''
+        if len(other.counts) > len(self.counts):
+            self.counts.extend([0] * (len(other.counts) - len(self.counts)))
+        for coverage, count in enumerate(other.counts):
+            self.counts[coverage] += count
+        for coverage, count in other.overflow.items():
+            self.overflow[coverage] += count
+
+    def items(self):
+        '''
+            (coverage, bases) sorted by coverage, for coverage with at least one base
+        '''
+        return [(coverage, count) for coverage, count in enumerate(self.counts) if count > 0] + sorted(self.overflow.items())
+
+    def total(self):
+        '''
+            number of bases
+        '''
+        return sum(self.counts) + sum(self.overflow.values())
+
+    def mean(self):
+        '''
+            mean coverage, matching mean() of the values
+        '''
+        total = self.total()
+        if total == 0:
+            return 0
+        return sum([coverage * count for coverage, count in self.items()]) / float(total)
+
+    def minimum(self):
+        '''
+            lowest coverage of any base
+        '''
+        return self.items()[0][0]
+
+    def maximum(self):
+        '''
+            highest coverage of any base
+        '''
+        return self.items()[-1][0]
+
+    def value_at(self, rank):
+        '''
+            the value at position rank (0 based) if all values in the histogram were sorted
+        '''
+        seen = 0
+        for coverage, count in self.items():
+            seen += count
+            if seen > rank:
+                return coverage
+        return None
+
+    def median(self):
+        '''
+            median coverage, matching median() of the values, or 0 with no bases as for mean()
+        '''
+        total = self.total()
+        if total == 0:
+            return 0
+        if total % 2 == 0:
+            high = total / 2
+            return (self.value_at(high) + self.value_at(high - 1)) / 2.
+        else:
+            return self.value_at((total - 1) / 2)
+
+    def above(self, threshold):
+        '''
+            bases with coverage more than threshold
+        '''
+        return sum([count for coverage, count in self.items() if coverage > threshold])
+
+    def mean_stats(self, overall_mean, levels, mean_range):
+        '''
+            percentage of bases within the fraction mean_range of overall_mean, then at or above each of levels
+        '''
+        total = self.total()
+        if total == 0:
+            return [0.] * (len(levels) + 1)
+        mean_stats = [0] * (len(levels) + 1)
+        for coverage, count in self.items():
+            if coverage > overall_mean * (1.0 - mean_range) and coverage < overall_mean * (1.0 + mean_range):
+                mean_stats[0] += count
+            for idx, level in enumerate(levels):
+                if coverage >= level:
+                    mean_stats[idx + 1] += count
+        return [100. * x / total for x in mean_stats]
+
+def format_median(value):
+    '''
+        write medians as R does, without a decimal point for whole numbers
+    '''
+    if value == int(value):
+        return str(int(value))
+    return str(value)
+
+def write_medians(store, gene_out, median_out):
+    '''
+        write the median coverage of each gene as csv and the overall median, as check_coverage calculated them in R
+    '''
+    overall = CoverageHistogram()
+    gene_out.write('Gene,MedianCov\n')
+    for gene in sorted(store.genes):
+        histogram = CoverageHistogram()
+        for interval, depths in store.gene(gene):
+            for depth in depths:
+                histogram.add(depth)
+        gene_out.write('{0},{1}\n'.format(gene, format_median(histogram.median())))
+        overall.merge(histogram)
+    median_out.write('{0}\n'.format(format_median(overall.median())))
+
+def main():
+    '''
+        parse command line and execute
+    '''
+    import argparse
+    parser = argparse.ArgumentParser(description='Convert and read per base coverage stores')
+    parser.add_argument('--convert', required=False, help='coverageBed -d output to convert, plain or gzipped')
+    parser.add_argument('--output', required=False, help='coverage store to write with --convert')
+    parser.add_argument('--text', required=False, help='write this coverage store as coverageBed -d output')
+    parser.add_argument('--gene_medians', required=False, help='write the median coverage of each gene to this csv file')
+    parser.add_argument('--median', required=False, help='write the overall median coverage to this file')
+    parser.add_argument('store', nargs='?', help='coverage store for --gene_medians and --median')
+    args = parser.parse_args()
+    if args.convert:
+        if not args.output:
+            parser.error('--output is required with --convert')
+        with open(args.output, 'wb') as out:
+            convert(open_coverage(args.convert), out, log=sys.stderr)
+    elif args.text:
+        for line in open_coverage(args.text):
+            sys.stdout.write(line)
+    elif args.gene_medians and args.median and args.store:
+        with open(args.gene_medians, 'w') as gene_out:
+            with open(args.median, 'w') as median_out:
+                write_medians(CoverageStore(args.store), gene_out, median_out)
+    else:
+        parser.error('specify --convert, --text or --gene_medians and --median with a store')
+
+if __name__ == '__main__':
+    main()
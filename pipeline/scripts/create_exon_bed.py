@@ -30,176 +30,227 @@
 # boundaries.
 #
 ############################################################################
+import bisect
 import sys, csv, getopt, re,logging as log
 
 log.basicConfig(level=log.INFO)
 
-# Whether to include UTR regions 
-include_utr = True
-
-splice_mode = False
-
-opts,args = getopt.getopt(sys.argv[1:],"cs",)
-for opt,value in opts:
-        if opt == '-c':
-            include_utr = False 
-        elif opt == '-s':
-            splice_mode = True
-        elif opt == '-v':
-            log.basicConfig(level=log.DEBUG)
-
-if not args or len(args)<4:
-        log.info( "\nUsage: python %s [-c] <gene bed file> <hg19 UCSC RefSeq genes file> <transcript file> <output file>\n" % sys.argv[0])
-        log.info( "\t-c   do not include UTR")
-        log.info( "\t-s   write each splice boundary as a separate line instead of whole exons\n")
-        log.info( "\t-v   show debug logging\n")
-        sys.exit(1)
-
-
-# Read all of the transcripts
-tx_file = args[2]
-priority_txes = [ re.sub('\.[0-9]*$', '',line).strip() for line in open(tx_file) ]
-
-log.info( "The prioritised transcripts are %s" % priority_txes)
-
-
 def check_overlap(existing_exons,newexon):            
     """
     Return an overlapping existing exon if the new exon overlaps an existing exon
     """
-    start,end = newexon[0],newexon[1]
     i=0
     for existing in existing_exons:
-        # exact match
-        if newexon == existing:
-           return i
-        # overlaps start point
-        elif start<existing[0] and end > existing[0]:
-            return i
-        # contained within existing
-        elif start>=existing[0] and end <= existing[1]:
-            return i
-        # overlaps end point
-        elif start<=existing[1] and end > existing[1]:
-            return i
-        elif start<=existing[0] and end >= existing[1]:
+        if overlaps(existing, newexon):
             return i
         i+=1
 
     return None
 
+def overlaps(existing, newexon):
+    """
+    Whether the new exon overlaps an existing exon
+    """
+    start,end = newexon[0],newexon[1]
+    # exact match
+    if newexon == existing:
+       return True
+    # overlaps start point
+    elif start<existing[0] and end > existing[0]:
+        return True
+    # contained within existing
+    elif start>=existing[0] and end <= existing[1]:
+        return True
+    # overlaps end point
+    elif start<=existing[1] and end > existing[1]:
+        return True
+    elif start<=existing[0] and end >= existing[1]:
+        return True
+    return False
+
+class GeneExons(object):
+    """
+    The merged exons of a gene, in the order they were added, with their
+    starts kept sorted so that overlapping exons are found without
+    scanning every exon of the gene
+    """
+    def __init__(self):
+        self.exons = [] # [start, end] lists in the order they were added
+        self.starts = [] # sorted (start, index) of exons
+        self.longest = 0 # no exon is longer than this
+
+    def __iter__(self):
+        return iter(self.exons)
+
+    def __len__(self):
+        return len(self.exons)
+
+    def find_overlap(self, newexon):
+        """
+        Index of the first added exon that the new exon overlaps, as check_overlap finds it, or None
+        """
+        low = min(newexon[0], newexon[1]) - self.longest
+        high = max(newexon[0], newexon[1])
+        first = bisect.bisect_left(self.starts, (low,))
+        last = bisect.bisect_right(self.starts, (high, sys.maxint))
+        matches = [i for _, i in self.starts[first:last] if overlaps(self.exons[i], newexon)]
+        if len(matches) == 0:
+            return None
+        return min(matches)
+
+    def add(self, exon):
+        bisect.insort(self.starts, (exon[0], len(self.exons)))
+        self.exons.append(exon)
+        self.longest = max(self.longest, exon[1] - exon[0])
+
+    def update(self, i, start, end):
+        """
+        Change the coordinates of an added exon
+        """
+        exon = self.exons[i]
+        if start != exon[0]:
+            del self.starts[bisect.bisect_left(self.starts, (exon[0], i))]
+            bisect.insort(self.starts, (start, i))
+        exon[0] = start
+        exon[1] = end
+        self.longest = max(self.longest, end - start)
+
+    def first(self):
+        """
+        The exon with the lowest start, the first added of equal starts
+        """
+        return self.exons[self.starts[0][1]]
+
+    def last(self):
+        """
+        The exon with the highest end, the first added of equal ends
+        """
+        return self.exons[max(range(len(self.exons)), key=lambda i: self.exons[i][1])]
+
+def read_priority_transcripts(lines):
+    """
+    Transcript ids without their versions
+    """
+    return [ re.sub('\.[0-9]*$', '',line).strip() for line in lines ]
 
-# Start by reading the genes we are interested in (don't care about
-# coordinates)
-gene_file = csv.reader(open(args[0]), delimiter='\t')
-genes = {}
-gene_ranges = {}
-gene_chr = {}
-for g in gene_file:
-    if not g or g[0].startswith('#'):
-        continue
-    chr,start,stop,gene = g
-    genes[gene] = []
-    gene_chr[gene] = chr
-    if gene in gene_ranges:
-        gene_ranges[gene][0] = min(gene_ranges[gene][0], int(start)-1)
-        gene_ranges[gene][1] = max(gene_ranges[gene][1], int(stop)+1)
-    else:
-        gene_ranges[gene] = [int(start)-1,int(stop)+1]
-
-log.info("Read %d genes from gene file" % len(genes))
+def read_genes(lines):
+    """
+    Read the genes we are interested in (don't care about coordinates)
+    Returns an empty GeneExons for each gene with the chromosome and
+    range of each gene
+    """
+    gene_file = csv.reader(lines, delimiter='\t')
+    genes = {}
+    gene_ranges = {}
+    gene_chr = {}
+    for g in gene_file:
+        if not g or g[0].startswith('#'):
+            continue
+        chr,start,stop,gene = g
+        genes[gene] = GeneExons()
+        gene_chr[gene] = chr
+        if gene in gene_ranges:
+            gene_ranges[gene][0] = min(gene_ranges[gene][0], int(start)-1)
+            gene_ranges[gene][1] = max(gene_ranges[gene][1], int(stop)+1)
+        else:
+            gene_ranges[gene] = [int(start)-1,int(stop)+1]
+    return genes, gene_ranges, gene_chr
 
-cds_starts = {}
-cds_ends = {}
+def merge_exons(existing_exons, exons, gene, gene_range, tx, priority_txes, prioritized_txes):
+    """
+    Merge the exons of transcript tx with the existing exons of gene
+    An exon overlapping an existing exon is replaced by the exon of a
+    prioritized transcript, otherwise extended to the longest sequence
+    unless the gene already has a prioritized transcript
+    """
+    for e in exons:
+        if e[0] > gene_range[1] or e[1] < gene_range[0]:
+            log.debug("Exon %s in gene %s ignored because it is outside range defined for gene: %s" % (e,gene,gene_range))
+            continue
 
-prioritized_txes = { }
+        overlapping = existing_exons.find_overlap(e)
+        if overlapping is not None:
 
-# Now create a hash in memory of exons indexed by gene
-# We are reading the whole hg19 RefSeq gene annotation database into memory here
-ignored_alt_chrs=set()
-refseq_genes = csv.reader(open(args[1]), delimiter='\t')
-for g in refseq_genes:
-    gene = g[12]
+            old_start = existing_exons.exons[overlapping][0]
+            new_start = min(e[0],old_start)
 
-    chr=g[2]
+            old_end = existing_exons.exons[overlapping][1]
+            new_end = max(e[1],old_end)
 
-    # Ignore haploytype chromosomes
-    if re.match('chr.*_.*$', chr):
-        #log.info("Ignoring gene %s on alternative chromosome %s" % (gene,chr))
-        ignored_alt_chrs.add(chr)
-        continue
+            if new_start == old_start and new_end == old_end:
+                continue
 
-    # debug: limit to specific gene
-    # if gene != 'DSP':
-    #  continue
+            if tx in priority_txes:
+                log.info("Exon %s in gene %s has multiple potential splice regions! Selecting prioritized tx=%s : will use %d-%d as coding sequence" % (e,gene,tx,e[0],e[1]))
+                existing_exons.update(overlapping, e[0], e[1])
+                prioritized_txes[gene] = tx
+            elif gene in prioritized_txes:
+                log.info("Exon %s in gene %s has multiple potential splice regions! Not using longest sequence because a prioritized tx (%s) exists vs tx=%s : will use %d-%d as coding sequence" \
+                    % (e,gene,prioritized_txes[gene], tx,new_start,new_end))
+            else:
+                log.info("Exon %s in gene %s has multiple potential splice regions! Current tx=%s Will use %d-%d as longest coding sequence" % (e,gene,tx,new_start,new_end))
+                existing_exons.update(overlapping, new_start, new_end)
+        else:
+            existing_exons.add(e)
 
-    if gene in genes:
+def read_refseq(refseq_genes, genes, gene_ranges, gene_chr, priority_txes):
+    """
+    Merge the exons of each transcript of the genes from rows of the UCSC RefSeq table
+    Returns the CDS start and end of each gene and the alternative chromosomes ignored
+    """
+    cds_starts = {}
+    cds_ends = {}
 
-        # Exon start positions in column 9
-        starts = map(lambda x: int(x), filter(lambda x: x != '', g[9].split(",")))
+    prioritized_txes = { }
+    priority_txes = set(priority_txes)
 
-        # Exon end positions in column 10
-        ends = map(lambda x: int(x), filter(lambda x: x != '', g[10].split(",")))
+    # Now create a hash in memory of exons indexed by gene
+    # We are reading the whole hg19 RefSeq gene annotation database into memory here
+    ignored_alt_chrs=set()
+    for g in refseq_genes:
+        gene = g[12]
 
-        exons = map(lambda x: list(x), zip(starts,ends))
-        #log.info("Found gene %s with transcript %s (%d exons)" % (g[12],g[1],len(exons)))
+        chr=g[2]
 
-        if chr != gene_chr[gene]:
-            log.warning("WARNING: Gene %s is annotated to multiple chromosomes: %s vs %s. The chromosome %s version of this gene will be ignored." % (gene, gene_chr[gene], g[2], chr))
+        # Ignore haploytype chromosomes
+        if re.match('chr.*_.*$', chr):
+            #log.info("Ignoring gene %s on alternative chromosome %s" % (gene,chr))
+            ignored_alt_chrs.add(chr)
             continue
 
-        cds_start = int(g[6])
-        cds_end = int(g[7])
-
-        # Update the index of coding sequence starts / ends
-        # This is to be used later when we adjust exons based on 
-        # UTR inclusion
-        cds_starts[gene] = min(cds_starts.get(gene,sys.maxint),cds_start)
-        cds_ends[gene] = max(cds_ends.get(gene,0),cds_end)
+        if gene in genes:
 
-        #log.info("CDS starts for gene %s are %s" % (str(cds_starts), str(cds_ends)))
+            # Exon start positions in column 9
+            starts = map(lambda x: int(x), filter(lambda x: x != '', g[9].split(",")))
 
-        existing_exons = genes[gene]
+            # Exon end positions in column 10
+            ends = map(lambda x: int(x), filter(lambda x: x != '', g[10].split(",")))
 
-        #print "Existing exons = %s" % existing_exons
-        gene_range = gene_ranges[gene]
+            exons = map(lambda x: list(x), zip(starts,ends))
+            #log.info("Found gene %s with transcript %s (%d exons)" % (g[12],g[1],len(exons)))
 
-        # Merge the exons with existing ones
-        for e in exons:
-            if e[0] > gene_range[1] or e[1] < gene_range[0]:
-                log.debug("Exon %s in gene %s ignored because it is outside range defined for gene: %s" % (e,gene,gene_range))
+            if chr != gene_chr[gene]:
+                log.warning("WARNING: Gene %s is annotated to multiple chromosomes: %s vs %s. The chromosome %s version of this gene will be ignored." % (gene, gene_chr[gene], g[2], chr))
                 continue
 
-            overlapping = check_overlap(existing_exons,e)
-            if overlapping is not None:
-
-                old_start = existing_exons[overlapping][0]
-                new_start = min(e[0],old_start)
-
-                old_end = existing_exons[overlapping][1]
-                new_end = max(e[1],old_end)
-
-                if new_start == old_start and new_end == old_end:
-                    continue
-
-                if g[1] in priority_txes:
-                    log.info("Exon %s in gene %s has multiple potential splice regions! Selecting prioritized tx=%s : will use %d-%d as coding sequence" % (e,gene,g[1],e[0],e[1]))
-                    existing_exons[overlapping][0] = e[0]
-                    existing_exons[overlapping][1] = e[1]
-                    prioritized_txes[gene] = g[1]
-                elif gene in prioritized_txes:
-                    log.info("Exon %s in gene %s has multiple potential splice regions! Not using longest sequence because a prioritized tx (%s) exists vs tx=%s : will use %d-%d as coding sequence" \
-                        % (e,gene,prioritized_txes[gene], g[1],new_start,new_end))
-                else:
-                    log.info("Exon %s in gene %s has multiple potential splice regions! Current tx=%s Will use %d-%d as longest coding sequence" % (e,gene,g[1],new_start,new_end))
-                    existing_exons[overlapping][0] = new_start
-                    existing_exons[overlapping][1] = new_end
-            else:
-                existing_exons.append(e)
+            cds_start = int(g[6])
+            cds_end = int(g[7])
+
+            # Update the index of coding sequence starts / ends
+            # This is to be used later when we adjust exons based on 
+            # UTR inclusion
+            cds_starts[gene] = min(cds_starts.get(gene,sys.maxint),cds_start)
+            cds_ends[gene] = max(cds_ends.get(gene,0),cds_end)
+
+            merge_exons(genes[gene], exons, gene, gene_ranges[gene], g[1], priority_txes, prioritized_txes)
+
+    return cds_starts, cds_ends, ignored_alt_chrs
 
-# Exons include the UTR by default, so if it should not be included,
-# trim the first and last exons 
-if not include_utr:
+def trim_utr(genes, cds_starts, cds_ends):
+    """
+    Exons include the UTR by default, so if it should not be included,
+    trim the first and last exons 
+    """
     for g in genes:
         if g in cds_starts:
             exons = genes[g]
@@ -212,7 +263,7 @@ if not include_utr:
             if len(exons) == 0:
                 log.info("WARNING: no exons overlapped by coordinates for gene %s: " % g)
             else:
-                first_exon = exons[min(range(len(exons)), key=lambda i: exons[i][0])]
+                first_exon = exons.first()
 
                 if first_exon[1] > cds_starts[g]:
                     first_exon[0] = cds_starts[g]
@@ -220,26 +271,70 @@ if not include_utr:
                 # Move the end of the last exon to the end of the CDS
                 # Note that exons are not sorted, so we have to find 
                 # the last exon ...
-                last_exon = exons[max(range(len(exons)), key=lambda i: exons[i][1])]
+                last_exon = exons.last()
                 if last_exon[0] < cds_ends[g]:
                     last_exon[1] = cds_ends[g]
-            
-
-# Write out result bed file
-if args[3] == "-":
-    output = csv.writer(sys.stdout, delimiter='\t', lineterminator='\n')
-else:
-    output = csv.writer(open(args[3],'wb'), delimiter='\t', lineterminator='\n')
-for g in genes:
-    exon_count = 0
-    for e in genes[g]:
-        exon_count += 1
-        # print ','.join(map(lambda x: str(x), [ gene_chr[g], e[0], e[1], "%s|%d" % (g, exon_count)])) 
-        if splice_mode:
-            output.writerow( [ gene_chr[g], e[0], e[0]+1, "%s|%d|start" % (g, exon_count)] )
-            output.writerow( [ gene_chr[g], e[1], e[1]+1, "%s|%d|end" % (g, exon_count)] )
-        else:
-            output.writerow( [ gene_chr[g], e[0], e[1], "%s|%d" % (g, exon_count)] )
 
-if len(ignored_alt_chrs)>0:
-    log.info("WARNING: genes on the following alternative haplotype chromosomes were ignored: %s" % ignored_alt_chrs)
+def write_bed(genes, gene_chr, out, splice_mode=False):
+    """
+    Write the exons of each gene, numbered in the order they were added
+    """
+    output = csv.writer(out, delimiter='\t', lineterminator='\n')
+    for g in genes:
+        exon_count = 0
+        for e in genes[g]:
+            exon_count += 1
+            if splice_mode:
+                output.writerow( [ gene_chr[g], e[0], e[0]+1, "%s|%d|start" % (g, exon_count)] )
+                output.writerow( [ gene_chr[g], e[1], e[1]+1, "%s|%d|end" % (g, exon_count)] )
+            else:
+                output.writerow( [ gene_chr[g], e[0], e[1], "%s|%d" % (g, exon_count)] )
+
+def main():
+    # Whether to include UTR regions 
+    include_utr = True
+
+    splice_mode = False
+
+    opts,args = getopt.getopt(sys.argv[1:],"cs",)
+    for opt,value in opts:
+            if opt == '-c':
+                include_utr = False 
+            elif opt == '-s':
+                splice_mode = True
+            elif opt == '-v':
+                log.basicConfig(level=log.DEBUG)
+
+    if not args or len(args)<4:
+            log.info( "\nUsage: python %s [-c] <gene bed file> <hg19 UCSC RefSeq genes file> <transcript file> <output file>\n" % sys.argv[0])
+            log.info( "\t-c   do not include UTR")
+            log.info( "\t-s   write each splice boundary as a separate line instead of whole exons\n")
+            log.info( "\t-v   show debug logging\n")
+            sys.exit(1)
+
+    # Read all of the transcripts
+    priority_txes = read_priority_transcripts(open(args[2]))
+
+    log.info( "The prioritised transcripts are %s" % priority_txes)
+
+    genes, gene_ranges, gene_chr = read_genes(open(args[0]))
+
+    log.info("Read %d genes from gene file" % len(genes))
+
+    cds_starts, cds_ends, ignored_alt_chrs = read_refseq(csv.reader(open(args[1]), delimiter='\t'), genes, gene_ranges, gene_chr, priority_txes)
+
+    if not include_utr:
+        trim_utr(genes, cds_starts, cds_ends)
+
+    # Write out result bed file
+    if args[3] == "-":
+        write_bed(genes, gene_chr, sys.stdout, splice_mode)
+    else:
+        with open(args[3],'wb') as out:
+            write_bed(genes, gene_chr, out, splice_mode)
+
+    if len(ignored_alt_chrs)>0:
+        log.info("WARNING: genes on the following alternative haplotype chromosomes were ignored: %s" % ignored_alt_chrs)
+
+if __name__ == '__main__':
+    main()
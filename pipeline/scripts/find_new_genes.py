@@ -22,7 +22,7 @@
 # Purpose:
 #   Given a gene list and reference bed file, generate a bed file with just those genes
 # Usage:
-#   find_new_genes --reference reference_bed --exclude exclude --target target_dir < sample_file
+#   find_new_genes --reference reference_bed --exclude exclude --target target_dir [--meta sample_file] < sample_file
 ####################################################################################
 
 import argparse
@@ -31,9 +31,12 @@ import os
 import re
 import sys
 
+import sample_metadata
+
 def generate_new_genes( sample_lines, log, reference_genes, excluded_genes, reference_source, excluded_source ):
   '''
     given samples, make files of the form CS.extra.genes.txt and CS.extra.excluded.genes.txt
+    sample_lines are the lines of the metadata file, or an already parsed sample_metadata.Metadata
   '''
   # get list of reference genes
   reference = set()
@@ -50,23 +53,23 @@ def generate_new_genes( sample_lines, log, reference_genes, excluded_genes, refe
   log.write( '{0} available reference genes found in {1}, {2} excluded genes found in {3}: {4}\n'.format( len(reference), reference_source, len(excluded), excluded_source, ' '.join( sorted( list( excluded ) ) ) ) )
 
   # parse sample
-  headers = {}
-  for idx, title in enumerate(sample_lines[0].split('\t')):
-    headers[title] = idx
+  if isinstance( sample_lines, sample_metadata.Metadata ):
+    metadata = sample_lines
+  else:
+    metadata = sample_metadata.parse( sample_lines )
 
-  if 'Cohort' not in headers:
+  if metadata.column( 'Cohort' ) is None:
     log.write( 'ERROR: Cohort not in sample header\n' )     
     return 1
-  if 'Prioritised_Genes' not in headers:
+  if metadata.column( 'Prioritised_Genes' ) is None:
     log.write( 'ERROR: Prioritised_Genes not in sample header\n' )     
     return 1
   
   result = {}
-  for line in sample_lines[1:]: # each sample
-    fields = line.split('\t')
-    cohort = fields[headers['Cohort']]
-    genes = fields[headers['Prioritised_Genes']]
-    sample_id = fields[headers['Sample_ID']]
+  for fields in metadata.rows: # each sample
+    cohort = metadata.get( fields, 'Cohort' )
+    genes = metadata.get( fields, 'Prioritised_Genes' )
+    sample_id = metadata.get( fields, 'Sample_ID' )
     addonce_target = 'addonce.{0}'.format( sample_id )
     if cohort != '':
       if cohort not in result:
@@ -102,8 +105,12 @@ if __name__ == '__main__':
   parser.add_argument('--reference', required=True, help='reference bed file') # input
   parser.add_argument('--exclude', required=True, help='file containing genes to exclude') # input
   parser.add_argument('--target', required=True, help='target directory')
+  parser.add_argument('--meta', required=False, help='sample metadata file, read from stdin if not given')
   args = parser.parse_args()
-  samples = sys.stdin.readlines()
+  if args.meta:
+    samples = sample_metadata.load( args.meta, log=sys.stderr )
+  else:
+    samples = sys.stdin.readlines()
   additions = generate_new_genes( samples, sys.stderr, open(args.reference, 'r'), open(args.exclude, 'r'), os.path.basename(args.reference), os.path.basename(args.exclude) )
   write_genes( additions, args.target, sys.stderr, dummy=False )
 
@@ -28,223 +28,218 @@
 ###########################################################################
 '''
 
+import array
+import bisect
 import collections
 import datetime
+import itertools
 import math
+import multiprocessing
 import os
+import StringIO
 import sys
 
-# interval matching from https://bitbucket.org/james_taylor/bx-python/raw/ebf9a4b352d3/lib/bx/intervals/operations/quicksect.py
-import random
+import coverage_store
+import gene_coverage
 
-class IntervalTree(object):
+# coverage is read in blocks of about this many bytes, or this many lines
+BLOCK_SIZE = 4 * 1024 * 1024
+BLOCK_LINES = 100000
+
+IndexedInterval = collections.namedtuple('IndexedInterval', ['start', 'end', 'linenum', 'other'])
+
+class ChromIntervals(object):
     '''
-         fast interval finder
+        sorted, array backed intervals for a single chromosome
+        intervals are kept sorted by start, with equal starts ordered most recently inserted first.
+        maxends[i] is the largest end of intervals 0..i, which bounds overlap searches.
+        by_end holds the indices of the intervals ordered by end then index, and sorted_ends their ends.
     '''
     def __init__(self):
+        self.pending = []
+        self.starts = array.array('l')
+        self.ends = array.array('l')
+        self.maxends = array.array('l')
+        self.by_end = array.array('l')
+        self.sorted_ends = array.array('l')
+        self.items = []
+
+    def insert(self, start, end, linenum=0, other=None):
         '''
-            dictionary of intervals
+            add an interval, the index is rebuilt on the next query
         '''
-        self.chroms = {}
+        self.pending.append(IndexedInterval(start, end, linenum, other))
 
-    def insert(self, interval, linenum=0, other=None):
+    def build(self):
         '''
-            add a new interval
+            sort pending intervals into the arrays
         '''
-        chrom = interval.chrom
-        start = interval.start
-        end = interval.end
-        if interval.chrom in self.chroms:
-            self.chroms[chrom] = self.chroms[chrom].insert(start, end, linenum, other)
-        else:
-            self.chroms[chrom] = IntervalNode(start, end, linenum, other)
-
-    def intersect(self, interval, report_func):
+        if not self.pending:
+            return
+        # sort is stable, so reversing first puts later insertions first among equal starts
+        items = self.items + list(reversed(self.pending))
+        items.sort(key=lambda item: item.start)
+        self.pending = []
+        self.items = items
+        self.starts = array.array('l', [item.start for item in items])
+        self.ends = array.array('l', [item.end for item in items])
+        self.maxends = array.array('l')
+        current = None
+        for item in items:
+            if current is None or item.end > current:
+                current = item.end
+            self.maxends.append(current)
+        self.by_end = array.array('l', sorted(xrange(len(items)), key=lambda i: (self.ends[i], i)))
+        self.sorted_ends = array.array('l', [self.ends[i] for i in self.by_end])
+
+    def __len__(self):
+        return len(self.items) + len(self.pending)
+
+    def intersect(self, start, end):
         '''
-            add a new interval
+            return intervals overlapping [start, end), ordered by start
         '''
-        chrom = interval.chrom
-        start = interval.start
-        end = interval.end
-        if chrom in self.chroms:
-            self.chroms[chrom].intersect(start, end, report_func)
+        self.build()
+        last = bisect.bisect_left(self.starts, end) # intervals from here start at or after end
+        first = bisect.bisect_right(self.maxends, start) # intervals before here all end at or before start
+        return [self.items[i] for i in xrange(first, last) if self.ends[i] > start]
 
-    def traverse(self, func):
+    def nearest(self, start, end):
         '''
-            iterate over all intervals
+            find the closest interval to [start, end) that does not overlap it
+            returns (interval, distance) or (None, None) if there are no intervals.
+            ties go to the earlier interval in start order, and the first interval is always a candidate.
         '''
-        for item in self.chroms.itervalues():
-            item.traverse(func)
-
-class IntervalNode(object):
+        self.build()
+        if not self.items:
+            return None, None
+
+        # the first interval is always a candidate, as with a full traversal
+        best = 0
+        if self.starts[0] > end:
+            best_distance = self.starts[0] - end
+        else:
+            best_distance = start - self.ends[0]
+
+        # upstream: intervals starting before end, none of which overlap, so all end at or before start
+        upstream = bisect.bisect_left(self.starts, end)
+        if upstream > 0:
+            if self.maxends[upstream - 1] < start:
+                candidate = bisect.bisect_left(self.maxends, self.maxends[upstream - 1], 0, upstream)
+            else: # an adjacent interval ends exactly at start, so take the first of the intervals with the latest end before start
+                # intervals from upstream on start at or after end, so only upstream intervals can end before start
+                candidate = None
+                before = bisect.bisect_left(self.sorted_ends, start)
+                if before > 0:
+                    candidate = self.by_end[bisect.bisect_left(self.sorted_ends, self.sorted_ends[before - 1])]
+            if candidate is not None and start - self.ends[candidate] < best_distance:
+                best = candidate
+                best_distance = start - self.ends[candidate]
+
+        # downstream: first interval starting after end
+        downstream = bisect.bisect_right(self.starts, end)
+        if downstream < len(self.items) and self.starts[downstream] - end < best_distance:
+            best = downstream
+            best_distance = self.starts[downstream] - end
+
+        return self.items[best], best_distance
+
+class IntervalIndex(object):
     '''
-        an interval in a tree
+         fast interval finder, one sorted set of intervals per chromosome
     '''
-
-    def __init__(self, start, end, linenum=0, other=None):
+    def __init__(self):
         '''
-        Python lacks the binomial distribution, so we convert a
-        uniform into a binomial because it naturally scales with
-        tree size.  Also, python's uniform is perfect since the
-        upper limit is not inclusive, which gives us undefined here.
+            dictionary of intervals
         '''
-        self.priority = math.ceil((-1.0 / math.log(.5))* math.log(-1.0 / (random.uniform(0, 1)- 1)))
-        self.start = start
-        self.end = end
-        self.maxend = self.end
-        self.minend = self.end
-        self.left = None
-        self.right = None
-        self.linenum = linenum
-        self.other = other
+        self.chroms = {}
 
-    def insert(self, start, end, linenum=0, other=None):
-        '''
-            add an interval to the tree
-        '''
-        root = self
-        if start > self.start:
-            # insert to right tree
-            if self.right:
-                self.right = self.right.insert(start, end, linenum, other)
-            else:
-                self.right = IntervalNode(start, end, linenum, other)
-            # rebalance tree
-            if self.priority < self.right.priority:
-                root = self.rotateleft()
-        else:
-            # insert to left tree
-            if self.left:
-                self.left = self.left.insert(start, end, linenum, other)
-            else:
-                self.left = IntervalNode(start, end, linenum, other)
-            # rebalance tree
-            if self.priority < self.left.priority:
-                root = self.rotateright()
-        if root.right and root.left:
-            root.maxend = max(root.end, root.right.maxend, root.left.maxend)
-            root.minend = min(root.end, root.right.minend, root.left.minend)
-        elif root.right:
-            root.maxend = max(root.end, root.right.maxend)
-            root.minend = min(root.end, root.right.minend)
-        elif root.left:
-            root.maxend = max(root.end, root.left.maxend)
-            root.minend = min(root.end, root.left.minend)
-        return root
-
-    def rotateright(self):
+    def insert(self, interval, linenum=0, other=None):
         '''
-            rearrange tree
+            add a new interval
         '''
-        root = self.left
-        self.left = self.left.right
-        root.right = self
-        if self.right and self.left:
-            self.maxend = max(self.end, self.right.maxend, self.left.maxend)
-            self.minend = min(self.end, self.right.minend, self.left.minend)
-        elif self.right:
-            self.maxend = max(self.end, self.right.maxend)
-            self.minend = min(self.end, self.right.minend)
-        elif self.left:
-            self.maxend = max(self.end, self.left.maxend)
-            self.minend = min(self.end, self.left.minend)
-        return root
-
-    def rotateleft(self):
+        if interval.chrom not in self.chroms:
+            self.chroms[interval.chrom] = ChromIntervals()
+        self.chroms[interval.chrom].insert(interval.start, interval.end, linenum, other)
+
+    def intersect(self, interval):
         '''
-            rearrange tree
+            list of intervals overlapping interval
         '''
-        root = self.right
-        self.right = self.right.left
-        root.left = self
-        if self.right and self.left:
-            self.maxend = max(self.end, self.right.maxend, self.left.maxend)
-            self.minend = min(self.end, self.right.minend, self.left.minend)
-        elif self.right:
-            self.maxend = max(self.end, self.right.maxend)
-            self.minend = min(self.end, self.right.minend)
-        elif self.left:
-            self.maxend = max(self.end, self.left.maxend)
-            self.minend = min(self.end, self.left.minend)
-        return root
-
-    def intersect(self, start, end, report_func):
+        if interval.chrom in self.chroms:
+            return self.chroms[interval.chrom].intersect(interval.start, interval.end)
+        return []
+
+    def nearest(self, interval):
         '''
-            find intersection
+            closest non-overlapping interval and its distance
         '''
-        if start < self.end and end > self.start:
-            report_func(self)
-        if self.left and start < self.left.maxend:
-            self.left.intersect(start, end, report_func)
-        if self.right and end > self.start:
-            self.right.intersect(start, end, report_func)
-
-    def traverse(self, func):
+        if interval.chrom in self.chroms:
+            return self.chroms[interval.chrom].nearest(interval.start, interval.end)
+        return None, None
+
+    def build(self):
         '''
-            find all
+            sort all pending intervals
         '''
-        if self.left:
-            self.left.traverse(func)
-        func(self)
-        if self.right:
-            self.right.traverse(func)
+        for item in self.chroms.itervalues():
+            item.build()
 
-def traversal_handler_builder(start, end):
+class TranscriptCoordinates(object):
     '''
-        helper to traverse all
+        maps genomic positions to coding sequence positions for one transcript
+        exons are the coding parts of each exon in genomic order, with offsets[i] the number of coding bases before exon i
     '''
-    data = [None, 3e9]
-    def traversal_handler(interval):
+    def __init__(self, strand, exons):
+        self.strand = strand
+        self.starts = array.array('l', [start for start, _ in exons])
+        self.ends = array.array('l', [end for _, end in exons])
+        self.offsets = array.array('l')
+        total = 0
+        for start, end in exons:
+            self.offsets.append(total)
+            total += end - start
+        self.length = total
+
+    def cds_position(self, position):
         '''
-            closure for traversal
+            1 based position in the coding sequence of the 0 based genomic position, or None if it is not coding
         '''
-        if data[0] is None:
-            data[0] = interval
-            if interval.start > end:
-                data[1] = interval.start - end
-            else:
-                data[1] = start - interval.end
-        elif interval.start > end and interval.start - end < data[1]:
-            data[0] = interval
-            data[1] = interval.start - end
-        elif start > interval.end and start - interval.end < data[1]:
-            data[0] = interval
-            data[1] = start - interval.end
-    return data, traversal_handler
+        idx = bisect.bisect_right(self.starts, position) - 1
+        if idx < 0 or position >= self.ends[idx]:
+            return None
+        offset = self.offsets[idx] + position - self.starts[idx]
+        if self.strand == '-':
+            return self.length - offset
+        return offset + 1
+
+    def codon_position(self, position):
+        '''
+            1 based codon of the 0 based genomic position, or None if it is not coding
+        '''
+        cds = self.cds_position(position)
+        if cds is None:
+            return None
+        return int(math.ceil(cds / 3.0))
 
 def annotate_gap(gap, data_source, log):
     '''
         given a gap, annotate it
     '''
     # find overlapping cds interval, or nearest
-    target = []
     if gap['chr'] in data_source['cds'].chroms:
         start_pos = gap['start'] + gap['start_offset'] - 1
         end = start_pos + gap['length']
-        data_source['cds'].chroms[gap['chr']].intersect(start_pos, end, lambda x: target.append(x))# find overlap
+        target = data_source['cds'].chroms[gap['chr']].intersect(start_pos, end) # find overlap
         if len(target) == 0: # no overlap
-            # find closest by traversing the entire tree
-            result, handler = traversal_handler_builder(start_pos, end)
-            data_source['cds'].chroms[gap['chr']].traverse(handler)
-            return {'interval': result[0], 'distance': result[1]}
+            # find closest
+            interval, distance = data_source['cds'].chroms[gap['chr']].nearest(start_pos, end)
+            return {'interval': interval, 'distance': distance}
         else: # overlap found
-            if len(target) > 1:
-                #write_log(log, "annotate_gap: {0} overlaps found for {1}".format(len(target), gap['start']))
-                pass
-            #write_log(log, "annotate_gap: {0} {1} {2}".format(target[0].start, target[0].end, target[0].end - target[0].start))# debug
-
-            # intersect the gap with the coding region
-            #for i in xrange(0, len(target)):
-            #    intersect = find_intersect(target[i].start, target[i].end, start_pos, end)
-            #    write_log(log, '{0}. intersect {1} gap {2}->{3} cds {4}->{5}'.format(i, intersect, start_pos, end, target[i].start, target[i].end))
-
-            # what is the intersection relative to the coding region?
+            # what is the intersection relative to the coding sequence of the transcript?
             intersect = find_intersect(target[0].start, target[0].end, start_pos, end)
-            coding_intersect = [intersect[0] - target[0].start + 1, intersect[1] - target[0].start] # start=1 based, end=inclusive
-            #if target[0].other['strand'] == '+': # count from start
-            #    coding_intersect = [x - target[0].start for x in intersect]
-            #else: # count from end
-            #    coding_intersect = [target[0].end - x for x in intersect]
+            transcript = target[0].other['transcript']
+            coding_intersect = sorted([transcript.cds_position(intersect[0]), transcript.cds_position(intersect[1] - 1)]) # start=1 based, end=inclusive
             codon_positions = [int(math.ceil(x / 3.0)) for x in coding_intersect]
 
             # determine exon rank
@@ -253,7 +248,6 @@ def annotate_gap(gap, data_source, log):
             else:
                 exon_rank = target[0].other['count'] - target[0].other['number'] + 1
 
-            #write_log(log, "annotate_gap: coding region intersect: {0} codons: {1}".format(coding_intersect, codon_positions))
             return {'interval': target[0], 'distance': 0, 'coding_intersect': coding_intersect, 'codon_positions': codon_positions, 'rank': exon_rank}
     else:
         return None # unexpected chromosome
@@ -273,70 +267,308 @@ def run(cmd, log):
     write_log(log, 'executing {0}\n'.format(cmd))
     os.system(cmd)
 
-def median(items):
+def write_header(target):
     '''
-      return the median of a list of items
+      write the column names of the gap report
     '''
-    sorted_list = sorted(items)
-    if len(items)% 2 == 0:
-        high = len(items)/ 2
-        return (sorted_list[high] + sorted_list[high-1])/ 2.
-    else:
-        mid = (len(items)- 1)/ 2
-        return sorted_list[mid]
+    target.write('{0},{1},{2},{3},{4},{5},{6},{7},{8},{9},{10},{11},{12},{13},{14},{15},{16}\n'.format('Chr', 'Gene', 'Start', 'End', 'Min Cov', 'Max Cov', 'Median Cov', 'Width', 'Tx Name', 'Strand', 'CDS Distance', 'CDS Overlap Start', 'CDS Overlap End', 'AA Overlap Start', 'AA Overlap End', 'Exon Number', 'Exon Rank'))
 
-def write_gap(gap, target, data_source, log):
+def format_gap(gap, annotation):
     '''
-      write out the found gap
+      the report line for an annotated gap
     '''
     # note that start and end are inclusive
-    annotation = annotate_gap(gap, data_source, log)
     if annotation is None: # shouldn't happen unless things are really wrong
-        target.write('{0},{1},{2},{3},{4},{5},{6},{7},{8},{9},{10},{11},{12},{13},{14},{15},{16}\n'.format(gap['chr'], gap['gene'], gap['start'] + gap['start_offset'] - 1, gap['start'] + gap['start_offset'] + gap['length'] - 1 - 1, min(gap['coverage']), max(gap['coverage']), median(gap['coverage']), gap['length'], 'N/A', 'N/A', 'N/A', 'N/A', 'N/A', 'N/A', 'N/A', 'N/A', 'N/A'))
+        return '{0},{1},{2},{3},{4},{5},{6},{7},{8},{9},{10},{11},{12},{13},{14},{15},{16}\n'.format(gap['chr'], gap['gene'], gap['start'] + gap['start_offset'] - 1, gap['start'] + gap['start_offset'] + gap['length'] - 1 - 1, gap['coverage'].minimum(), gap['coverage'].maximum(), gap['coverage'].median(), gap['length'], 'N/A', 'N/A', 'N/A', 'N/A', 'N/A', 'N/A', 'N/A', 'N/A', 'N/A')
     elif annotation['distance'] == 0: # gap overlapping coding sequence
-        target.write('{0},{1},{2},{3},{4},{5},{6},{7},{8},{9},{10},{11},{12},{13},{14},{15},{16}\n'.format(gap['chr'], gap['gene'], gap['start'] + gap['start_offset'] - 1, gap['start'] + gap['start_offset'] + gap['length'] - 1 - 1, min(gap['coverage']), max(gap['coverage']), median(gap['coverage']), gap['length'], annotation['interval'].other['name'], annotation['interval'].other['strand'], annotation['distance'], annotation['coding_intersect'][0], annotation['coding_intersect'][1], annotation['codon_positions'][0], annotation['codon_positions'][1], annotation['interval'].other['number'], annotation['rank']))
+        return '{0},{1},{2},{3},{4},{5},{6},{7},{8},{9},{10},{11},{12},{13},{14},{15},{16}\n'.format(gap['chr'], gap['gene'], gap['start'] + gap['start_offset'] - 1, gap['start'] + gap['start_offset'] + gap['length'] - 1 - 1, gap['coverage'].minimum(), gap['coverage'].maximum(), gap['coverage'].median(), gap['length'], annotation['interval'].other['name'], annotation['interval'].other['strand'], annotation['distance'], annotation['coding_intersect'][0], annotation['coding_intersect'][1], annotation['codon_positions'][0], annotation['codon_positions'][1], annotation['interval'].other['number'], annotation['rank'])
     else: # nearest distance
-        target.write('{0},{1},{2},{3},{4},{5},{6},{7},{8},{9},{10},{11},{12},{13},{14},{15},{16}\n'.format(gap['chr'], gap['gene'], gap['start'] + gap['start_offset'] - 1, gap['start'] + gap['start_offset'] + gap['length'] - 1 - 1, min(gap['coverage']), max(gap['coverage']), median(gap['coverage']), gap['length'], annotation['interval'].other['name'], annotation['interval'].other['strand'], annotation['distance'], 'N/A', 'N/A', 'N/A', 'N/A', annotation['interval'].other['number'], 'N/A'))
+        return '{0},{1},{2},{3},{4},{5},{6},{7},{8},{9},{10},{11},{12},{13},{14},{15},{16}\n'.format(gap['chr'], gap['gene'], gap['start'] + gap['start_offset'] - 1, gap['start'] + gap['start_offset'] + gap['length'] - 1 - 1, gap['coverage'].minimum(), gap['coverage'].maximum(), gap['coverage'].median(), gap['length'], annotation['interval'].other['name'], annotation['interval'].other['strand'], annotation['distance'], 'N/A', 'N/A', 'N/A', 'N/A', annotation['interval'].other['number'], 'N/A')
 
-def find_gaps(coverage, min_width, max_coverage, target, data_source, log):
+def write_gap(gap, target, data_source, log):
     '''
-        find gaps and annotate
+      write out the found gap
     '''
-    target.write('{0},{1},{2},{3},{4},{5},{6},{7},{8},{9},{10},{11},{12},{13},{14},{15},{16}\n'.format('Chr', 'Gene', 'Start', 'End', 'Min Cov', 'Max Cov', 'Median Cov', 'Width', 'Tx Name', 'Strand', 'CDS Distance', 'CDS Overlap Start', 'CDS Overlap End', 'AA Overlap Start', 'AA Overlap End', 'Exon Number', 'Exon Rank'))
-    current = None
-    gaps = 0
-    idx = 0
-    write_log(log, 'finding gaps...')
-    for idx, line in enumerate(coverage):
-        fields = line.strip('\n').split('\t')# tab separated: chr, start, end, gene, offset, coverage
+    target.write(format_gap(gap, annotate_gap(gap, data_source, log)))
+
+def coverage_blocks(coverage, block_size=BLOCK_SIZE):
+    '''
+        read coverage lines in blocks of about block_size bytes
+        files are read a block at a time and split into lines in one call, so lines from files have no newline
+    '''
+    if hasattr(coverage, 'read'):
+        remainder = ''
+        while True:
+            text = coverage.read(block_size)
+            if not text:
+                break
+            lines = (remainder + text).split('\n')
+            remainder = lines.pop() # incomplete until the next block
+            if len(lines) > 0:
+                yield lines
+        if remainder != '':
+            yield [remainder]
+    else: # any iterable of lines
+        block = []
+        for line in coverage:
+            block.append(line)
+            if len(block) >= BLOCK_LINES:
+                yield block
+                block = []
+        if len(block) > 0:
+            yield block
+
+def find_gap_runs(coverage, min_width, max_coverage, log, block_size=BLOCK_SIZE):
+    '''
+        generate runs of low coverage at least min_width long
+    '''
+    for _, gap in find_threshold_gap_runs(coverage, min_width, [max_coverage], log, block_size):
+        yield gap
+
+def parse_coverage_block(lines, first, log):
+    '''
+        columns of the valid lines of a block of coverage lines (chr, start, end, gene, offset, coverage)
+        returns lists of chr, start, gene and offset strings and an array of coverage
+        lines without a coverage, and headers, are logged by their line number counting from first
+    '''
+    if all([line.count('\t') == 5 for line in lines]): # split the whole block at once
+        fields = '\t'.join(lines).replace('\n', '').split('\t')
+        chrs = fields[0::6]
+        if 'chr' not in [chrom.lower() for chrom in set(chrs)]: # no header
+            return chrs, fields[1::6], fields[3::6], fields[4::6], array.array('l', [int(depth) for depth in fields[5::6]])
+    chrs, starts, genes, offsets, depths = [], [], [], [], array.array('l')
+    for idx, line in enumerate(lines):
+        fields = line.strip('\n').split('\t')
         if len(fields) > 5 and fields[0].lower() != 'chr':
-            coverage = int(fields[5])
-            if current is None: # not in gap
-                if max_coverage == -1 or coverage <= max_coverage: # start a new gap
-                    current = {'start': int(fields[1]), 'start_offset': int(fields[4]), 'length': 1, 'chr': fields[0], 'gene': fields[3], 'coverage': [coverage]}
-            else: # in gap
-                if fields[0] == current['chr'] and int(fields[1]) == current['start'] and fields[3] == current['gene'] and (max_coverage == -1 or coverage <= max_coverage): # continue gap
-                    current['length'] += 1
-                    current['coverage'].append(coverage)
-                else: # end of gap
-                    if current['length'] >= min_width: # write it out
-                        write_gap(current, target, data_source, log)
-                        gaps += 1
-                    if max_coverage == -1 or coverage <= max_coverage: # start a new gap?
-                        current = {'start': int(fields[1]), 'start_offset': int(fields[4]), 'length': 1, 'chr': fields[0], 'gene': fields[3], 'coverage': [coverage]}
-                    else:
-                        current = None
+            chrs.append(fields[0])
+            starts.append(fields[1])
+            genes.append(fields[3])
+            offsets.append(fields[4])
+            depths.append(int(fields[5]))
         else:
-            write_log(log, 'skipped line {0}'.format(idx))
+            write_log(log, 'skipped line {0}'.format(first + idx))
+    return chrs, starts, genes, offsets, depths
 
-        if idx % 100000 == 0:
-            write_log(log, 'finding gaps: {0} lines processed; {1} gaps found...'.format(idx, gaps))
+def coverage_segments(coverage, log, block_size=BLOCK_SIZE):
+    '''
+        generate (chr, interval start, gene, offsets, depths) for each run of consecutive coverage lines with the same chr, interval start and gene
+        a run split across blocks is generated in parts
+        a coverage store gives the depth array of each interval without parsing
+    '''
+    if isinstance(coverage, coverage_store.CoverageStore):
+        if not coverage.has_genes:
+            write_log(log, 'coverage store has no genes')
+            return
+        for interval in coverage.intervals:
+            depths = coverage.depths(interval)
+            yield interval.chrom, interval.start, interval.gene, xrange(1, len(depths) + 1), depths
+        return
+    lines_read = 0
+    for lines in coverage_blocks(coverage, block_size):
+        chrs, starts, genes, offsets, depths = parse_coverage_block(lines, lines_read, log)
+        lines_read += len(lines)
+        first = 0
+        for position in xrange(1, len(depths) + 1):
+            if position == len(depths) or chrs[position] != chrs[first] or starts[position] != starts[first] or genes[position] != genes[first]:
+                yield chrs[first], int(starts[first]), genes[first], offsets[first:position], depths[first:position]
+                first = position
+
+def low_runs(depths, max_coverage):
+    '''
+        (start, end) of each run of depths at or below max_coverage, all of depths for a max_coverage of -1
+    '''
+    if max_coverage == -1:
+        return [(0, len(depths))]
+    runs = []
+    run_start = None
+    for position, depth in enumerate(depths):
+        if depth <= max_coverage:
+            if run_start is None:
+                run_start = position
+        elif run_start is not None:
+            runs.append((run_start, position))
+            run_start = None
+    if run_start is not None:
+        runs.append((run_start, len(depths)))
+    return runs
+
+def find_threshold_gap_runs(coverage, min_width, max_coverages, log, block_size=BLOCK_SIZE):
+    '''
+        generate (max_coverage, gap) for runs of low coverage at least min_width long, for each of max_coverages in one pass
+        a run continues while chr, interval start and gene are unchanged, including across block boundaries
+    '''
+    current = [None] * len(max_coverages)
+    previous = None # chr, interval start and gene of the last segment
+    gaps = 0
+    bases = 0
+    write_log(log, 'finding gaps...')
+    for chrom, start, gene, offsets, depths in coverage_segments(coverage, log, block_size):
+        same = (chrom, start, gene) == previous
+        previous = (chrom, start, gene)
+        ended = [] # (position in segment, threshold index, gap) of gaps ended in this segment
+        for i, max_coverage in enumerate(max_coverages):
+            gap = current[i]
+            runs = low_runs(depths, max_coverage)
+            if gap is not None and (not same or len(runs) == 0 or runs[0][0] > 0): # ended by a new interval or high coverage
+                ended.append((0, i, gap))
+                gap = None
+            for run_start, run_end in runs:
+                if gap is None: # start a new gap
+                    gap = {'start': start, 'start_offset': int(offsets[run_start]), 'length': 0, 'chr': chrom, 'gene': gene, 'coverage': coverage_store.CoverageHistogram()}
+                gap['length'] += run_end - run_start
+                gap['coverage'].add_values(depths[run_start:run_end])
+                if run_end < len(depths): # ended by high coverage
+                    ended.append((run_end, i, gap))
+                    gap = None
+            current[i] = gap
+        ended.sort(key=lambda item: item[:2])
+        for _, i, gap in ended:
+            if gap['length'] >= min_width:
+                gaps += 1
+                yield max_coverages[i], gap
+        bases += len(depths)
+        if bases / BLOCK_LINES > (bases - len(depths)) / BLOCK_LINES: # every BLOCK_LINES bases
+            write_log(log, 'finding gaps: {0} bases processed; {1} gaps found...'.format(bases, gaps))
 
     # still a gap in progress?
-    if current is not None and current['length'] >= min_width:
-        write_gap(current, target, data_source, log)
-        gaps += 1
-    write_log(log, 'finding gaps: {0} lines; {1} gaps: done'.format(idx, gaps))
+    for max_coverage, gap in zip(max_coverages, current):
+        if gap is not None and gap['length'] >= min_width:
+            gaps += 1
+            yield max_coverage, gap
+    write_log(log, 'finding gaps: {0} bases; {1} gaps: done'.format(bases, gaps))
+
+def find_gaps(coverage, min_width, max_coverage, target, data_source, log):
+    '''
+        find gaps and annotate
+    '''
+    find_threshold_gaps(coverage, {(max_coverage, min_width): target}, data_source, log)
+
+def find_threshold_gaps(coverage, targets, data_source, log, header=True):
+    '''
+        find and annotate gaps for several thresholds in one pass
+        targets maps (max_coverage, min_width) to the report to write
+    '''
+    max_coverages = sorted(set([max_coverage for max_coverage, _ in targets]))
+    min_widths = {}
+    for max_coverage, min_width in sorted(targets):
+        min_widths.setdefault(max_coverage, []).append(min_width)
+    if header:
+        for target in targets.values():
+            write_header(target)
+    for max_coverage, gap in find_threshold_gap_runs(coverage, min(min_widths[max_coverage][0] for max_coverage in max_coverages), max_coverages, log):
+        line = None
+        for min_width in min_widths[max_coverage]:
+            if gap['length'] < min_width:
+                break
+            if line is None: # annotate once for all widths
+                line = format_gap(gap, annotate_gap(gap, data_source, log))
+            targets[(max_coverage, min_width)].write(line)
+
+def line_chrom(line):
+    '''
+        chromosome of a coverage line
+    '''
+    return line.split('\t', 1)[0]
+
+def chromosome_partitions(filename):
+    '''
+        byte ranges (chrom, start, end) of each chromosome in a coverage file grouped by chromosome
+        boundaries are found by binary search on byte offsets, so the file is not read in full
+    '''
+    size = os.path.getsize(filename)
+    partitions = []
+    with open(filename, 'rb') as handle:
+        def next_line(offset):
+            '''
+                offset of the first line starting at or after offset
+            '''
+            if offset == 0:
+                return 0
+            handle.seek(offset - 1)
+            handle.readline()
+            return handle.tell()
+
+        def chrom_at(offset):
+            '''
+                chromosome of the line starting at offset
+            '''
+            handle.seek(offset)
+            return line_chrom(handle.readline())
+
+        start = 0
+        while start < size:
+            chrom = chrom_at(start)
+            low, high = start, size
+            while high - low > 1:
+                mid = (low + high) / 2
+                offset = next_line(mid)
+                if offset >= size or chrom_at(offset) != chrom:
+                    high = mid
+                else:
+                    low = mid
+            end = next_line(high)
+            partitions.append((chrom, start, end))
+            start = end
+    return partitions
+
+def read_partition(filename, chrom, start, end, block_size=BLOCK_SIZE):
+    '''
+        generate blocks of lines from the byte range start to end of filename, which should all be on chrom
+    '''
+    prefix = chrom + '\t'
+    with open(filename, 'r') as handle:
+        handle.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            lines = handle.readlines(min(block_size, remaining)) # may read past end
+            if not lines:
+                break
+            for idx, line in enumerate(lines):
+                remaining -= len(line)
+                if not line.startswith(prefix) and len(line.split('\t')) > 5 and line_chrom(line).lower() != 'chr':
+                    raise ValueError('coverage file is not grouped by chromosome: found {0} in partition for {1}'.format(line_chrom(line), chrom))
+                if remaining <= 0:
+                    lines = lines[:idx + 1]
+                    break
+            yield lines
+
+def annotate_partition(task):
+    '''
+        find and annotate the gaps in one chromosome partition, returning the report fragment for each threshold
+        runs in a worker process, with only the cds intervals of this chromosome
+    '''
+    filename, chrom, start, end, combinations, cds = task
+    data_source = {'cds': IntervalIndex()}
+    if cds is not None:
+        data_source['cds'].chroms[chrom] = cds
+    fragments = dict([(combination, StringIO.StringIO()) for combination in combinations])
+    lines = itertools.chain.from_iterable(read_partition(filename, chrom, start, end))
+    find_threshold_gaps(lines, fragments, data_source, None, header=False)
+    return chrom, dict([(combination, fragment.getvalue()) for combination, fragment in fragments.items()])
+
+def find_threshold_gaps_parallel(filename, targets, data_source, log, workers):
+    '''
+        find and annotate gaps with a pool of workers, one task per chromosome
+        fragments are written in file order, so the reports match a serial run
+    '''
+    partitions = chromosome_partitions(filename)
+    write_log(log, 'find_threshold_gaps_parallel: {0} partitions with {1} workers'.format(len(partitions), workers))
+    for target in targets.values():
+        write_header(target)
+    combinations = targets.keys()
+    tasks = [(filename, chrom, start, end, combinations, data_source['cds'].chroms.get(chrom)) for chrom, start, end in partitions]
+    pool = multiprocessing.Pool(workers)
+    try:
+        for chrom, fragments in pool.imap(annotate_partition, tasks):
+            for combination, fragment in fragments.items():
+                targets[combination].write(fragment)
+            write_log(log, 'find_threshold_gaps_parallel: {0} done'.format(chrom))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
 
 Interval = collections.namedtuple('Interval', ['start', 'end', 'chrom'])
 
@@ -354,7 +586,7 @@ def init_db(target, log):
         prepare annotation db
     '''
     write_log(log, 'starting init_db...')
-    result = {'cds': IntervalTree()}
+    result = {'cds': IntervalIndex()}
     added = 0
     first = True
     for i, line in enumerate(target):
@@ -368,16 +600,21 @@ def init_db(target, log):
         if cds_end > cds_start:
             # extract exons in cds range
             exon_number = 0
+            exons = []
             for exon_start, exon_end in zip(fields[9].split(','), fields[10].split(',')):
                 if exon_start != '':
                     exon_number += 1
                     intersect_range = find_intersect(int(exon_start), int(exon_end), cds_start, cds_end)
                     if intersect_range is not None and intersect_range[1] > intersect_range[0]:
-                        item = Interval(start=intersect_range[0], end=intersect_range[1], chrom=chrom)
-                        result['cds'].insert(item, other={'name': fields[1], 'strand': fields[3], 'number': exon_number, 'count': int(fields[8])})
-                        added += 1
+                        exons.append((exon_number, intersect_range))
+            transcript = TranscriptCoordinates(fields[3], [intersect_range for _, intersect_range in exons])
+            for exon_number, intersect_range in exons:
+                item = Interval(start=intersect_range[0], end=intersect_range[1], chrom=chrom)
+                result['cds'].insert(item, other={'name': fields[1], 'strand': fields[3], 'number': exon_number, 'count': int(fields[8]), 'transcript': transcript})
+                added += 1
         if i % 10000 == 0:
             write_log(log, 'init_db: {0} lines processed {1} cds intervals last {2}...'.format(i, added, item))
+    result['cds'].build()
     write_log(log, 'init_db: done with {0} intervals'.format(added))
     return result
 
@@ -389,24 +626,148 @@ def download_db(log):
     run("mysql --user=genome --host=genome-mysql.cse.ucsc.edu -A -e 'select * from refGene' hg19 > gap.db", log)
     write_log(log, 'download_db: done')
 
+def copy_previous_gaps(previous, target, excluded):
+    '''
+        copy an earlier gap report to target, leaving out gaps in the excluded genes
+    '''
+    for idx, line in enumerate(previous):
+        if idx == 0 or line.split(',', 2)[1].upper() not in excluded:
+            target.write(line)
+
+def update_threshold_gaps(previous, exome_cov, regions, excluded, targets, data_source, log):
+    '''
+        update gap reports after a gene list change without the bam
+        gaps are kept from the previous reports except for excluded genes, and found for the genes in regions from whole exome coverage
+        previous and targets map (max_coverage, min_width) to the earlier and new reports
+    '''
+    for combination, target in targets.items():
+        copy_previous_gaps(previous[combination], target, excluded)
+    if len(regions) > 0:
+        find_threshold_gaps(gene_coverage.restrict_to_genes(exome_cov, regions, log), targets, data_source, log, header=False)
+
+def check_output(output, combinations):
+    '''
+        raise ValueError if output cannot name a report for each (max_coverage, min_width) combination
+    '''
+    if len(combinations) > 1:
+        if output is None:
+            raise ValueError('an output filename with {min_coverage_ok} and {min_gap_width} is required for more than one threshold')
+        if '{min_coverage_ok}' not in output or '{min_gap_width}' not in output:
+            raise ValueError('output filename {0} must contain {{min_coverage_ok}} and {{min_gap_width}} for more than one threshold'.format(output))
+
+def open_targets(output, combinations):
+    '''
+        open a report for each (max_coverage, min_width) combination
+        output is a filename, with {min_coverage_ok} and {min_gap_width} required for several combinations, or None for stdout
+    '''
+    check_output(output, combinations)
+    if output is None:
+        return {combinations[0]: sys.stdout}
+    return dict([((max_coverage, min_width), open(output.format(min_coverage_ok=max_coverage, min_gap_width=min_width), 'w')) for max_coverage, min_width in combinations])
+
+def close_targets(targets):
+    '''
+        close reports opened by open_targets
+    '''
+    for target in targets.values():
+        if target is not sys.stdout:
+            target.close()
+
+# annotation db shared by batch workers, set before the pool forks
+BATCH_DATA_SOURCE = {}
+
+def set_batch_data_source(data_source):
+    '''
+        pool initializer: make the annotation db available to annotate_sample
+    '''
+    BATCH_DATA_SOURCE['db'] = data_source
+
+def annotate_sample(task):
+    '''
+        write the gap reports for one sample of a batch
+    '''
+    coverage, output, combinations = task
+    targets = open_targets(output, combinations)
+    try:
+        find_threshold_gaps(coverage_store.open_coverage(coverage), targets, BATCH_DATA_SOURCE['db'], None)
+    finally:
+        close_targets(targets)
+    return coverage
+
+def find_batch_gaps(samples, combinations, data_source, log, workers):
+    '''
+        write gap reports for many samples, sharing one annotation db
+        samples is a list of (coverage, output) and up to workers samples are processed at once
+    '''
+    tasks = [(coverage, output, combinations) for coverage, output in samples]
+    set_batch_data_source(data_source)
+    if workers <= 1:
+        for task in tasks:
+            write_log(log, 'find_batch_gaps: {0} done'.format(annotate_sample(task)))
+        return
+    pool = multiprocessing.Pool(workers, initializer=set_batch_data_source, initargs=(data_source,))
+    try:
+        for coverage in pool.imap_unordered(annotate_sample, tasks):
+            write_log(log, 'find_batch_gaps: {0} done'.format(coverage))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
 def main():
     '''
         parse command line and execute
     '''
     import argparse
     parser = argparse.ArgumentParser(description='Generate gap report')
-    parser.add_argument('--min_coverage_ok', required=False, type=int, default=-1, help='maximum value to consider to be low coverage (-1 for all)')
-    parser.add_argument('--min_gap_width', required=False, type=int, default=1, help='minimum width of a gap to report')
-    parser.add_argument('--coverage', required=True, help='coverage file to examine for gaps')
+    parser.add_argument('--min_coverage_ok', required=False, type=int, nargs='+', default=[-1], help='maximum value to consider to be low coverage (-1 for all), several values can be given')
+    parser.add_argument('--min_gap_width', required=False, type=int, nargs='+', default=[1], help='minimum width of a gap to report, several values can be given')
+    parser.add_argument('--coverage', required=True, nargs='+', help='coverage file to examine for gaps, plain, gzipped or a coverage store. several files are processed as a batch')
     parser.add_argument('--db', required=False, help='db to annotate gaps')
+    parser.add_argument('--workers', required=False, type=int, default=1, help='number of processes: chromosomes of a single uncompressed coverage file, or samples of a batch, are annotated in parallel')
+    parser.add_argument('--previous', required=False, help='gap report from before a gene list change, formatted like --output. coverage is then whole exome coverage')
+    parser.add_argument('--add_genes', required=False, help='with --previous, genes to find gaps for')
+    parser.add_argument('--remove_genes', required=False, help='with --previous, genes to drop from the report')
+    parser.add_argument('--gene_bed', required=False, help='bed file of gene regions for add_genes')
+    parser.add_argument('--output', required=False, nargs='+', help='report filename, default stdout. with several thresholds it must contain {min_coverage_ok} and {min_gap_width}. a batch needs one per coverage file')
     args = parser.parse_args()
+    combinations = [(max_coverage, min_width) for max_coverage in args.min_coverage_ok for min_width in args.min_gap_width]
+    outputs = args.output or [None]
+    if len(args.coverage) != len(outputs):
+        parser.error('--output must be given once for each --coverage file')
+    try:
+        for output in outputs:
+            check_output(output, combinations)
+    except ValueError, ex:
+        parser.error(str(ex))
+    if args.previous is not None and (len(args.coverage) > 1 or args.workers > 1):
+        parser.error('--previous updates a single report with one worker')
+    if args.add_genes is not None and (args.previous is None or args.gene_bed is None):
+        parser.error('--add_genes requires --previous and --gene_bed')
+    targets = open_targets(outputs[0], combinations) if len(args.coverage) == 1 else None
     if args.db:
         data_source = init_db(open(args.db, 'r'), sys.stderr)
     else:
         download_db(sys.stderr)
         data_source = init_db(open('gap.db', 'r'), sys.stderr)
-    find_gaps(open(args.coverage, 'r'), args.min_gap_width, args.min_coverage_ok, sys.stdout, data_source, sys.stderr)
+    if args.previous is not None: # update for changed genes
+        added = gene_coverage.read_genes(open(args.add_genes, 'r')) if args.add_genes else set()
+        removed = gene_coverage.read_genes(open(args.remove_genes, 'r')) if args.remove_genes else set()
+        regions = gene_coverage.read_gene_regions(open(args.gene_bed, 'r'), added, sys.stderr) if args.gene_bed else {}
+        previous = dict([((max_coverage, min_width), open(args.previous.format(min_coverage_ok=max_coverage, min_gap_width=min_width), 'r')) for max_coverage, min_width in combinations])
+        update_threshold_gaps(previous, coverage_store.open_coverage(args.coverage[0]), regions, added.union(removed), targets, data_source, sys.stderr)
+    elif targets is None: # batch
+        find_batch_gaps(zip(args.coverage, outputs), combinations, data_source, sys.stderr, args.workers)
+    elif args.workers > 1 and not coverage_store.is_gzipped(args.coverage[0]) and not coverage_store.is_store(args.coverage[0]):
+        find_threshold_gaps_parallel(args.coverage[0], targets, data_source, sys.stderr, args.workers)
+    else:
+        if args.workers > 1:
+            write_log(sys.stderr, 'gzipped or stored coverage cannot be partitioned, using a single worker')
+        find_threshold_gaps(coverage_store.open_coverage(args.coverage[0]), targets, data_source, sys.stderr)
+    if targets is not None:
+        close_targets(targets)
 
 if __name__ == '__main__':
     main()
-
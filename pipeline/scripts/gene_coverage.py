@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+'''
+###########################################################################
+#
+# This file is part of Cpipe.
+#
+# Cpipe is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, under version 3 of the License, subject
+# to additional terms compatible with the GNU General Public License version 3,
+# specified in the LICENSE file that is part of the Cpipe distribution.
+#
+# Cpipe is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cpipe.  If not, see <http:#www.gnu.org/licenses/>.
+#
+###########################################################################
+#
+# Purpose:
+#   Restrict whole exome per base coverage to a set of genes, so that
+#   reports can be updated for changed gene lists without the bam.
+# Usage:
+#   gene_coverage.py --genes added.genes.txt --bed exons.bed < exome.txt > genes.cov.txt
+#
+###########################################################################
+'''
+
+import bisect
+import collections
+import datetime
+import sys
+
+Region = collections.namedtuple('Region', ['start', 'end', 'gene'])
+
+def write_log(log, msg):
+    '''
+        write a date stamped message to log
+    '''
+    now = datetime.datetime.now().strftime('%y%m%d-%H%M%S')
+    if log is not None:
+        log.write('%s: %s\n' % (now, msg))
+
+def read_genes(genelist):
+    '''
+        upper case gene names from a gene list, ignoring comments and any category column
+    '''
+    genes = set()
+    for line in genelist:
+        if line.startswith('#') or line.strip() == '':
+            continue
+        genes.add(line.strip().split('\t')[0].upper())
+    return genes
+
+def read_gene_regions(bed, genes, log=None):
+    '''
+        regions of the listed genes from a bed file of chr, start, end, gene
+        returns a dictionary of chromosome to regions sorted by start
+    '''
+    regions = collections.defaultdict(list)
+    found = set()
+    for line in bed:
+        if line.startswith('#'):
+            continue
+        fields = line.strip().split('\t')
+        if len(fields) > 3 and fields[3].upper() in genes:
+            regions[fields[0]].append(Region(int(fields[1]), int(fields[2]), fields[3]))
+            found.add(fields[3].upper())
+    for chrom in regions:
+        regions[chrom].sort()
+    write_log(log, 'read_gene_regions: {0} of {1} genes found'.format(len(found), len(genes)))
+    return regions
+
+def restrict_to_genes(exome_cov, regions, log=None):
+    '''
+        generate report coverage lines (chr, start, end, gene, offset, coverage) from exome coverage lines (chr, start, end, offset, coverage)
+        intervals are clipped to each gene region, as for coverageBed over the genes intersected with the exome
+        the lines of each clipped region are written together, so overlapping genes do not alternate
+    '''
+    starts = dict([(chrom, [region.start for region in regions[chrom]]) for chrom in regions])
+    longest = dict([(chrom, max([region.end - region.start for region in regions[chrom]] or [0])) for chrom in regions]) # regions overlapping an interval start no earlier than its start less this
+    current = None
+    overlapping = []
+    rows = [] # lines of each overlapping region of the current interval
+    for idx, line in enumerate(exome_cov):
+        fields = line.strip().split('\t')
+        if len(fields) < 5:
+            write_log(log, 'skipped line {0}'.format(idx))
+            continue
+        interval = (fields[0], fields[1], fields[2])
+        if interval != current: # write the previous interval and find the gene regions overlapping this one
+            for region_rows in rows:
+                for row in region_rows:
+                    yield row
+            current = interval
+            overlapping = []
+            if fields[0] in regions:
+                start, end = int(fields[1]), int(fields[2])
+                first = bisect.bisect_left(starts[fields[0]], start - longest[fields[0]])
+                last = bisect.bisect_left(starts[fields[0]], end)
+                for region in regions[fields[0]][first:last]:
+                    if region.end > start:
+                        overlapping.append((max(start, region.start), min(end, region.end), region.gene))
+            rows = [[] for _ in overlapping]
+        if len(overlapping) == 0:
+            continue
+        position = int(fields[1]) + int(fields[3]) - 1
+        for region_rows, (start, end, gene) in zip(rows, overlapping):
+            if start <= position < end:
+                region_rows.append('{0}\t{1}\t{2}\t{3}\t{4}\t{5}\n'.format(fields[0], start, end, gene, position - start + 1, fields[4]))
+    for region_rows in rows:
+        for row in region_rows:
+            yield row
+
+def main():
+    '''
+        parse command line and execute
+    '''
+    import argparse
+    parser = argparse.ArgumentParser(description='Restrict exome coverage to genes')
+    parser.add_argument('--genes', required=True, help='gene list to keep')
+    parser.add_argument('--bed', required=True, help='bed file of gene regions')
+    args = parser.parse_args()
+    regions = read_gene_regions(open(args.bed, 'r'), read_genes(open(args.genes, 'r')), log=sys.stderr)
+    for line in restrict_to_genes(sys.stdin, regions, log=sys.stderr):
+        sys.stdout.write(line)
+
+if __name__ == '__main__':
+    main()
@@ -21,15 +21,18 @@
 # Filter a coverage file for regions < a threshold in coverage and
 # output a unique identifier as an annotation for those regions
 # This eases further processing in R
+# The coverage file can be text, gzipped or a coverage store
 ###########################################################################
 
 import sys, csv
 
+import coverage_store
+
 if len(sys.argv) < 4:
     print "\nUsage: %s <coverage file> <output file> <coverage threshold>\n" % sys.argv[0]
     exit(1)
 
-cov = csv.reader(open(sys.argv[1]), delimiter='\t')
+cov = (line.rstrip('\n').split('\t') for line in coverage_store.open_coverage(sys.argv[1]))
 output = csv.writer(open(sys.argv[2],'wb'), delimiter='\t')
 
 coverage_threshold = int(sys.argv[3])
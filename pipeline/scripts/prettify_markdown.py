@@ -28,32 +28,41 @@
 import re
 import sys
 
-sys.stdout.write( '<html>\n<head>\n<link rel="stylesheet" href="http://yui.yahooapis.com/pure/0.6.0/pure-min.css">\n</head>\n<body>\n<div class="pure-g">\n<div class="pure-u-1-24"></div><div class="pure-u-22-24">\n' )
+HEADER = '<html>\n<head>\n<link rel="stylesheet" href="http://yui.yahooapis.com/pure/0.6.0/pure-min.css">\n</head>\n<body>\n<div class="pure-g">\n<div class="pure-u-1-24"></div><div class="pure-u-22-24">\n'
+FOOTER = '</div>\n<div class="pure-u-1-24"></div>\n</div>\n</body>\n</html>\n'
 
-in_thead = None
-is_empty = True
-for line in sys.stdin:
-  line = line.replace( '<table>', '<table class="pure-table pure-table-bordered">' )
-  # remove empty table headers
-  if in_thead is not None: # already in thead
-    if '</thead>' in line:
-      if not is_empty:
-        sys.stdout.write(in_thead)
-        sys.stdout.write(line)
+def prettify(html, out):
+  '''
+    write the lines of html from markdown2 to out as a styled page
+  '''
+  out.write( HEADER )
+
+  in_thead = None
+  is_empty = True
+  for line in html:
+    line = line.replace( '<table>', '<table class="pure-table pure-table-bordered">' )
+    # remove empty table headers
+    if in_thead is not None: # already in thead
+      if '</thead>' in line:
+        if not is_empty:
+          out.write(in_thead)
+          out.write(line)
+        else:
+          pass # don't print empty
+        in_thead = None
       else:
-        pass # don't print empty
-      in_thead = None
-    else:
-      # determine if line contains content
-      if re.search('<th>[^<]+</th>', line) is not None:
-        is_empty = False
-      in_thead += line
-  else:
-    if '<thead>' in line:
-      in_thead = line
-      is_empty = True
+        # determine if line contains content
+        if re.search('<th>[^<]+</th>', line) is not None:
+          is_empty = False
+        in_thead += line
     else:
-      sys.stdout.write( line )
+      if '<thead>' in line:
+        in_thead = line
+        is_empty = True
+      else:
+        out.write( line )
 
-sys.stdout.write( '</div>\n<div class="pure-u-1-24"></div>\n</div>\n</body>\n</html>\n' )
+  out.write( FOOTER )
 
+if __name__ == '__main__':
+  prettify(sys.stdin, sys.stdout)
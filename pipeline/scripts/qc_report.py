@@ -33,22 +33,47 @@
 # --study: ID of study
 # --meta: meta data file
 # --threshold: threshold for satisfactory coverage
+# --coverage_levels: report the proportion of bases with at least these coverages
 # --classes: how to categorise results
 # --exome: target regions for entire exome
 # --gc: gene categories of genes
 # --anonymous: do not show study ID
 # --write_karyotype: write karyotype details to this file
 # --fragments: file containing fragment details
+# --chromosomes: per chromosome exome depth from bam_qc.py, for karyotype without reading exome_cov
+# --bam: indexed bam, for karyotype estimated from the read counts of its index and --exome
+# --exome: target regions for entire exome
+# --fragment_distributions: file containing fragment size and read length distributions
+# --gene_cache: per gene coverage histograms, reused when genes are added or removed
+# --add_genes: genes added since gene_cache was written, read from exome_cov
+# --remove_genes: genes removed since gene_cache was written
+# --gene_bed: gene regions for add_genes
+# --batch: tab separated inputs for many samples, with a header naming columns from BATCH_COLUMNS
+# --workers: number of samples of a batch to summarize at once
+# --matrix: write the median coverage of each gene for each sample of a batch to this file
 #
 ##############################################################################
 '''
 
 import collections
 import datetime
+import multiprocessing
+import os
 import re
+import StringIO
 import sys
 
+import calculate_qc_statistics
+import coverage_store
+import gene_coverage
+import markdown2
+import prettify_markdown
+import sample_metadata
+
 MEAN_RANGE = 0.8 # calculate proportion of coverage within this fraction of the mean
+COVERAGE_LEVELS = (1, 10, 20, 50) # report proportion of coverage at or above these levels
+DEFAULT_READ_LENGTH = 100. # for karyotype from bam index read counts without fragment statistics
+BATCH_COLUMNS = ('study', 'output', 'report_cov', 'exome_cov', 'ontarget', 'metrics', 'chromosomes', 'fragments', 'fragment_distributions') # study, output, report_cov, exome_cov, ontarget and metrics are required
 
 def write_log(log, msg):
     '''
@@ -58,6 +83,19 @@ def write_log(log, msg):
     if log is not None:
         log.write('%s: %s\n' % (now, msg))
 
+def karyotype_target(chrom):
+    '''
+        x, y or a (autosome) for the chromosomes used to infer karyotype, otherwise None
+    '''
+    chrom = chrom.lower()
+    if chrom == 'chrx':
+        return 'x'
+    if chrom == 'chry':
+        return 'y'
+    if chrom == 'chr1' or chrom == 'chr22':
+        return 'a'
+    return None
+
 def calculate_karyotype(exome_cov, log=None):
     '''
         * calculate the mean coverage on chr1 and chr22, chrX, and chrY
@@ -67,26 +105,39 @@ def calculate_karyotype(exome_cov, log=None):
         * else sample is other
     '''
     write_log(log, 'calculating karyotype...')
-    stats = collections.defaultdict(int)
+    depths = collections.defaultdict(lambda: [0, 0])
+    if isinstance(exome_cov, coverage_store.CoverageStore): # only the depth arrays of the karyotype chromosomes are read
+        for interval in exome_cov.intervals:
+            if karyotype_target(interval.chrom) is not None:
+                values = exome_cov.depths(interval)
+                depths[interval.chrom][0] += sum(values)
+                depths[interval.chrom][1] += len(values)
+        return karyotype_from_depths(depths, log)
     for idx, line in enumerate(exome_cov):
         fields = line.strip().split('\t') # chr, start, end, offset, coverage
         if len(fields) > 4:
-            target = None
-            if fields[0].lower() == 'chrx':
-                target = 'x'
-            if fields[0].lower() == 'chry':
-                target = 'y'
-            if fields[0].lower() == 'chr1' or fields[0].lower() == 'chr22':
-                target = 'a'
-            if target is not None:
-                stats['{0}c'.format(target)] += int(fields[4])
-                stats['{0}n'.format(target)] += 1
+            if karyotype_target(fields[0]) is not None:
+                depths[fields[0]][0] += int(fields[4])
+                depths[fields[0]][1] += 1
         else:
             write_log(log, 'skipped line {0}: {1}'.format(idx, line.strip()))
         if idx % 100000 == 0:
             write_log(log, 'processed {0} lines...'.format(idx))
     write_log(log, 'processed {0} lines'.format(idx))
 
+    return karyotype_from_depths(depths, log)
+
+def karyotype_from_depths(depths, log=None):
+    '''
+        infer karyotype as calculate_karyotype does, from a dictionary of chromosome to (total depth, bases) over the exome
+    '''
+    stats = collections.defaultdict(int)
+    for chrom, (depth, bases) in depths.items():
+        target = karyotype_target(chrom)
+        if target is not None:
+            stats['{0}c'.format(target)] += depth
+            stats['{0}n'.format(target)] += bases
+
     result = {'sex': 'OTHER', 'x_mean_coverage': 0.0, 'y_mean_coverage': 0.0, \
         'autosome_mean_coverage': 0.0}
 
@@ -110,6 +161,50 @@ def calculate_karyotype(exome_cov, log=None):
 
     return result
 
+def read_chromosome_depths(chromosomes):
+    '''
+        (total depth, bases) over the exome for each chromosome from the --chromosomes output of bam_qc.py
+    '''
+    depths = {}
+    for line in chromosomes:
+        if line.startswith('#'):
+            continue
+        fields = line.strip('\n').split('\t') # chrom, reads, bases, depth, mean_depth
+        if len(fields) > 3:
+            depths[fields[0]] = (int(fields[3]), int(fields[2]))
+    return depths
+
+def capture_bases(bed):
+    '''
+        number of bases covered by the regions of a bed file on each chromosome used for karyotype, counting overlaps once
+    '''
+    regions = collections.defaultdict(list)
+    for line in bed:
+        fields = line.strip().split('\t')
+        if len(fields) > 2 and karyotype_target(fields[0]) is not None:
+            regions[fields[0]].append((int(fields[1]), int(fields[2])))
+    result = {}
+    for chrom in regions:
+        bases = 0
+        last = 0
+        for start, end in sorted(regions[chrom]):
+            if end > last:
+                bases += end - max(start, last)
+                last = end
+        result[chrom] = bases
+    return result
+
+def index_depths(references, counts, capture, read_length, ontarget_fraction):
+    '''
+        estimate (total depth, bases) over the capture for each chromosome from the mapped read counts in a bam index
+        the reads of each chromosome are assumed to be on target in the same proportion as all reads
+    '''
+    depths = {}
+    for name, (mapped, _) in zip(references, counts):
+        if name in capture:
+            depths[name] = (mapped * read_length * ontarget_fraction, capture[name])
+    return depths
+
 def write_karyotype(target, karyotype, meta):
     '''
         write karyotype details to target
@@ -145,77 +240,94 @@ def parse_metadata(meta, study):
     '''
        reads metadata file and returns info about a study
     '''
-    header = None
-    for line in meta:
-        if header is None:
-            header = line.strip('\n').split('\t')
-        else:
-            fields = line.strip('\n').split('\t')
-            # convert to dict
-            candidate = {}
-            for idx, field in enumerate(fields):
-                candidate[header[idx].strip().lower()] = field.strip()
-            if 'sample_id' in candidate and candidate['sample_id'] == study:
-                return candidate
-    # problem
-    return None
+    return sample_metadata.parse(meta).record(study)
 
-def calculate_mean_stats(overall_stats, overall_mean, log):
+def calculate_mean_stats(overall_stats, overall_mean, log, levels=COVERAGE_LEVELS):
     '''
-        calculate coverage stats of the form: [in mean range, cov >1, >10, >20, >50]
+        calculate coverage stats of the form: [in mean range, cov >= each of levels]
     '''
     write_log(log, 'calculating coverage stats...')
-    mean_stats = [0, 0, 0, 0, 0]
-
+    histogram = coverage_store.CoverageHistogram()
     for coverage in overall_stats:
-        if coverage > overall_mean * (1.0 - MEAN_RANGE) and coverage < overall_mean * (1.0 + MEAN_RANGE):
-            mean_stats[0] += 1
-        if coverage >= 1:
-            mean_stats[1] += 1
-        if coverage >= 10:
-            mean_stats[2] += 1
-        if coverage >= 20:
-            mean_stats[3] += 1
-        if coverage >= 50:
-            mean_stats[4] += 1
-
-    mean_stats = [100. * x / len(overall_stats) for x in mean_stats]
+        histogram.add(coverage)
+    mean_stats = histogram.mean_stats(overall_mean, levels, MEAN_RANGE)
     write_log(log, 'calculating: done')
 
     return mean_stats
- 
-def calculate_summary(report_cov, threshold, log):
+
+def summarize_coverage(histograms, threshold, levels, log):
     '''
-      calculate a summary of coverage across genes in report_cov
+      summary of coverage from a coverage_store.CoverageHistogram for each gene
     '''
-    write_log(log, 'calculating gene summaries...')
-    stats = collections.defaultdict(list)
-    total_ok = collections.defaultdict(int)
-    total = collections.defaultdict(int)
-    overall_stats = []
+    overall = coverage_store.CoverageHistogram()
+    gene_results = {}
+    for gene, histogram in histograms.items():
+        total = histogram.total()
+        if total == 0:
+            continue
+        gene_results[gene] = {'ok': 100. * histogram.above(threshold) / total, 'median': int(histogram.median())}
+        overall.merge(histogram)
+
+    overall_mean = overall.mean()
+    mean_stats = overall.mean_stats(overall_mean, levels, MEAN_RANGE)
+    write_log(log, 'summarized {0} genes'.format(len(gene_results)))
+
+    return {'mean': overall_mean, 'median': overall.median(), 'genes': gene_results, 'mean_stats': mean_stats, 'levels': list(levels)}
+
+def calculate_gene_histograms(report_cov, log):
+    '''
+      a coverage_store.CoverageHistogram for each gene in report_cov, lines of coverage or a coverage store
+    '''
+    write_log(log, 'calculating gene histograms...')
+    histograms = collections.defaultdict(coverage_store.CoverageHistogram)
+    if isinstance(report_cov, coverage_store.CoverageStore): # depth arrays need no parsing
+        for interval in report_cov.intervals:
+            histogram = histograms[interval.gene]
+            for depth in report_cov.depths(interval):
+                histogram.add(depth)
+        return histograms
     for idx, line in enumerate(report_cov):
         fields = line.strip().split('\t') # chr, start, end, gene, offset, cov
         if len(fields) > 5:
-            gene = fields[3]
-            cov = int(fields[5])
-            stats[gene].append(cov)
-            overall_stats.append(cov)
-            total[gene] += 1
-            if cov > threshold:
-                total_ok[gene] += 1
+            histograms[fields[3]].add(int(fields[5]))
         if idx % 100000 == 0:
-            #write_log(log, 'processed {0} lines... {1} > {2}'.format(idx, cov, threshold))
             write_log(log, 'processed {0} lines...'.format(idx))
+    return histograms
 
-    overall_mean = mean(overall_stats)
-    mean_stats = calculate_mean_stats(overall_stats, overall_mean, log)
+def calculate_summary(report_cov, threshold, log, levels=COVERAGE_LEVELS):
+    '''
+      calculate a summary of coverage across genes in report_cov, lines of coverage or a coverage store
+    '''
+    return summarize_coverage(calculate_gene_histograms(report_cov, log), threshold, levels, log)
 
-    # now record medians of each gene
-    gene_results = {}
-    for gene in stats:
-        gene_results[gene] = {'ok': 100. * total_ok[gene] / total[gene], 'median': int(median(stats[gene]))}
+def read_gene_histograms(cache):
+    '''
+      read per gene histograms written by write_gene_histograms
+    '''
+    histograms = {}
+    for line in cache:
+        fields = line.strip('\n').split('\t') # gene, cov:count,...
+        if len(fields) > 1:
+            histograms[fields[0]] = coverage_store.CoverageHistogram([(int(cov), int(count)) for cov, count in [item.split(':') for item in fields[1].split(',')]])
+    return histograms
 
-    return {'mean': overall_mean, 'median': median(overall_stats), 'genes': gene_results, 'mean_stats': mean_stats}
+def write_gene_histograms(target, histograms):
+    '''
+      write per gene histograms as gene<tab>cov:count,...
+    '''
+    for gene in sorted(histograms):
+        target.write('{0}\t{1}\n'.format(gene, ','.join(['{0}:{1}'.format(cov, count) for cov, count in histograms[gene].items()])))
+
+def update_gene_histograms(histograms, exome_cov, gene_bed, added, removed, log):
+    '''
+      drop removed genes and calculate added genes from whole exome coverage, reusing everything else
+    '''
+    result = dict([(gene, histogram) for gene, histogram in histograms.items() if gene.upper() not in removed and gene.upper() not in added])
+    write_log(log, 'reusing {0} of {1} cached genes'.format(len(result), len(histograms)))
+    if len(added) > 0:
+        regions = gene_coverage.read_gene_regions(gene_bed, added, log)
+        result.update(calculate_gene_histograms(gene_coverage.restrict_to_genes(exome_cov, regions, log), log))
+    return result
 
 def is_ok(percent, conversion):
     '''return the status for a gene'''
@@ -311,7 +423,7 @@ def group_number(number):
         s = s[:-3]
     return s + ','.join(reversed(groups))
 
-def generate_report(summary, karyotype, meta, threshold, categories, conversion, metrics, capture, anonymous, fragments, padding, out):
+def generate_report(summary, karyotype, meta, threshold, categories, conversion, metrics, capture, anonymous, fragments, padding, out, distributions=None):
     '''
         generate a report from the provided summary
     '''
@@ -364,7 +476,8 @@ def generate_report(summary, karyotype, meta, threshold, categories, conversion,
 
     # coverage uniformity
     out.write('**% Coverage within 80% of Mean** | {0:.1f}%\n'.format(summary['mean_stats'][0]))
-    out.write('**% Coverage at 1x, 10x, 20x, 50x** | {0:.1f}%, {1:.1f}%, {2:.1f}%, {3:.1f}%\n'.format(summary['mean_stats'][1], summary['mean_stats'][2], summary['mean_stats'][3], summary['mean_stats'][4]))
+    levels = summary.get('levels', COVERAGE_LEVELS)
+    out.write('**% Coverage at {0}** | {1}\n'.format(', '.join(['{0}x'.format(level) for level in levels]), ', '.join(['{0:.1f}%'.format(x) for x in summary['mean_stats'][1:len(levels) + 1]])))
 
     # fragments
     if fragments is not None:
@@ -372,6 +485,13 @@ def generate_report(summary, karyotype, meta, threshold, categories, conversion,
         out.write('**Mean read length (Std. dev)** | {0:.1f} ({1:.1f})\n'.format(float(fragments['read_mean']), float(fragments['read_sd'])))
         out.write('**% Bases >= Q30** | {0:.1f}%\n'.format(100. * float(fragments['base_pass']) / float(fragments['base_count'])))
 
+    # robust fragment statistics
+    if distributions is not None:
+        out.write('**Median fragment size (MAD)** | {0} ({1})\n'.format(distributions['fragment_median'], distributions['fragment_mad']))
+        out.write('**Fragment size 25th-75th percentile** | {0} - {1}\n'.format(distributions['fragment_p25'], distributions['fragment_p75']))
+        out.write('**Fragment size 5th-95th percentile** | {0} - {1}\n'.format(distributions['fragment_p5'], distributions['fragment_p95']))
+        out.write('**Median read length (MAD)** | {0} ({1})\n'.format(distributions['read_median'], distributions['read_mad']))
+
     # padding
     if padding is not None:
         padding_items = padding.split(',')
@@ -398,6 +518,9 @@ def generate_report(summary, karyotype, meta, threshold, categories, conversion,
     out.write('\n\n**% Mapped on Target**: the proportion of mapped reads that have any part align to any part of the capture region')
     out.write('\n\n**% Coverage within 20% of Mean**: bases in the capture region with coverage within 20% of the observed mean coverage')
     out.write('\n\n**Mean Fragment Size**: the average distance between correctly mapped and paired reads')
+    if distributions is not None:
+        out.write('\n\n**Median Fragment Size**: the median distance between correctly mapped and paired reads, with the median absolute deviation (MAD) from it. Unlike the mean, these are not affected by a few very distant pairs')
+        out.write('\n\n**Fragment size percentile**: the range of fragment sizes containing the middle 50% and 90% of correctly mapped and paired reads')
     out.write('\n\n**Mean Read Length**: the average length of all sequenced reads')
     out.write('\n\n**% Bases >= Q30**: what percentage of bases were given a recalibrated quality of at least 30')
     out.write('\n\n**Exon Padding**: when calling variants, how much padding is given to the exon boundary, overall, for indels, and for SNVs')
@@ -410,6 +533,12 @@ def build_categories(categories, prioritized, log):
     '''
         build a dictionary that maps genes to categories
     '''
+    return prioritize_categories(read_categories(categories), prioritized, log)
+
+def read_categories(categories):
+    '''
+        map genes to categories from the gene categories file
+    '''
     result = {}
     for line in categories:
         if line.startswith('#'):
@@ -417,6 +546,13 @@ def build_categories(categories, prioritized, log):
         fields = line.strip().split('\t')
         if len(fields) > 1:
             result[fields[0].lower()] = int(fields[1])
+    return result
+
+def prioritize_categories(categories, prioritized, log):
+    '''
+        copy of categories with the prioritized genes of a sample overriding them
+    '''
+    result = dict(categories)
 
     # override with prioritized
     prioritized = prioritized.strip('"')
@@ -444,35 +580,176 @@ def build_capture(coverage, log):
             write_log(log, 'exome_cov: {0} processed {1} -> {2}...'.format(idx, field[0], field[1]))
     return result
 
+def render_html(markdown, out):
+    '''
+        write markdown as a styled html page, as markdown2.py --extras tables | prettify_markdown.py does
+    '''
+    html = markdown2.markdown(markdown, extras={'tables': None}).encode('utf-8', 'xmlcharrefreplace')
+    prettify_markdown.prettify(StringIO.StringIO(html), out)
+
+def read_batch(batch):
+    '''
+        per sample inputs from a tab separated file with a header row of names from BATCH_COLUMNS
+    '''
+    header = None
+    result = []
+    for line in batch:
+        if line.startswith('#') or line.strip() == '':
+            continue
+        fields = line.strip('\n').split('\t')
+        if header is None:
+            header = [field.strip().lower() for field in fields]
+            unknown = [column for column in header if column not in BATCH_COLUMNS]
+            missing = [column for column in BATCH_COLUMNS[:6] if column not in header]
+            if len(unknown) > 0 or len(missing) > 0:
+                raise ValueError('batch columns not recognized: {0}, missing: {1}'.format(', '.join(unknown), ', '.join(missing)))
+        else:
+            result.append(dict([(column, field.strip() or None) for column, field in zip(header, fields)]))
+    return result
+
+def summarize_sample(task):
+    '''
+        calculate the coverage summary, karyotype and metrics of one sample of a batch
+    '''
+    inputs, threshold, levels = task
+    result = {'study': inputs['study'], 'output': inputs['output']}
+    result['summary'] = calculate_summary(coverage_store.open_coverage(inputs['report_cov']), threshold, None, levels)
+    result['metrics'] = build_metrics(open(inputs['metrics'], 'r'), open(inputs['ontarget'], 'r'), None)
+    if inputs.get('chromosomes'):
+        result['karyotype'] = karyotype_from_depths(read_chromosome_depths(open(inputs['chromosomes'], 'r')))
+    else:
+        result['karyotype'] = calculate_karyotype(coverage_store.open_coverage(inputs['exome_cov']))
+    result['fragments'] = parse_tsv(open(inputs['fragments'], 'r')) if inputs.get('fragments') else None
+    result['distributions'] = parse_tsv(open(inputs['fragment_distributions'], 'r')) if inputs.get('fragment_distributions') else None
+    return result
+
+def summarize_batch(samples, threshold, levels, log, workers):
+    '''
+        generate summaries for samples, a list of inputs from read_batch, in order
+        up to workers samples are summarized at once
+    '''
+    tasks = [(inputs, threshold, levels) for inputs in samples]
+    if workers <= 1:
+        for task in tasks:
+            result = summarize_sample(task)
+            write_log(log, 'summarize_batch: {0} done'.format(result['study']))
+            yield result
+        return
+    pool = multiprocessing.Pool(workers)
+    try:
+        for result in pool.imap(summarize_sample, tasks):
+            write_log(log, 'summarize_batch: {0} done'.format(result['study']))
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def write_matrix(target, studies, medians):
+    '''
+        write the median coverage of each gene (rows) for each study (columns), NA where a study did not report the gene
+    '''
+    genes = sorted(set([gene for study in studies for gene in medians[study]]))
+    target.write('Gene\t{0}\n'.format('\t'.join(studies)))
+    for gene in genes:
+        target.write('{0}\t{1}\n'.format(gene, '\t'.join([str(medians[study].get(gene, 'NA')) for study in studies])))
+
+def generate_batch(samples, meta, categories, capture, threshold, levels, conversion, anonymous, padding, log, workers=1, matrix=None):
+    '''
+        write the markdown and html report and karyotype of each sample of a batch, sharing the metadata, categories and capture
+        meta is a sample_metadata.Metadata
+        each sample writes <output>.md, <output>.htm and <output>.karyotype.tsv
+    '''
+    medians = {}
+    studies = []
+    for result in summarize_batch(samples, threshold, levels, log, workers):
+        study = result['study']
+        sample = meta.record(study)
+        if sample is None:
+            raise ValueError('study {0} not found in the metadata'.format(study))
+        output = result['output']
+        with open('{0}.karyotype.tsv'.format(output), 'w') as target:
+            write_karyotype(target, result['karyotype'], sample)
+        report = StringIO.StringIO()
+        generate_report(result['summary'], result['karyotype'], sample, threshold, prioritize_categories(categories, sample['prioritised_genes'], log), conversion, result['metrics'], capture, anonymous, result['fragments'], padding, out=report, distributions=result['distributions'])
+        with open('{0}.md'.format(output), 'w') as target:
+            target.write(report.getvalue())
+        with open('{0}.htm'.format(output), 'w') as target:
+            render_html(report.getvalue(), target)
+        studies.append(study)
+        medians[study] = dict([(gene, record['median']) for gene, record in result['summary']['genes'].items()])
+    if matrix is not None:
+        write_matrix(matrix, studies, medians)
+
 def main():
     '''
         parse command line and execute
     '''
     import argparse
     parser = argparse.ArgumentParser(description='Generate coverage report')
-    parser.add_argument('--report_cov', required=True, help='intersected coverage file with genes from bedtools')
+    parser.add_argument('--report_cov', required=False, help='intersected coverage file with genes from bedtools, not needed when updating gene_cache')
     parser.add_argument('--gene_cov', required=True, help='coverage of each gene')
-    parser.add_argument('--exome_cov', required=True, help='exome coverage file with genes')
+    parser.add_argument('--exome_cov', required=False, help='exome coverage file with genes, required without --batch')
     parser.add_argument('--ontarget', required=False, help='target reads count file')
     parser.add_argument('--metrics', required=False, help='metrics output from Picard')
-    #parser.add_argument('--bam', required=False, help='alignment of reads')
-    parser.add_argument('--study', required=True, help='ID of study')
+    parser.add_argument('--bam', required=False, help='indexed alignment of reads, for karyotype estimated from the index read counts and --exome')
+    parser.add_argument('--study', required=False, help='ID of study, required without --batch')
     parser.add_argument('--meta', required=True, help='meta data file')
     parser.add_argument('--threshold', type=int, required=True, help='threshold for satisfactory coverage')
+    parser.add_argument('--coverage_levels', type=int, nargs='+', required=False, default=list(COVERAGE_LEVELS), help='report the proportion of bases with at least these coverages')
     parser.add_argument('--classes', required=True, help='how to categorise results')
-    #parser.add_argument('--exome', required=True, #   help='target regions for entire exome')
+    parser.add_argument('--exome', required=False, help='target regions for entire exome, needed with --bam')
+    parser.add_argument('--chromosomes', required=False, help='per chromosome exome depth from bam_qc.py, for karyotype without reading exome_cov')
     parser.add_argument('--gc', required=True, help='gene categories of genes')
     parser.add_argument('--anonymous', action='store_true', required=False, help='do not show study ID')
     parser.add_argument('--write_karyotype', required=False, help='write karyotype details to specified file')
     parser.add_argument('--fragments', required=False, help='file containing fragment statistics')
+    parser.add_argument('--fragment_distributions', required=False, help='file containing fragment size and read length distributions')
     parser.add_argument('--padding', required=False, help='comma separated padding stats for all,indel,snv')
+    parser.add_argument('--gene_cache', required=False, help='per gene coverage histograms, written from report_cov or updated with add_genes and remove_genes')
+    parser.add_argument('--add_genes', required=False, help='genes added since gene_cache was written, calculated from exome_cov')
+    parser.add_argument('--remove_genes', required=False, help='genes removed since gene_cache was written')
+    parser.add_argument('--gene_bed', required=False, help='bed file of gene regions for add_genes')
+    parser.add_argument('--batch', required=False, help='tab separated inputs of many samples with a header of {0}. writes <output>.md, <output>.htm and <output>.karyotype.tsv for each'.format(', '.join(BATCH_COLUMNS)))
+    parser.add_argument('--workers', required=False, type=int, default=1, help='number of samples of a batch to summarize at once')
+    parser.add_argument('--matrix', required=False, help='with --batch, write the median coverage of each gene for each sample to this file')
     args = parser.parse_args()
-    write_log(sys.stderr, 'opening {0} for karyotype'.format(args.exome_cov))
-    karyotype = calculate_karyotype(open(args.exome_cov, 'r'), log=sys.stderr)
-    summary = calculate_summary(open(args.report_cov, 'r'), args.threshold, log=sys.stderr)
-    sample = parse_metadata(open(args.meta, 'r'), args.study)
-    if args.write_karyotype:
-        write_karyotype(open(args.write_karyotype, 'w'), karyotype, sample)
+    if args.batch:
+        try:
+            samples = read_batch(open(args.batch, 'r'))
+        except ValueError, ex:
+            parser.error(str(ex))
+        meta = sample_metadata.load(args.meta, log=sys.stderr)
+        categories = read_categories(open(args.gc, 'r'))
+        capture = build_capture(open(args.gene_cov, 'r'), log=sys.stderr)
+        matrix = open(args.matrix, 'w') if args.matrix else None
+        generate_batch(samples, meta, categories, capture, args.threshold, args.coverage_levels, args.classes, args.anonymous, args.padding, sys.stderr, args.workers, matrix)
+        if matrix is not None:
+            matrix.close()
+        return
+    if args.study is None or args.exome_cov is None:
+        parser.error('--study and --exome_cov are required without --batch')
+    incremental = args.gene_cache is not None and os.path.exists(args.gene_cache) and (args.add_genes is not None or args.remove_genes is not None)
+    if incremental and args.add_genes is not None and args.gene_bed is None:
+        parser.error('--gene_bed is required with --add_genes')
+    if not incremental and args.report_cov is None:
+        parser.error('--report_cov is required unless updating an existing --gene_cache')
+    if args.bam and not args.exome:
+        parser.error('--exome is required with --bam')
+    if incremental:
+        added = gene_coverage.read_genes(open(args.add_genes, 'r')) if args.add_genes else set()
+        removed = gene_coverage.read_genes(open(args.remove_genes, 'r')) if args.remove_genes else set()
+        gene_bed = open(args.gene_bed, 'r') if args.gene_bed else None
+        histograms = update_gene_histograms(read_gene_histograms(open(args.gene_cache, 'r')), coverage_store.open_coverage(args.exome_cov), gene_bed, added, removed, log=sys.stderr)
+    else:
+        histograms = calculate_gene_histograms(coverage_store.open_coverage(args.report_cov), log=sys.stderr)
+    if args.gene_cache is not None:
+        with open(args.gene_cache, 'w') as cache:
+            write_gene_histograms(cache, histograms)
+    summary = summarize_coverage(histograms, args.threshold, args.coverage_levels, log=sys.stderr)
+    sample = sample_metadata.load(args.meta, log=sys.stderr).record(args.study)
     categories = build_categories(open(args.gc, 'r'), sample['prioritised_genes'], log=sys.stderr)
     metrics = build_metrics(open(args.metrics, 'r'), open(args.ontarget, 'r'), log=sys.stderr)
     capture = build_capture(open(args.gene_cov, 'r'), log=sys.stderr)
@@ -480,7 +757,24 @@ def main():
         fragments = parse_tsv(open(args.fragments, 'r'))
     else:
         fragments = None
-    generate_report(summary, karyotype, sample, args.threshold, categories, args.classes, metrics, capture, args.anonymous, fragments, args.padding, out=sys.stdout)
+    if args.chromosomes:
+        karyotype = karyotype_from_depths(read_chromosome_depths(open(args.chromosomes, 'r')), log=sys.stderr)
+    elif args.bam:
+        references = calculate_qc_statistics.bam_references(open(args.bam, 'rb'))
+        counts = calculate_qc_statistics.read_bai_counts(open(calculate_qc_statistics.find_bai(args.bam), 'rb'))
+        read_length = float(fragments['read_mean']) if fragments is not None else DEFAULT_READ_LENGTH
+        ontarget_fraction = 1. * metrics['on_target'] / (int(metrics['read_pairs_examined']) * 2)
+        karyotype = karyotype_from_depths(index_depths(references, counts, capture_bases(open(args.exome, 'r')), read_length, ontarget_fraction), log=sys.stderr)
+    else:
+        write_log(sys.stderr, 'opening {0} for karyotype'.format(args.exome_cov))
+        karyotype = calculate_karyotype(coverage_store.open_coverage(args.exome_cov), log=sys.stderr)
+    if args.write_karyotype:
+        write_karyotype(open(args.write_karyotype, 'w'), karyotype, sample)
+    if args.fragment_distributions:
+        distributions = parse_tsv(open(args.fragment_distributions, 'r'))
+    else:
+        distributions = None
+    generate_report(summary, karyotype, sample, args.threshold, categories, args.classes, metrics, capture, args.anonymous, fragments, args.padding, out=sys.stdout, distributions=distributions)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+'''
+###########################################################################
+#
+# This file is part of Cpipe.
+#
+# Cpipe is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, under version 3 of the License, subject
+# to additional terms compatible with the GNU General Public License version 3,
+# specified in the LICENSE file that is part of the Cpipe distribution.
+#
+# Cpipe is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cpipe.  If not, see <http:#www.gnu.org/licenses/>.
+#
+###########################################################################
+#
+# Purpose:
+#   Cache the output of steps that depend only on the content of their
+#   input files, such as statistics derived from reference files.
+#   Entries are named by a hash of the step, its version and its inputs,
+#   and are written to a temporary file and renamed into place, so that
+#   concurrent pipelines can share a cache directory.
+# Usage:
+#   reference_cache.py --cache cache_dir --name step --input file1 --input file2 -- command args > output
+#   the output of command is cached, and later runs with unchanged inputs write it without running command
+#
+###########################################################################
+'''
+
+import datetime
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+BLOCK_SIZE = 1024 * 1024
+
+def write_log(log, msg):
+    '''
+        write a date stamped message to log
+    '''
+    now = datetime.datetime.now().strftime('%y%m%d-%H%M%S')
+    if log is not None:
+        log.write('%s: %s\n' % (now, msg))
+
+def file_hash(filename):
+    '''
+        sha1 of the content of a file
+    '''
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as handle:
+        while True:
+            block = handle.read(BLOCK_SIZE)
+            if block == '':
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+def script_version(filename):
+    '''
+        a version that changes whenever a script does, the hash of its source
+    '''
+    if filename.endswith('.pyc'):
+        filename = filename[:-1]
+    return file_hash(filename)
+
+def cache_key(name, version, inputs):
+    '''
+        hash identifying the output of step name at version for the content of the input files
+    '''
+    digest = hashlib.sha1()
+    digest.update('{0}\n{1}\n'.format(name, version))
+    for filename in inputs:
+        digest.update('{0}\n'.format(file_hash(filename)))
+    return digest.hexdigest()
+
+def cached(cache, name, version, inputs, compute, out, log=None):
+    '''
+        write the output of compute(target) for inputs to out, reusing it from the cache directory if it was calculated before
+        compute must depend only on the content of inputs
+        returns True if the cache was used
+    '''
+    entry = os.path.join(cache, '{0}.{1}'.format(name, cache_key(name, version, inputs)))
+    if os.path.exists(entry):
+        write_log(log, 'using cached {0}'.format(entry))
+        hit = True
+    else:
+        write_log(log, 'calculating {0}'.format(entry))
+        if not os.path.isdir(cache):
+            try:
+                os.makedirs(cache)
+            except OSError: # another process made it
+                if not os.path.isdir(cache):
+                    raise
+        handle, temporary = tempfile.mkstemp(dir=cache, prefix='.{0}.'.format(name))
+        try:
+            with os.fdopen(handle, 'wb') as target:
+                compute(target)
+            os.chmod(temporary, 0644)
+            os.rename(temporary, entry) # whichever process finishes last replaces an identical entry
+        except:
+            os.remove(temporary)
+            raise
+        hit = False
+    with open(entry, 'rb') as source:
+        shutil.copyfileobj(source, out)
+    return hit
+
+def run_command(command):
+    '''
+        a compute function writing the output of command
+    '''
+    def compute(target):
+        subprocess.check_call(command, stdout=target)
+    return compute
+
+def main():
+    '''
+        parse command line and execute
+    '''
+    import argparse
+    parser = argparse.ArgumentParser(description='Cache the output of a command that depends only on its input files')
+    parser.add_argument('--cache', required=True, help='cache directory')
+    parser.add_argument('--name', required=True, help='name of the step')
+    parser.add_argument('--version', required=False, help='version of the step. by default, the hashes of the files in command that are not inputs, such as the script')
+    parser.add_argument('--input', required=True, action='append', help='input file the output depends on, can be given several times')
+    parser.add_argument('command', nargs=argparse.REMAINDER, help='command writing the output to stdout')
+    args = parser.parse_args()
+    command = args.command[1:] if len(args.command) > 0 and args.command[0] == '--' else args.command
+    if len(command) == 0:
+        parser.error('a command is required')
+    if args.version is None:
+        inputs = set([os.path.abspath(filename) for filename in args.input])
+        version = ' '.join([script_version(item) for item in command if os.path.isfile(item) and os.path.abspath(item) not in inputs])
+    else:
+        version = args.version
+    cached(args.cache, args.name, '{0}\n{1}'.format(version, ' '.join(command)), args.input, run_command(command), sys.stdout, log=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+'''
+###########################################################################
+#
+# This file is part of Cpipe.
+#
+# Cpipe is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, under version 3 of the License, subject
+# to additional terms compatible with the GNU General Public License version 3,
+# specified in the LICENSE file that is part of the Cpipe distribution.
+#
+# Cpipe is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cpipe.  If not, see <http:#www.gnu.org/licenses/>.
+#
+###########################################################################
+#
+# Purpose:
+#   Read and update the tab separated sample metadata file.
+#   Rows are indexed by Sample_ID and column names are case insensitive.
+#   Files loaded by name are cached next to the file as .<name>.cache,
+#   which is used until the file's modification time or size changes.
+#   Updates replace the file atomically.
+#
+###########################################################################
+'''
+
+import collections
+import cPickle
+import csv
+import datetime
+import os
+import stat
+import tempfile
+
+SAMPLE_ID = 'Sample_ID'
+CACHE_VERSION = 1
+
+def write_log(log, msg):
+    '''
+        write a date stamped message to log
+    '''
+    now = datetime.datetime.now().strftime('%y%m%d-%H%M%S')
+    if log is not None:
+        log.write('%s: %s\n' % (now, msg))
+
+class Metadata(object):
+    '''
+        the rows of a sample metadata file, indexed by sample id
+    '''
+    def __init__(self, header, rows, terminated=True):
+        self.header = header # column names as written
+        self.rows = rows # the fields of each line after the header
+        self.terminated = terminated # whether the last line ended with a newline
+        self.columns = {}
+        self.index = {}
+        self.reindex()
+
+    def reindex(self):
+        '''
+            rebuild the lookups of columns and samples, after the header or sample ids change
+        '''
+        self.columns = dict([(name.strip().lower(), idx) for idx, name in enumerate(self.header)]) # the last of repeated names wins
+        self.index = collections.defaultdict(list)
+        column = self.column(SAMPLE_ID)
+        if column is not None:
+            for idx, fields in enumerate(self.rows):
+                if len(fields) > column and fields[column].strip() != '':
+                    self.index[fields[column].strip()].append(idx)
+
+    def column(self, name):
+        '''
+            index of the named column, or None
+        '''
+        return self.columns.get(name.strip().lower())
+
+    def samples(self):
+        '''
+            sample ids in file order
+        '''
+        return sorted(self.index.keys(), key=lambda sample_id: self.index[sample_id][0])
+
+    def __contains__(self, sample_id):
+        return sample_id in self.index
+
+    def get(self, fields, name, default=''):
+        '''
+            value of the named column from the fields of a row, or default when the row or header lacks it
+        '''
+        column = self.column(name)
+        if column is None or column >= len(fields):
+            return default
+        return fields[column]
+
+    def record(self, sample_id):
+        '''
+            dictionary of lower case column name to stripped value for the first row of sample_id, or None
+        '''
+        if sample_id not in self.index:
+            return None
+        fields = self.rows[self.index[sample_id][0]]
+        return dict([(name.strip().lower(), field.strip()) for name, field in zip(self.header, fields)])
+
+    def value(self, sample_id, name, default=None, convert=None):
+        '''
+            stripped value of a column for sample_id, passed through convert if given.
+            default if the sample or column is missing or the value is empty
+        '''
+        if sample_id not in self.index:
+            return default
+        value = self.get(self.rows[self.index[sample_id][0]], name).strip()
+        if value == '':
+            return default
+        if convert is not None:
+            return convert(value)
+        return value
+
+    def csv_rows(self):
+        '''
+            the header and rows as csv.reader with a tab delimiter reads the file, without the quotes around fields
+        '''
+        return [next(csv.reader(['\t'.join(fields)], delimiter='\t')) for fields in [self.header] + self.rows]
+
+    def set(self, sample_id, name, value):
+        '''
+            set a column of every row of sample_id, returning the number of rows changed
+        '''
+        column = self.column(name)
+        if column is None:
+            raise KeyError(name)
+        for idx in self.index.get(sample_id, []):
+            fields = self.rows[idx]
+            if len(fields) <= column:
+                fields.extend([''] * (column + 1 - len(fields)))
+            fields[column] = value
+        if column == self.column(SAMPLE_ID):
+            self.reindex()
+        return len(self.index.get(sample_id, []))
+
+    def add_column(self, name, value, position=None):
+        '''
+            add a column with the same value for every row, at the end or before position
+        '''
+        if position is None:
+            position = len(self.header)
+        self.header.insert(position, name)
+        for fields in self.rows:
+            fields.insert(position, value)
+        self.reindex()
+
+    def write(self, out, terminated=None):
+        '''
+            write as a tab separated file, ending with a newline if terminated or, by default, if the source did
+        '''
+        if len(self.header) == 0 and len(self.rows) == 0: # nothing was read
+            return
+        if terminated is None:
+            terminated = self.terminated
+        lines = ['\t'.join(self.header)] + ['\t'.join(fields) for fields in self.rows]
+        out.write('\n'.join(lines))
+        if terminated:
+            out.write('\n')
+
+def parse(lines):
+    '''
+        parse the lines of a metadata file
+    '''
+    header = None
+    rows = []
+    terminated = True
+    for line in lines:
+        terminated = line.endswith('\n')
+        fields = line.rstrip('\n').split('\t')
+        if header is None:
+            header = fields
+        else:
+            rows.append(fields)
+    return Metadata(header or [], rows, terminated)
+
+def cache_filename(filename):
+    '''
+        the cache of a metadata file, kept beside it
+    '''
+    directory, name = os.path.split(os.path.abspath(filename))
+    return os.path.join(directory, '.{0}.cache'.format(name))
+
+def cache_key(filename):
+    '''
+        a cache is valid for the same format, modification time and size
+    '''
+    details = os.stat(filename)
+    return (CACHE_VERSION, details.st_mtime, details.st_size)
+
+def write_atomic(filename, content):
+    '''
+        replace filename with what content(out) writes, so that readers never see a partial file
+    '''
+    directory, name = os.path.split(os.path.abspath(filename))
+    handle, temporary = tempfile.mkstemp(dir=directory, prefix='.{0}.'.format(name))
+    try:
+        with os.fdopen(handle, 'wb') as out:
+            content(out)
+        if os.path.exists(filename):
+            os.chmod(temporary, stat.S_IMODE(os.stat(filename).st_mode))
+        os.rename(temporary, filename)
+    except:
+        os.remove(temporary)
+        raise
+
+def write_cache(filename, metadata, log=None):
+    '''
+        cache parsed metadata for filename. a cache that cannot be written is skipped
+    '''
+    try:
+        key = cache_key(filename)
+        write_atomic(cache_filename(filename), lambda out: cPickle.dump((key, metadata), out, cPickle.HIGHEST_PROTOCOL))
+    except (IOError, OSError), ex:
+        write_log(log, 'metadata cache not written: {0}'.format(ex))
+
+def load(filename, log=None):
+    '''
+        parse a metadata file, or reuse its cache if the file is unchanged since the cache was written
+    '''
+    key = cache_key(filename)
+    try:
+        with open(cache_filename(filename), 'rb') as handle:
+            cached_key, metadata = cPickle.load(handle)
+        if cached_key == key:
+            write_log(log, 'using cached metadata for {0}'.format(filename))
+            return metadata
+    except Exception: # a missing, stale or unreadable cache is rebuilt
+        pass
+    with open(filename, 'r') as lines:
+        metadata = parse(lines)
+    write_cache(filename, metadata, log)
+    return metadata
+
+def save(metadata, filename, log=None):
+    '''
+        atomically replace filename with metadata and update its cache
+    '''
+    write_atomic(filename, metadata.write)
+    write_cache(filename, metadata, log)
@@ -24,6 +24,7 @@
 #   Given a gene list and reference bed file, generate a bed file with just those genes
 #   The source file is source_dir/cohort.genes.txt
 #   The target file is target_dir/cohort/cohort.genes.txt
+#   The genes added are listed in source_dir/cohort.added.genes.txt, for updating existing reports
 # Usage:
 #   update_gene_lists --source dir --target dir
 ####################################################################################
@@ -46,6 +47,7 @@ def write_log(log, msg):
 def update_gene_lists(source_dir, target_dir, log):
     '''
         adds genes from files of the form source_dir/*.add.genes.txt to gene lists in target_dir/cohort/cohort.genes.txt
+        and lists the genes that were added in source_dir/cohort.added.genes.txt
     '''
     for filename in glob.glob(os.path.join(source_dir, '*.add.genes.txt')):
         cohort = os.path.basename(filename).split('.')[0]
@@ -71,6 +73,11 @@ def update_gene_lists(source_dir, target_dir, log):
                     added.add(gene)
                     genes[gene] = CATEGORY
 
+            # list the additions, empty if there are none, so that reports can be updated for them
+            with open(os.path.join(source_dir, '%s.added.genes.txt' % cohort), 'w') as fh:
+                for gene in sorted(added):
+                    fh.write('%s\n' % gene)
+
             # write out additional
             if len(added) > 0:
                 with open(target, 'w') as fh:
@@ -24,37 +24,29 @@
 import argparse
 import sys
 
-def update_metadata( sample_in, sample_out, log, sample, name, value ):
-  if len( sample_in ) == 0:
+import sample_metadata
+
+def update_metadata( metadata, log, sample, name, value ):
+  '''
+    set field name of sample in metadata, a sample_metadata.Metadata, to value
+    returns 0 if it was updated, 1 on error
+  '''
+  if len( metadata.header ) == 0:
     log.write( 'ERROR: file is empty\n' )
     return 1
-  headers = sample_in[0].strip().split('\t')
-  headers_map = { header.lower(): idx for idx, header in enumerate( headers ) }
-  sample_out.write( sample_in[0] )
 
-  if 'sample_id' not in headers_map:
+  if metadata.column( 'sample_id' ) is None:
     log.write( 'ERROR: source does not appear to be a valid metadata file\n' )
     return 1
 
-  if name.lower() not in headers_map:
-    log.write( 'ERROR: {0} is not a valid field name. Must be one of: {1}\n'.format( name, ', '.join( headers_map.keys() ) ) )
+  if metadata.column( name ) is None:
+    log.write( 'ERROR: {0} is not a valid field name. Must be one of: {1}\n'.format( name, ', '.join( metadata.columns.keys() ) ) )
     return 1
 
-  sample_found = False
-  samples = []
-  for line in sample_in[1:]:
-    fields = line.rstrip('\n').split('\t')
-    samples.append( fields[headers_map['sample_id']].strip() )
-    if samples[-1] == sample:
-      sample_found = True
-      fields[headers_map[name.lower()]] = value
-      sample_found = True
-      sample_out.write( '%s\n' % '\t'.join( fields ) )
-    else:
-      sample_out.write( line )
-
-  if not sample_found:
-    log.write( 'ERROR: sample "{0}" not found in: {1}\n'.format( sample, ', '.join( samples ) ) )
+  if metadata.set( sample, name, value ) == 0:
+    log.write( 'ERROR: sample "{0}" not found in: {1}\n'.format( sample, ', '.join( metadata.samples() ) ) )
+    return 1
+  return 0
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser(description='Update metadata')
@@ -64,8 +56,8 @@ if __name__ == '__main__':
   parser.add_argument('--target', required=True, help='filename')
   args = parser.parse_args()
 
-  with open( args.target, 'r' ) as sample_in:
-    lines = sample_in.readlines()
-  with open( args.target, 'w' ) as sample_out:
-    update_metadata( lines, sample_out, sys.stderr, args.sample_id, args.name, args.value )
-
+  metadata = sample_metadata.load( args.target, log=sys.stderr )
+  if update_metadata( metadata, sys.stderr, args.sample_id, args.name, args.value ) == 0:
+    sample_metadata.save( metadata, args.target, log=sys.stderr ) # the file is replaced only when the update succeeds
+  else:
+    sys.exit( 1 )
@@ -24,6 +24,8 @@ import os.path
 import random
 import sys
 
+import sample_metadata
+
 def generate_new_id( f ):
   '''
     given a file, reads the current ID, appends to it, and writes it back to the same file.
@@ -77,13 +79,10 @@ def write( src, target, new_id ):
   '''
     reads lines from src and writes to target, appending the pipeline ID at the start as a new column of a tab separated file
   '''
-  first = True
-  for line in src:
-    if first:
-      target.write( 'Pipeline_Run_ID\t%s' % line )
-      first = False
-    else:
-      target.write( '%s\t%s' % ( new_id, line ) )
+  metadata = sample_metadata.parse( src )
+  if len( metadata.header ) > 0:
+    metadata.add_column( 'Pipeline_Run_ID', new_id, 0 )
+  metadata.write( target )
 
 if __name__ == "__main__":
   parser = argparse.ArgumentParser(description='Generate sample metadata file with pipeline ID')
@@ -20,6 +20,9 @@
 ###########################################################################
 import unittest
 import csv
+import os
+import tempfile
+import StringIO
 
 #
 # NOTE: to run these tests use  :
@@ -27,6 +30,7 @@ import csv
 #    python annotate_significance_tests.py
 #
 
+import annotate_significance
 from annotate_significance import Annovar 
 
 class AnnotateSignificanceTest(unittest.TestCase):
@@ -135,6 +139,101 @@ class AnnotateSignificanceTest(unittest.TestCase):
         a.set_value('Condel','')
         assert a.priority() == 1
 
+    def testMafValues(self):
+        a = self.a
+        a.set_value('esp6500siv2_all','0.02')
+        assert a.maf_values() == [0.02, 0, 0]
+        a.set_value('exac03','0.5')
+        assert a.maf_values() == [0.02, 0, 0.5]
+        assert a.maf_value('exac03') == 0.5
+
+    def testClassify(self):
+        common = list(self.a.line)
+        common[self.header.index('esp6500siv2_all')] = '0.5'
+        assert annotate_significance.classify([list(self.a.line), common, ['intronic']], annotate_significance.Regions()) == [[3], [1], [0]]
+
+    def testThresholdSets(self):
+        defaults = annotate_significance.Thresholds(0.01, 0.0005, 0.7)
+        lenient = annotate_significance.parse_threshold_set('lenient:0.6::0.2', defaults)
+        assert lenient == ('lenient', annotate_significance.Thresholds(0.6, 0.0005, 0.2))
+        try:
+            annotate_significance.parse_threshold_set('bad name:0.1:0.1:0.1', defaults)
+            assert False
+        except ValueError:
+            pass
+        common = list(self.a.line)
+        common[self.header.index('esp6500siv2_all')] = '0.5'
+        assert annotate_significance.classify([list(self.a.line), common], annotate_significance.Regions(), [lenient]) == [[3, 4], [1, 2]]
+
+        # the condel threshold only applies to threshold sets, not the main priority
+        try:
+            Annovar.CONDEL_THRESHOLD = 0.2
+            lenient_condel = annotate_significance.parse_threshold_set('condel:::', Annovar.default_thresholds())
+            assert annotate_significance.classify([list(self.a.line)], annotate_significance.Regions(), [lenient_condel]) == [[3, 4]]
+        finally:
+            Annovar.CONDEL_THRESHOLD = 0.7
+
+    def testRegions(self):
+        regions = annotate_significance.Regions(['chr1\t10\t20\n', 'chr1\t15\t25\n', 'chr1\t30\t31\n', 'chr2\t5\t5\n', 'track\n'])
+        assert len(regions) == 16
+        assert [pos for pos in range(40) if regions.contains('chr1', pos)] == range(10, 25) + [30]
+        assert regions.contains('chr1', '24')
+        assert not regions.contains('chr1', '')
+        assert not regions.contains('chr2', 5)
+
+    def testSynonymous(self):
+        a = self.a
+        a.ExonicFunc = "synonymous SNV"
+        a.synonymous = annotate_significance.Regions(['chr3\t38646390\t38646400\n'])
+        assert a.priority() == 5
+        a.synonymous = annotate_significance.Regions(['chr3\t38646390\t38646399\n'])
+        assert a.priority() == 0
+
+    def testParallel(self):
+        rows = []
+        for idx in range(20):
+            line = list(self.a.line)
+            line[self.header.index('Start')] = str(38646390 + idx)
+            line[self.header.index('esp6500siv2_all')] = ['', '0.5', '0.001'][idx % 3]
+            line[self.header.index('AAChange')] = 'quoted\nnewline, {0}'.format(idx) if idx % 4 == 0 else 'c'
+            rows.append(line)
+        text = StringIO.StringIO()
+        csv.writer(text).writerows([self.header] + rows)
+        handle, filename = tempfile.mkstemp(suffix='.csv')
+        try:
+            with os.fdopen(handle, 'wb') as out:
+                out.write(text.getvalue())
+            synonymous = ['chr3\t38646390\t38646395\n']
+            threshold_sets = [('lenient', annotate_significance.Thresholds(0.6, 0.0005, 0.2))]
+            serial = StringIO.StringIO()
+            counts = annotate_significance.process_annovar(open(filename, 'r'), serial, synonymous=synonymous, threshold_sets=threshold_sets)
+            for chunk_bytes in (1, 500, 100000):
+                parallel = StringIO.StringIO()
+                assert annotate_significance.process_annovar_parallel(filename, parallel, synonymous=synonymous, threshold_sets=threshold_sets, workers=2, chunk_bytes=chunk_bytes) == counts
+                assert parallel.getvalue() == serial.getvalue()
+            assert sum(counts[0].values()) == 20
+        finally:
+            os.remove(filename)
+
+    def testParallelMalformed(self):
+        text = StringIO.StringIO()
+        csv.writer(text).writerows([self.header] + [list(self.a.line) for _ in range(20)])
+        lines = text.getvalue().split('\n')
+        lines[12] = lines[12].replace('SCN5A', 'SCN\x005A') # a corrupt row partway through
+        handle, filename = tempfile.mkstemp(suffix='.csv')
+        try:
+            with os.fdopen(handle, 'wb') as out:
+                out.write('\n'.join(lines))
+            for process in (lambda: annotate_significance.process_annovar(open(filename, 'r'), StringIO.StringIO()),
+                            lambda: annotate_significance.process_annovar_parallel(filename, StringIO.StringIO(), workers=2, chunk_bytes=500),
+                            lambda: annotate_significance.process_annovar_parallel(filename, StringIO.StringIO(), workers=2)):
+                try:
+                    process()
+                    assert False
+                except csv.Error:
+                    pass
+        finally:
+            os.remove(filename)
 
      
  
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+###########################################################################
+#
+# This file is part of Cpipe.
+#
+# Cpipe is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, under version 3 of the License, subject
+# to additional terms compatible with the GNU General Public License version 3,
+# specified in the LICENSE file that is part of the Cpipe distribution.
+#
+# Cpipe is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cpipe.  If not, see <http:#www.gnu.org/licenses/>.
+#
+###########################################################################
+
+import unittest
+import random
+import struct
+import sys
+import zlib
+import StringIO
+
+sys.path.append('../scripts/')
+import bam_qc
+import calculate_qc_statistics
+
+CIGAR_CODES = 'MIDNSHP=X'
+
+def bam(records):
+    '''
+        build a bgzf compressed bam from (reference, position, cigar, flag, tlen, seq, qual) records on chr1 and chr2
+    '''
+    text = '@HD\tVN:1.4\n'
+    data = ['BAM\1', struct.pack('<i', len(text)), text, struct.pack('<i', 2), struct.pack('<i', 5), 'chr1\0', struct.pack('<i', 1000), struct.pack('<i', 5), 'chr2\0', struct.pack('<i', 1000)]
+    for reference, position, cigar, flag, tlen, seq, qual in records:
+        ops = [(int(length), CIGAR_CODES.index(op)) for length, op in cigar]
+        packed = '\x11' * ((len(seq) + 1) / 2)
+        quality = ''.join([chr(ord(c) - 33) for c in qual])
+        body = struct.pack('<iiBBHHHiiii', reference, position, 3, 60, 0, len(ops), flag, len(seq), reference, 0, tlen) + 'r1\0' + ''.join([struct.pack('<I', length << 4 | op) for length, op in ops]) + packed + quality
+        data.append(struct.pack('<i', len(body)) + body)
+    result = []
+    raw = ''.join(data)
+    for start in range(0, len(raw), 100) + [len(raw)]:
+        chunk = raw[start:start + 100]
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        compressed = compressor.compress(chunk) + compressor.flush()
+        result.append('\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00' + struct.pack('<H', len(compressed) + 25) + compressed + struct.pack('<Ii', zlib.crc32(chunk) & 0xffffffff, len(chunk)))
+    return ''.join(result)
+
+class BamQCTest(unittest.TestCase):
+
+    def test_region_depth(self):
+        depth = bam_qc.RegionDepth([(10, 20), (15, 30), (50, 60)])
+        assert depth.size == 30
+        assert depth.position(5) == 0
+        assert depth.position(40) == 20
+        assert depth.position(55) == 25
+        assert depth.overlaps(30, 50) == False
+        assert depth.overlaps(25, 51) == True
+        depth.add(0, 12)
+        depth.add(28, 52)
+        depth.add(35, 45)
+        assert list(depth.region_depth(10, 14)) == [1, 1, 0, 0]
+        assert list(depth.region_depth(27, 30)) == [0, 1, 1]
+        assert list(depth.region_depth(50, 53)) == [1, 1, 0]
+        assert depth.total() == 6
+
+    def test_random_depth(self):
+        random.seed(1)
+        intervals = [(start, start + random.randint(0, 40)) for start in [random.randint(0, 500) for _ in xrange(30)]]
+        depth = bam_qc.RegionDepth(intervals)
+        expected = [0] * 700
+        for _ in xrange(200):
+            start = random.randint(0, 600)
+            end = start + random.randint(1, 100)
+            depth.add(start, end)
+            for pos in xrange(start, end):
+                expected[pos] += 1
+        for start, end in intervals:
+            assert list(depth.region_depth(start, end)) == expected[start:end]
+
+    def test_intersect_bed(self):
+        target = bam_qc.read_bed(['chr1\t100\t200\tA\n', 'chr2\t100\t200\tB\n', 'chr1\t500\t600\tC\n'])
+        exome = bam_qc.read_bed(['track name=exome\n', 'chr1\t150\t250\n', 'chr1\t50\t120\n', 'chr1\t300\t400\n'])
+        result = bam_qc.intersect_bed(target, exome)
+        assert [interval.fields for interval in result] == [['chr1', '100', '120', 'A'], ['chr1', '150', '200', 'A']]
+
+    def test_bam_qc(self):
+        records = [
+            (0, 10, [(5, 'M'), (3, 'D'), (5, 'M')], 3, 100, 'A' * 10, 'I' * 10), # covers 10-23
+            (0, 20, [(2, 'S'), (4, 'M')], 3, -100, 'A' * 6, '5' * 6), # covers 20-24
+            (0, 30, [(4, 'M')], 7, 0, 'A' * 4, 'IIII'), # unmapped, not counted for depth
+            (1, 5, [(10, 'M')], 0, 0, 'A' * 10, 'I' * 10), # covers chr2 5-15
+            (-1, -1, [], 4, 0, 'AA', 'II')]
+        references = calculate_qc_statistics.bam_references(StringIO.StringIO(bam(records)))
+        assert references == ['chr1', 'chr2']
+        exome = bam_qc.read_bed(['chr1\t8\t12\n', 'chr1\t18\t26\n', 'chr2\t0\t3\n', 'chr3\t0\t2\n'])
+        depths = bam_qc.build_depths(exome)
+        ontarget = bam_qc.build_depths(bam_qc.read_bed(['chr1\t30\t31\n', 'chr2\t14\t20\n']))
+        alignments = calculate_qc_statistics.bam_alignments(StringIO.StringIO(bam(records)))
+        result = bam_qc.calculate_bam_qc(alignments, references, depths, ontarget, None)
+        assert result.ontarget == 2 # the unmapped read at its position and the chr2 read
+        assert result.reads == {'chr1': 2, 'chr2': 1}
+        assert result.stats.reads.count == 5
+
+        out = StringIO.StringIO()
+        bam_qc.write_coverage(exome, depths, out)
+        lines = out.getvalue().split('\n')
+        assert lines[:4] == ['chr1\t8\t12\t1\t0', 'chr1\t8\t12\t2\t0', 'chr1\t8\t12\t3\t1', 'chr1\t8\t12\t4\t1']
+        assert [line.split('\t')[-1] for line in lines[4:12]] == ['1', '1', '2', '2', '2', '1', '0', '0']
+        assert lines[12:17] == ['chr2\t0\t3\t1\t0', 'chr2\t0\t3\t2\t0', 'chr2\t0\t3\t3\t0', 'chr3\t0\t2\t1\t0', 'chr3\t0\t2\t2\t0']
+
+        out = StringIO.StringIO()
+        bam_qc.write_chromosomes(references, result.reads, depths, out)
+        assert out.getvalue().split('\n')[1:3] == ['chr1\t2\t12\t11\t0.92', 'chr2\t1\t3\t0\t0.00']
+
+        summary = bam_qc.summarize_coverage(exome[:2], depths, result)
+        assert summary['bases'] == 12
+        assert abs(summary['mean_coverage'] - 11 / 12.) < 1e-9
+        assert summary['mean_coverage_low'] == summary['mean_coverage_high'] == summary['mean_coverage']
+        assert summary['median_coverage'] == 1
+        assert summary['ontarget_reads'] == 2
+
+        summary = bam_qc.summarize_coverage(exome[:2], depths, result, 0.5)
+        assert abs(summary['mean_coverage'] - 22 / 12.) < 1e-9
+        assert summary['mean_coverage_low'] < summary['mean_coverage'] < summary['mean_coverage_high']
+        assert summary['ontarget_reads'] == 4
+        out = StringIO.StringIO()
+        bam_qc.write_coverage(exome[:1], depths, out, 2.)
+        assert [line.split('\t')[-1] for line in out.getvalue().split('\n')[:4]] == ['0', '0', '2', '2']
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+###########################################################################
+#
+# This file is part of Cpipe.
+#
+# Cpipe is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, under version 3 of the License, subject
+# to additional terms compatible with the GNU General Public License version 3,
+# specified in the LICENSE file that is part of the Cpipe distribution.
+#
+# Cpipe is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cpipe.  If not, see <http:#www.gnu.org/licenses/>.
+#
+###########################################################################
+
+import unittest
+import sys
+import StringIO
+
+sys.path.append('../scripts/')
+import calculate_exon_coverage
+
+class CalculateExonCoverageTest(unittest.TestCase):
+
+    def test_covered_bases(self):
+        covered = calculate_exon_coverage.CoveredBases([(10, 20), (15, 30), (40, 50), (50, 55), (60, 60)])
+        assert covered.starts == [10, 40]
+        assert covered.overlap(0, 100) == 35
+        assert covered.overlap(25, 45) == 10
+        assert covered.overlap(30, 40) == 0
+        assert covered.overlap(45, 44) == 0
+
+    def test_calculate_coverage(self):
+        capture = ['track name=capture\n', 'chr1\t100\t150\n', 'chr1\t140\t200\n', 'chr2\t0\t10\n']
+        exons = ['chr1\t90\t110\tA\n', 'chr1\t190\t210\tA\n', 'chr2\t5\t15\tB\n', 'chr3\t0\t10\tC\n', 'chr1\t100\t100\tD\n']
+        out = StringIO.StringIO()
+        calculate_exon_coverage.calculate_coverage(capture, exons, out, StringIO.StringIO())
+        assert out.getvalue() == 'a\t50.0\nb\t50.0\nc\t0.0\n'
@@ -24,12 +24,60 @@ import imp
 import os
 import random
 import re
+import struct
 import sys
+import tempfile
+import zlib
 import StringIO
 
 sys.path.append('../scripts/')
 import calculate_qc_statistics
 
+def bgzf(data, block_size=50):
+    '''
+        compress data into small bgzf blocks, ending with the empty eof block
+        returns the bgzf data and the compressed offset of each block
+    '''
+    result = []
+    offsets = []
+    position = 0
+    for start in range(0, len(data), block_size) + [len(data)]:
+        chunk = data[start:start + block_size]
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        compressed = compressor.compress(chunk) + compressor.flush()
+        block = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00' + struct.pack('<H', len(compressed) + 25) + compressed + struct.pack('<Ii', zlib.crc32(chunk) & 0xffffffff, len(chunk))
+        result.append(block)
+        offsets.append(position)
+        position += len(block)
+    return ''.join(result), offsets
+
+def bam(records, block_size=50):
+    '''
+        build a sorted bam and its index from sam style (flag, tlen, seq, qual, reference) records
+    '''
+    text = '@HD\tVN:1.4\tSO:coordinate\n'
+    data = ['BAM\1', struct.pack('<i', len(text)), text, struct.pack('<i', 2), struct.pack('<i', 5), 'chr1\0', struct.pack('<i', 1000), struct.pack('<i', 5), 'chr2\0', struct.pack('<i', 1000)]
+    spans = {}
+    position = len(''.join(data))
+    for flag, tlen, seq, qual, reference in records:
+        length = 0 if seq == '*' else len(seq)
+        packed = '\x11' * ((length + 1) / 2)
+        quality = '\xff' * length if qual == '*' else ''.join([chr(ord(c) - 33) for c in qual])
+        body = struct.pack('<iiBBHHHiiii', reference, 10 if reference >= 0 else -1, 3, 60, 0, 0, flag, length, reference, 20, tlen) + 'r1\0' + packed + quality
+        data.append(struct.pack('<i', len(body)) + body)
+        spans.setdefault(reference, [position, None, 0])[1] = position + len(data[-1])
+        spans[reference][2] += 1
+        position += len(data[-1])
+    compressed, offsets = bgzf(''.join(data), block_size)
+    voffset = lambda x: offsets[x / block_size] << 16 | x % block_size
+    index = ['BAI\1', struct.pack('<i', 2)]
+    for reference in (0, 1):
+        if reference in spans:
+            index.append(struct.pack('<iIi', 1, 37450, 2) + struct.pack('<QQQQ', voffset(spans[reference][0]), voffset(spans[reference][1]), spans[reference][2], 0) + struct.pack('<i', 0))
+        else:
+            index.append(struct.pack('<ii', 0, 0))
+    return compressed, ''.join(index)
+
 class CalculateQCTest(unittest.TestCase):
 
     def test_calc(self):
@@ -68,3 +116,120 @@ class CalculateQCTest(unittest.TestCase):
         assert result['fragment_count'] == 2
         assert result['fragment_mean'] == 150.0
         assert int(result['fragment_sd'] * 100) == 7071
+
+    def test_bam(self):
+        records = [(3, 100, 'AAAA', 'JJJJ', 0), (3, -100, 'A', '5', 0), (3, 300, 'ABC', '5I5', 0), (7, 500, 'AB', '*', 0), (3, 350, '*', '*', 0)]
+        sam = ['r1\t{0}\tchr1\t11\t60\t*\t=\t21\t{1}\t{2}\t{3}\n'.format(flag, tlen, seq, qual) for flag, tlen, seq, qual, _ in records]
+        log = StringIO.StringIO()
+        expected = calculate_qc_statistics.calculate_statistics(sam, log)
+        for threads in (1, 2):
+            result = calculate_qc_statistics.calculate_record_statistics(calculate_qc_statistics.bam_records(StringIO.StringIO(bam(records)[0]), threads), log)
+            assert result.pop('qualities').histogram == expected['qualities'].histogram
+            assert result.pop('fragment_sizes').items() == expected['fragment_sizes'].items()
+            assert result.pop('read_lengths').items() == expected['read_lengths'].items()
+            assert result == dict([(key, value) for key, value in expected.items() if key not in ('qualities', 'fragment_sizes', 'read_lengths')])
+
+    def test_qualities(self):
+        bam = ['0\t3\t2\t3\t4\t5\t6\t7\t100\tA\t5\n', '0\t3\t2\t3\t4\t5\t6\t7\t200\tAB\t5I\n', '0\t3\t2\t3\t4\t5\t6\t7\t300\tABC\t555\n', '0\t3\t2\t3\t4\t5\t6\t7\t350\tABCD\t5II5\n']
+        log = StringIO.StringIO()
+        qualities = calculate_qc_statistics.calculate_statistics(bam, log)['qualities']
+        assert dict(qualities.histogram) == {20: 7, 40: 3}
+        assert qualities.bases_at_or_above(20) == 10
+        assert qualities.bases_at_or_above(30) == 3
+        assert qualities.cycle_bases == [4, 3, 2, 1]
+        assert qualities.cycle_means() == [20.0, 100. / 3, 30.0, 20.0]
+        out = StringIO.StringIO()
+        qualities.write(out)
+        assert out.getvalue().split('\n')[:3] == ['quality\t20\t7', 'quality\t40\t3', 'cycle\t1\t4\t20.00']
+
+    def test_merge(self):
+        a = calculate_qc_statistics.ShardStatistics()
+        b = calculate_qc_statistics.ShardStatistics()
+        both = calculate_qc_statistics.ShardStatistics()
+        for idx, length in enumerate((10, 20, 35, 37, 80, 81, 150)):
+            record = (3, length * 3, length, '5' * (length - 1) + 'I')
+            (a if idx < 3 else b).add(*record)
+            both.add(*record)
+        out = StringIO.StringIO()
+        b.write(out)
+        a.merge(calculate_qc_statistics.read_shard(out.getvalue().split('\n')))
+        merged = a.result(None)
+        expected = both.result(None)
+        for key in ('read_count', 'fragment_count', 'base_count', 'base_pass'):
+            assert merged[key] == expected[key]
+        for key in ('read_mean', 'read_sd', 'fragment_mean', 'fragment_sd'):
+            assert abs(merged[key] - expected[key]) < 1e-9
+        assert merged['qualities'].cycle_means() == expected['qualities'].cycle_means()
+        assert merged['fragment_sizes'].items() == expected['fragment_sizes'].items()
+        assert merged['read_lengths'].items() == expected['read_lengths'].items()
+
+    def test_sample_fraction(self):
+        sam = ['read{0}\t3\tchr1\t11\t60\t*\t=\t21\t{1}\tAAAA\tIIII\n'.format(idx / 2, 100 if idx % 2 == 0 else -100) for idx in xrange(2000)]
+        kept = list(calculate_qc_statistics.sam_records(sam, 0.25))
+        assert kept == list(calculate_qc_statistics.sam_records(sam, 0.25))
+        assert len(kept) % 2 == 0 # mates stay together
+        assert 300 < len(kept) < 700
+        assert len(list(calculate_qc_statistics.sam_records(sam, 1.))) == 2000
+        stats = calculate_qc_statistics.calculate_record_statistics(kept, None)
+        estimate = calculate_qc_statistics.extrapolate_statistics(stats, 0.25)
+        assert estimate['read_count'] == len(kept) * 4
+        assert estimate['read_count_low'] < 2000 < estimate['read_count_high']
+        assert estimate['base_pass_rate_low'] == estimate['base_pass_rate_high'] == 1.
+        out = StringIO.StringIO()
+        calculate_qc_statistics.write_statistics(estimate, out)
+        lines = out.getvalue().split('\n')
+        assert lines[8] == 'sample_fraction\t0.25'
+        assert 'read_mean_low\t4.0' in lines
+
+    def test_size_histogram(self):
+        histogram = calculate_qc_statistics.SizeHistogram(100)
+        for size in (10, 12, 12, 14, 20, 90, 5000):
+            histogram.add(size)
+        assert histogram.count() == 7
+        assert histogram.overflow == 1
+        assert histogram.median() == 14
+        assert histogram.mad() == 4 # deviations 0, 2, 2, 4, 6, 76, 4987
+        assert histogram.percentile(25) == 12
+        assert histogram.percentile(95) == 101
+        histogram.add(16)
+        assert histogram.median() == 15.0
+
+    def test_distributions(self):
+        stats = calculate_qc_statistics.ShardStatistics()
+        for tlen in (200, 210, 220, 230, 100000):
+            stats.add(3, tlen, 100, 'I' * 100)
+        out = StringIO.StringIO()
+        calculate_qc_statistics.write_distributions(stats.result(None), out)
+        lines = out.getvalue().split('\n')
+        assert 'fragment_median\t220' in lines
+        assert 'fragment_mad\t10' in lines
+        assert 'fragment_overflow\t1' in lines
+        assert 'fragment_histogram\t200:1,210:1,220:1,230:1,2001:1' in lines
+        assert 'read_median\t100' in lines
+        assert 'read_histogram\t100:5' in lines
+
+    def test_sharded_bam(self):
+        records = [(3, 100, 'AAAA', 'JJJJ', 0), (3, -100, 'A', '5', 0), (3, 300, 'ABC', '5I5', 1), (3, 350, 'AB', '5I', 1), (4, 0, 'ABCDE', 'IIIII', -1)]
+        compressed, index = bam(records)
+        directory = tempfile.mkdtemp()
+        filename = os.path.join(directory, 'test.bam')
+        with open(filename, 'wb') as out:
+            out.write(compressed)
+        with open(filename + '.bai', 'wb') as out:
+            out.write(index)
+        try:
+            shards = calculate_qc_statistics.bam_shards(filename)
+            assert [name for name, _, _ in shards] == ['chr1', 'chr2', '*']
+            assert calculate_qc_statistics.read_bai_counts(open(filename + '.bai', 'rb')) == [(2, 0), (2, 0)]
+            counts = [calculate_qc_statistics.calculate_shard((filename, name, start, reference, 1, None))[1].reads.count for name, start, reference in shards]
+            assert counts == [2, 2, 1]
+            result = calculate_qc_statistics.calculate_sharded_statistics(filename, None, 2, 1, None).result(None)
+            assert result['read_count'] == 5
+            assert result['fragment_count'] == 3
+            assert result['base_count'] == 15
+            chr2 = calculate_qc_statistics.calculate_sharded_statistics(filename, ['chr2'], 2, 1, None).result(None)
+            assert chr2['read_count'] == 2
+        finally:
+            os.remove(filename)
+            os.remove(filename + '.bai')
+            os.rmdir(directory)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+###########################################################################
+#
+# This file is part of Cpipe.
+#
+# Cpipe is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, under version 3 of the License, subject
+# to additional terms compatible with the GNU General Public License version 3,
+# specified in the LICENSE file that is part of the Cpipe distribution.
+#
+# Cpipe is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cpipe.  If not, see <http:#www.gnu.org/licenses/>.
+#
+###########################################################################
+
+import unittest
+import os
+import random
+import sys
+import tempfile
+import StringIO
+
+sys.path.append('../scripts/')
+import coverage_store
+import qc_report
+
+def write_store(lines):
+    '''
+        convert coverage lines to a temporary store, returning its filename
+    '''
+    handle, filename = tempfile.mkstemp(suffix='.cov.store')
+    with os.fdopen(handle, 'wb') as out:
+        coverage_store.convert(lines, out)
+    return filename
+
+class CoverageStoreTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        random.seed(2)
+        lines = []
+        for start, end, gene in ((100, 110, 'A'), (200, 205, 'B'), (100, 110, 'A'), (300, 304, 'A')):
+            for offset in xrange(1, end - start + 1):
+                lines.append('chr1\t{0}\t{1}\t{2}\t{3}\t{4}\n'.format(start, end, gene, offset, random.randint(0, 100)))
+        lines[-1] = 'chr1\t300\t304\tA\t4\t70000\n'
+        filename = write_store(lines)
+        try:
+            assert coverage_store.is_store(filename)
+            store = coverage_store.CoverageStore(filename)
+            assert list(store) == lines
+            assert [interval.typecode for interval in store.intervals] == ['H', 'H', 'H', 'I']
+            assert store.depth_at(store.intervals[3], 3) == 70000
+            assert [len(depths) for _, depths in store.gene('A')] == [10, 10, 4]
+            region = store.region('chr1', 108, 202)
+            assert [(interval.start, list(depths)) for interval, depths in region] == [(100, [int(line.split('\t')[5]) for line in lines[8:10]]), (100, [int(line.split('\t')[5]) for line in lines[23:25]]), (200, [int(line.split('\t')[5]) for line in lines[10:12]])]
+            assert store.region('chr2', 0, 1000) == []
+            store.close()
+        finally:
+            os.remove(filename)
+
+    def test_exome_coverage(self):
+        lines = ['chrX\t100\t103\t{0}\t{1}\n'.format(offset, offset * 10) for offset in xrange(1, 4)] + ['chr1\t0\t2\t1\t5\n', 'chr1\t0\t2\t2\t7\n']
+        filename = write_store(lines)
+        try:
+            store = coverage_store.CoverageStore(filename)
+            assert not store.has_genes
+            assert list(store) == lines
+            assert qc_report.calculate_karyotype(store) == qc_report.calculate_karyotype(lines)
+        finally:
+            os.remove(filename)
+
+    def test_histogram(self):
+        histogram = coverage_store.CoverageHistogram()
+        assert histogram.median() == 0
+        assert histogram.mean() == 0
+        for value in (4, 1, 3, 1, 5000):
+            histogram.add(value)
+        assert histogram.items() == [(1, 2), (3, 1), (4, 1), (5000, 1)]
+        assert histogram.median() == qc_report.median([4, 1, 3, 1, 5000])
+
+    def test_summary(self):
+        random.seed(3)
+        lines = ['chr1\t{0}\t{1}\tG{2}\t{3}\t{4}\n'.format(gene * 100, gene * 100 + 33, gene, offset, random.randint(0, 60)) for gene in xrange(3) for offset in xrange(1, 34)]
+        filename = write_store(lines)
+        try:
+            store = coverage_store.open_coverage(filename)
+            assert qc_report.calculate_summary(store, 20, None) == qc_report.calculate_summary(lines, 20, None)
+            genes = StringIO.StringIO()
+            median = StringIO.StringIO()
+            coverage_store.write_medians(store, genes, median)
+            assert genes.getvalue().split('\n')[0] == 'Gene,MedianCov'
+            assert len(genes.getvalue().split('\n')) == 5
+            assert median.getvalue() == '{0}\n'.format(coverage_store.format_median(qc_report.median([int(line.split('\t')[5]) for line in lines])))
+        finally:
+            os.remove(filename)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+###########################################################################
+#
+# This file is part of Cpipe.
+#
+# Cpipe is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, under version 3 of the License, subject
+# to additional terms compatible with the GNU General Public License version 3,
+# specified in the LICENSE file that is part of the Cpipe distribution.
+#
+# Cpipe is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cpipe.  If not, see <http:#www.gnu.org/licenses/>.
+#
+###########################################################################
+
+
+import unittest
+import random
+import sys
+import StringIO
+
+sys.path.append('../scripts/')
+import create_exon_bed
+
+def refseq_row(tx, gene, exons, cds=(0, 1000), chrom='chr1'):
+    '''
+        a row of the UCSC RefSeq table
+    '''
+    return ['0', tx, chrom, '+', '0', '0', str(cds[0]), str(cds[1]), str(len(exons)), ''.join(['{0},'.format(start) for start, _ in exons]), ''.join(['{0},'.format(end) for _, end in exons]), '0', gene]
+
+class CreateExonBedTest(unittest.TestCase):
+
+    def test_find_overlap(self):
+        random.seed(1)
+        exons = create_exon_bed.GeneExons()
+        reference = []
+        for _ in xrange(500):
+            start = random.randint(0, 1000)
+            exon = [start, start + random.randint(0, 30)]
+            found = exons.find_overlap(exon)
+            assert found == create_exon_bed.check_overlap(reference, exon)
+            if found is None:
+                exons.add(list(exon))
+                reference.append(list(exon))
+            elif random.random() < 0.5:
+                exons.update(found, exon[0], exon[1])
+                reference[found] = list(exon)
+        assert exons.exons == reference
+        assert exons.first() is exons.exons[min(range(len(reference)), key=lambda i: reference[i][0])]
+        assert exons.last() is exons.exons[max(range(len(reference)), key=lambda i: reference[i][1])]
+
+    def test_prioritized(self):
+        genes, gene_ranges, gene_chr = create_exon_bed.read_genes(['#chr\tstart\tend\tgene\n', 'chr1\t0\t1000\tA\n', 'chr1\t0\t1000\tB\n'])
+        priority = create_exon_bed.read_priority_transcripts(['NM_2.3\n'])
+        rows = [
+            refseq_row('NM_1', 'A', [(100, 200), (300, 400)], (150, 350)),
+            refseq_row('NM_2', 'A', [(120, 220), (500, 600)], (130, 550)),
+            refseq_row('NM_3', 'A', [(90, 210)], (150, 350)),
+            refseq_row('NM_4', 'B', [(100, 200)], chrom='chr1_alt'),
+            refseq_row('NM_5', 'B', [(100, 200)], chrom='chr2'),
+            refseq_row('NM_6', 'B', [(100, 200), (2000, 2100)], (120, 220)),
+            refseq_row('NM_7', 'B', [(150, 250)], (160, 240))]
+        cds_starts, cds_ends, ignored = create_exon_bed.read_refseq(rows, genes, gene_ranges, gene_chr, priority)
+        assert genes['A'].exons == [[120, 220], [300, 400], [500, 600]] # the prioritized exon replaces the longer one
+        assert genes['B'].exons == [[100, 250]] # longest sequence without a prioritized transcript
+        assert ignored == set(['chr1_alt'])
+        create_exon_bed.trim_utr(genes, cds_starts, cds_ends)
+        out = StringIO.StringIO()
+        create_exon_bed.write_bed(genes, gene_chr, out)
+        assert sorted(out.getvalue().split('\n')[:-1]) == ['chr1\t120\t240\tB|1', 'chr1\t130\t220\tA|1', 'chr1\t300\t400\tA|2', 'chr1\t500\t550\tA|3']
+        out = StringIO.StringIO()
+        create_exon_bed.write_bed({'A': genes['A']}, gene_chr, out, splice_mode=True)
+        assert out.getvalue().split('\n')[:2] == ['chr1\t130\t131\tA|1|start', 'chr1\t220\t221\tA|1|end']
@@ -22,15 +22,19 @@
 '''
 
 import unittest
+import gzip
 import imp
 import os
 import random
 import re
 import sys
+import tempfile
 import StringIO
 
 sys.path.append('../scripts/')
+import coverage_store
 import gap_annotator
+import gene_coverage
 
 class GapAnnotatorTest(unittest.TestCase):
 
@@ -67,6 +71,186 @@ class GapAnnotatorTest(unittest.TestCase):
         gap_annotator.find_gaps(cov, 0, 0, target, ds, log)
         lines = target.getvalue().split('\n')
         # Chr,Gene,Start,End,Min Cov,Max Cov,Median Cov,Width,Tx Name,Strand,CDS Distance,CDS Overlap Start,CDS Overlap End,AA Overlap Start,AA Overlap End,Exon Number,Exon Rank
-        assert lines[1] == 'chr1,A,15471419,15471420,0,0,0.0,2,NM_033083,+,0,1,2,1,1,2,2'
+        assert lines[1] == 'chr1,A,15471419,15471420,0,0,0.0,2,NM_033083,+,0,104,105,35,35,2,2'
         assert len(lines) == 3
         assert lines[2] == ''
+
+    def test_interval_index(self):
+        index = gap_annotator.IntervalIndex()
+        index.insert(gap_annotator.Interval(start=100, end=200, chrom='chr1'), other={'name': 'a'})
+        index.insert(gap_annotator.Interval(start=10, end=50, chrom='chr1'), other={'name': 'b'})
+        index.insert(gap_annotator.Interval(start=150, end=300, chrom='chr1'), other={'name': 'c'})
+        index.insert(gap_annotator.Interval(start=500, end=600, chrom='chr1'), other={'name': 'd'})
+        assert [x.other['name'] for x in index.intersect(gap_annotator.Interval(start=160, end=170, chrom='chr1'))] == ['a', 'c']
+        assert [x.other['name'] for x in index.intersect(gap_annotator.Interval(start=250, end=260, chrom='chr1'))] == ['c']
+        assert index.intersect(gap_annotator.Interval(start=300, end=500, chrom='chr1')) == []
+        assert index.intersect(gap_annotator.Interval(start=1, end=2, chrom='chr2')) == []
+        interval, distance = index.nearest(gap_annotator.Interval(start=320, end=330, chrom='chr1'))
+        assert interval.other['name'] == 'c' and distance == 20
+        interval, distance = index.nearest(gap_annotator.Interval(start=400, end=480, chrom='chr1'))
+        assert interval.other['name'] == 'd' and distance == 20
+        interval, distance = index.nearest(gap_annotator.Interval(start=60, end=70, chrom='chr1'))
+        assert interval.other['name'] == 'b' and distance == 10
+
+    def test_nearest_adjacent(self):
+        random.seed(6)
+        intervals = gap_annotator.ChromIntervals()
+        for idx in xrange(300):
+            start = random.randint(0, 3000)
+            intervals.insert(start, start + random.randint(1, 20), idx)
+        intervals.build()
+        for _ in xrange(500):
+            start = random.randint(0, 3100)
+            end = start + random.randint(0, 5)
+            if len(intervals.intersect(start, end)) > 0:
+                continue
+            interval, distance = intervals.nearest(start, end)
+            # reference: the latest end before start among intervals starting before end, or the first after end, or the first interval
+            candidates = [(intervals.starts[0] - end if intervals.starts[0] > end else start - intervals.ends[0], 0)]
+            upstream = [i for i in xrange(len(intervals.items)) if intervals.starts[i] < end and intervals.ends[i] < start]
+            if upstream:
+                i = max(upstream, key=lambda i: (intervals.ends[i], -i))
+                candidates.append((start - intervals.ends[i], i))
+            downstream = [i for i in xrange(len(intervals.items)) if intervals.starts[i] > end]
+            if downstream:
+                candidates.append((intervals.starts[downstream[0]] - end, downstream[0]))
+            best_distance, best = candidates[0]
+            for candidate_distance, candidate in candidates[1:]:
+                if candidate_distance < best_distance:
+                    best_distance, best = candidate_distance, candidate
+            assert (interval, distance) == (intervals.items[best], best_distance)
+
+    def test_gzip_coverage_across_blocks(self):
+        cov = ''.join(['chr1\t100\t200\tA\t{0}\t{1}\n'.format(i, 0 if i < 40 else 10) for i in xrange(1, 51)])
+        handle, filename = tempfile.mkstemp(suffix='.cov.gz')
+        os.close(handle)
+        try:
+            with gzip.open(filename, 'wb') as out:
+                out.write(cov)
+            gaps = list(gap_annotator.find_gap_runs(coverage_store.open_coverage(filename), 0, 5, None, block_size=64))
+        finally:
+            os.remove(filename)
+        assert len(gaps) == 1
+        assert gaps[0]['start_offset'] == 1
+        assert gaps[0]['length'] == 39
+
+    def test_parse_coverage_block(self):
+        log = StringIO.StringIO()
+        chrs, starts, genes, offsets, depths = gap_annotator.parse_coverage_block(['chr1\t100\t200\tA\t1\t5', 'chr1\t100\t200\tA\t2\t12\n'], 1, log)
+        assert (chrs, starts, genes, offsets, list(depths)) == (['chr1', 'chr1'], ['100', '100'], ['A', 'A'], ['1', '2'], [5, 12])
+        assert log.getvalue() == ''
+        chrs, starts, genes, offsets, depths = gap_annotator.parse_coverage_block(['chr\tstart\tend\tgene\toffset\tcov', 'chr2\t300\t350\tB\t7\t0\textra', '', 'chr2\t300\t350\tB\t8\t3'], 10, log)
+        assert (chrs, starts, genes, offsets, list(depths)) == (['chr2', 'chr2'], ['300', '300'], ['B', 'B'], ['7', '8'], [0, 3])
+        assert re.findall('skipped line [0-9]+', log.getvalue()) == ['skipped line 10', 'skipped line 12']
+
+    def test_coverage_store(self):
+        random.seed(5)
+        cov = ['{0}\t{1}\t{2}\t{3}\t{4}\t{5}\n'.format(chrom, start, start + 40, gene, offset, random.choice([0, 3, 8, 20, 40])) for chrom, start, gene in (('chr1', 100, 'A'), ('chr1', 100, 'B'), ('chr2', 100, 'B'), ('chr2', 300, 'B')) for offset in xrange(1, 41)]
+        handle, filename = tempfile.mkstemp(suffix='.cov.store')
+        with os.fdopen(handle, 'wb') as out:
+            coverage_store.convert(cov, out)
+        try:
+            store = coverage_store.open_coverage(filename)
+            from_store = [(max_coverage, gap['chr'], gap['gene'], gap['start'], gap['start_offset'], gap['length'], gap['coverage'].items()) for max_coverage, gap in gap_annotator.find_threshold_gap_runs(store, 1, [-1, 5, 10], None)]
+            store.close()
+        finally:
+            os.remove(filename)
+        from_lines = [(max_coverage, gap['chr'], gap['gene'], gap['start'], gap['start_offset'], gap['length'], gap['coverage'].items()) for max_coverage, gap in gap_annotator.find_threshold_gap_runs(cov, 1, [-1, 5, 10], None)]
+        assert len(from_lines) > 10
+        assert from_store == from_lines
+
+    def test_multiple_thresholds(self):
+        cov = ['chr1\t100\t200\tA\t1\t5', 'chr1\t100\t200\tA\t2\t12', 'chr1\t100\t200\tA\t3\t15', 'chr1\t100\t200\tA\t4\t30']
+        log = StringIO.StringIO()
+        data = ['bin\tname\tchrom\tstrand\ttxStart\ttxEnd\tcdsStart\tcdsEnd\texonCount\texonStarts\texonEnds\tscore\tname2\tcdsStartStat\tcdsEndStat\texonFrames']
+        ds = gap_annotator.init_db(data, log)
+        targets = {(10, 1): StringIO.StringIO(), (20, 1): StringIO.StringIO(), (20, 4): StringIO.StringIO()}
+        gap_annotator.find_threshold_gaps(cov, targets, ds, log)
+        assert targets[(10, 1)].getvalue().split('\n')[1] == 'chr1,A,100,100,5,5,5,1,N/A,N/A,N/A,N/A,N/A,N/A,N/A,N/A,N/A'
+        assert targets[(20, 1)].getvalue().split('\n')[1] == 'chr1,A,100,102,5,15,12,3,N/A,N/A,N/A,N/A,N/A,N/A,N/A,N/A,N/A'
+        assert len(targets[(20, 4)].getvalue().split('\n')) == 2
+
+    def test_gap_coverage_median(self):
+        coverage = coverage_store.CoverageHistogram()
+        for value in (4, 1, 3, 1):
+            coverage.add(value)
+        assert coverage.minimum() == 1
+        assert coverage.maximum() == 4
+        assert coverage.median() == 2.0
+        coverage.add(9)
+        assert coverage.median() == 3
+
+    def test_parallel_matches_serial(self):
+        cov = ''.join(['{0}\t15471419\t15471614\tA\t{1}\t{2}\n'.format(chrom, i, i % 7) for chrom in ('chr1', 'chr2', 'chr3') for i in xrange(1, 100)])
+        data = ['bin\tname\tchrom\tstrand\ttxStart\ttxEnd\tcdsStart\tcdsEnd\texonCount\texonStarts\texonEnds\tscore\tname2\tcdsStartStat\tcdsEndStat\texonFrames', '703\tNM_033083\tchr1\t+\t15469063\t15484120\t15469286\t15480662\t6\t15469063,15471419,15473593,15475854,15477848,15480615,\t15469389,15471514,15473730,15476045,15478082,15484120,\t0\tEAF1\tcmpl\tcmpl\t0,1,0,2,1,1,']
+        handle, filename = tempfile.mkstemp(suffix='.cov.txt')
+        os.write(handle, cov)
+        os.close(handle)
+        try:
+            assert [chrom for chrom, _, _ in gap_annotator.chromosome_partitions(filename)] == ['chr1', 'chr2', 'chr3']
+            ds = gap_annotator.init_db(data, None)
+            serial = {(3, 1): StringIO.StringIO(), (5, 2): StringIO.StringIO()}
+            gap_annotator.find_threshold_gaps(open(filename), serial, ds, None)
+            parallel = {(3, 1): StringIO.StringIO(), (5, 2): StringIO.StringIO()}
+            gap_annotator.find_threshold_gaps_parallel(filename, parallel, ds, None, 2)
+        finally:
+            os.remove(filename)
+        for combination in serial:
+            assert serial[combination].getvalue() == parallel[combination].getvalue()
+
+    def test_batch(self):
+        data = ['bin\tname\tchrom\tstrand\ttxStart\ttxEnd\tcdsStart\tcdsEnd\texonCount\texonStarts\texonEnds\tscore\tname2\tcdsStartStat\tcdsEndStat\texonFrames', '703\tNM_033083\tchr1\t+\t15469063\t15484120\t15469286\t15480662\t6\t15469063,15471419,15473593,15475854,15477848,15480615,\t15469389,15471514,15473730,15476045,15478082,15484120,\t0\tEAF1\tcmpl\tcmpl\t0,1,0,2,1,1,']
+        ds = gap_annotator.init_db(data, None)
+        directory = tempfile.mkdtemp()
+        samples = []
+        for sample, depth in (('s1', 0), ('s2', 30)):
+            coverage = os.path.join(directory, '{0}.cov.txt'.format(sample))
+            with open(coverage, 'w') as out:
+                out.write('chr1\t15471419\t15471614\tA\t1\t{0}\nchr1\t15471419\t15471614\tA\t2\t{0}\n'.format(depth))
+            samples.append((coverage, os.path.join(directory, sample + '.{min_coverage_ok}.{min_gap_width}.csv')))
+        gap_annotator.find_batch_gaps(samples, [(15, 1), (20, 1)], ds, None, 2)
+        for threshold in (15, 20):
+            assert open(os.path.join(directory, 's1.{0}.1.csv'.format(threshold))).read().split('\n')[1] == 'chr1,A,15471419,15471420,0,0,0.0,2,NM_033083,+,0,104,105,35,35,2,2'
+            assert len(open(os.path.join(directory, 's2.{0}.1.csv'.format(threshold))).read().split('\n')) == 2
+        for filename in os.listdir(directory):
+            os.remove(os.path.join(directory, filename))
+        os.rmdir(directory)
+
+    def test_transcript_coordinates(self):
+        forward = gap_annotator.TranscriptCoordinates('+', [(100, 110), (200, 205)])
+        assert forward.cds_position(100) == 1
+        assert forward.cds_position(109) == 10
+        assert forward.cds_position(110) is None
+        assert forward.cds_position(200) == 11
+        assert forward.codon_position(200) == 4
+        assert forward.cds_position(99) is None
+        reverse = gap_annotator.TranscriptCoordinates('-', [(100, 110), (200, 205)])
+        assert reverse.cds_position(204) == 1
+        assert reverse.cds_position(200) == 5
+        assert reverse.cds_position(109) == 6
+        assert reverse.codon_position(100) == 5
+
+    def test_reverse_strand_overlap(self):
+        # gap covers the last 2 coding bases of exon 1 in genomic order, which is the end of the coding sequence
+        cov = ['chr1\t15469286\t15469389\tA\t1\t0', 'chr1\t15469286\t15469389\tA\t2\t0', 'chr1\t15469286\t15469389\tA\t3\t10']
+        data = ['bin\tname\tchrom\tstrand\ttxStart\ttxEnd\tcdsStart\tcdsEnd\texonCount\texonStarts\texonEnds\tscore\tname2\tcdsStartStat\tcdsEndStat\texonFrames', '703\tNM_1\tchr1\t-\t15469063\t15484120\t15469286\t15471514\t2\t15469063,15471419,\t15469389,15471514,\t0\tEAF1\tcmpl\tcmpl\t0,1,']
+        target = StringIO.StringIO()
+        ds = gap_annotator.init_db(data, None)
+        gap_annotator.find_gaps(cov, 0, 0, target, ds, None)
+        assert target.getvalue().split('\n')[1] == 'chr1,A,15469286,15469287,0,0,0.0,2,NM_1,-,0,197,198,66,66,1,2'
+
+    def test_update_gaps(self):
+        previous = StringIO.StringIO()
+        gap_annotator.write_header(previous)
+        previous.write('chr1,A,100,101,0,0,0.0,2,N/A,N/A,N/A,N/A,N/A,N/A,N/A,N/A,N/A\n')
+        previous.write('chr1,B,300,301,0,0,0.0,2,N/A,N/A,N/A,N/A,N/A,N/A,N/A,N/A,N/A\n')
+        previous.seek(0)
+        exome = ['chr2\t500\t503\t1\t3', 'chr2\t500\t503\t2\t4', 'chr2\t500\t503\t3\t50']
+        regions = gene_coverage.read_gene_regions(['chr2\t500\t600\tC'], set(['C']))
+        ds = gap_annotator.init_db(['header'], None)
+        target = StringIO.StringIO()
+        gap_annotator.update_threshold_gaps({(20, 1): previous}, exome, regions, set(['B', 'C']), {(20, 1): target}, ds, None)
+        lines = target.getvalue().split('\n')
+        assert lines[1] == 'chr1,A,100,101,0,0,0.0,2,N/A,N/A,N/A,N/A,N/A,N/A,N/A,N/A,N/A'
+        assert lines[2] == 'chr2,C,500,501,3,4,3.5,2,N/A,N/A,N/A,N/A,N/A,N/A,N/A,N/A,N/A'
+        assert len(lines) == 4
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+###########################################################################
+#
+# This file is part of Cpipe.
+#
+# Cpipe is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, under version 3 of the License, subject
+# to additional terms compatible with the GNU General Public License version 3,
+# specified in the LICENSE file that is part of the Cpipe distribution.
+#
+# Cpipe is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cpipe.  If not, see <http:#www.gnu.org/licenses/>.
+#
+###########################################################################
+
+import unittest
+import random
+import sys
+
+sys.path.append('../scripts/')
+import gene_coverage
+
+class GeneCoverageTest(unittest.TestCase):
+
+    def test_read_genes(self):
+        genes = gene_coverage.read_genes(['# version 1\n', 'brca1\t1\n', 'TTN\n', '\n'])
+        assert genes == set(['BRCA1', 'TTN'])
+
+    def test_restrict_to_genes(self):
+        bed = ['chr1\t102\t104\tA\n', 'chr1\t500\t600\tB\n', 'chr2\t100\t200\tA\n']
+        regions = gene_coverage.read_gene_regions(bed, set(['A']))
+        assert len(regions['chr1']) == 1
+        exome = ['chr1\t100\t105\t{0}\t{1}\n'.format(offset, offset * 10) for offset in xrange(1, 6)]
+        result = list(gene_coverage.restrict_to_genes(exome, regions))
+        assert result == ['chr1\t102\t104\tA\t1\t30\n', 'chr1\t102\t104\tA\t2\t40\n']
+
+    def test_restrict_overlapping(self):
+        random.seed(4)
+        bed = []
+        for idx in xrange(200):
+            start = random.randint(0, 5000)
+            bed.append('chr1\t{0}\t{1}\tG{2}\n'.format(start, start + random.choice([5, 20, 50, 2000]), idx % 7))
+        regions = gene_coverage.read_gene_regions(bed, set(['G{0}'.format(idx) for idx in xrange(7)]))
+        exome = []
+        expected = []
+        for start in xrange(0, 6000, 37):
+            end = start + random.randint(1, 30)
+            for offset in xrange(1, end - start + 1):
+                exome.append('chr1\t{0}\t{1}\t{2}\t7\n'.format(start, end, offset))
+            for region in regions['chr1']: # each clipped region in full, as coverageBed -d over the gene bed
+                for position in xrange(max(start, region.start), min(end, region.end)):
+                    expected.append('chr1\t{0}\t{1}\t{2}\t{3}\t7\n'.format(max(start, region.start), min(end, region.end), region.gene, position - max(start, region.start) + 1))
+        assert list(gene_coverage.restrict_to_genes(exome, regions)) == expected
+
+    def test_restrict_overlapping_contiguous(self):
+        regions = gene_coverage.read_gene_regions(['chr1\t100\t110\tA\n', 'chr1\t105\t120\tB\n'], set(['A', 'B']))
+        exome = ['chr1\t100\t120\t{0}\t0\n'.format(offset) for offset in xrange(1, 21)]
+        genes = [line.split('\t')[3] for line in gene_coverage.restrict_to_genes(exome, regions)]
+        assert genes == ['A'] * 10 + ['B'] * 15
@@ -24,11 +24,15 @@ import imp
 import os
 import random
 import re
+import shutil
 import sys
+import tempfile
 import StringIO
 
 sys.path.append('../scripts/')
+import coverage_store
 import qc_report
+import sample_metadata
 
 class QCReportTest(unittest.TestCase):
 
@@ -50,6 +54,23 @@ class QCReportTest(unittest.TestCase):
         assert result['y_mean_coverage'] == 0.
         assert result['autosome_mean_coverage'] == 5.
 
+    def test_karyotype_from_chromosomes(self):
+        chromosomes = ['#chrom\treads\tbases\tdepth\tmean_depth\n', 'chr1\t10\t100\t2000\t20.00\n', 'chr2\t10\t100\t9000\t90.00\n', 'chrX\t5\t50\t500\t10.00\n', 'chrY\t5\t50\t500\t10.00\n']
+        result = qc_report.karyotype_from_depths(qc_report.read_chromosome_depths(chromosomes))
+        exome_cov = ['chr1\t100\t200\t1\t20', 'chr2\t100\t200\t1\t90', 'chrX\t100\t200\t1\t10', 'chrY\t100\t200\t1\t10']
+        assert result == qc_report.calculate_karyotype(exome_cov)
+        assert result['sex'] == 'MALE'
+
+    def test_karyotype_from_index(self):
+        capture = qc_report.capture_bases(['chr1\t0\t100\n', 'chr1\t50\t150\n', 'chr2\t0\t100\n', 'chrX\t0\t100\n'])
+        assert capture == {'chr1': 150, 'chrX': 100}
+        depths = qc_report.index_depths(['chr1', 'chr2', 'chrX', 'chrY'], [(300, 0), (100, 0), (400, 0), (0, 0)], capture, 100., 0.5)
+        assert depths == {'chr1': (15000., 150), 'chrX': (20000., 100)}
+        result = qc_report.karyotype_from_depths(depths)
+        assert result['autosome_mean_coverage'] == 100.
+        assert result['x_mean_coverage'] == 200.
+        assert result['sex'] == 'FEMALE'
+
     def test_median(self):
         l = [ 5, 8, 2, 9, -3 ]
         assert qc_report.median(l) == 5
@@ -82,6 +103,26 @@ class QCReportTest(unittest.TestCase):
         assert s['genes']['A']['median'] == 10
         assert s['genes']['A']['ok'] == 25.0
 
+    def test_calculate_summary_levels(self):
+        cov = ['chr1\t100\t200\tA\t1\t5', 'chr1\t100\t200\tA\t2\t5000', 'chr1\t100\t200\tB\t1\t15', 'chr1\t100\t200\tB\t2\t2000']
+        log = StringIO.StringIO()
+        s = qc_report.calculate_summary(cov, 20, log, levels=[5, 100, 3000])
+        assert s['mean'] == 1755.0
+        assert s['median'] == 1007.5
+        assert s['genes']['A']['median'] == 2502
+        assert s['levels'] == [5, 100, 3000]
+        assert s['mean_stats'] == [25.0, 100.0, 50.0, 25.0]
+
+    def test_coverage_histogram(self):
+        histogram = coverage_store.CoverageHistogram([(3, 2), (coverage_store.HISTOGRAM_CAP + 5, 1)])
+        histogram.add(0)
+        assert len(histogram.counts) == 4
+        assert histogram.items() == [(0, 1), (3, 2), (coverage_store.HISTOGRAM_CAP + 5, 1)]
+        other = coverage_store.CoverageHistogram([(10, 1)])
+        other.merge(histogram)
+        assert other.total() == 5
+        assert other.median() == 3
+
 #    def test_report(self):
 #        cov = ['chr1\t100\t200\tA\t1\t5', 'chr1\t100\t200\tA\t2\t5', 'chr1\t100\t200\tA\t3\t15', 'chr1\t100\t200\tA\t4\t40']
 #        log = StringIO.StringIO()
@@ -105,6 +146,17 @@ class QCReportTest(unittest.TestCase):
         assert res['mean'] == '123.4'
         assert res['sd'] == '567.9'
 
+    def test_report_distributions(self):
+        summary = {'mean': 50.0, 'median': 48, 'mean_stats': [80.0, 99.0, 95.0, 90.0, 50.0], 'genes': {}}
+        karyotype = {'x': 1.0, 'y': 0.0, 'sex': 'FEMALE'}
+        meta = {'sex': 'Female', 'sample_id': 'S1', 'batch': 'B1', 'sequencing_date': '20150101', 'prioritised_genes': ''}
+        metrics = {'read_pairs_examined': 4, 'on_target': 5, 'unmapped_reads': 1, 'unpaired_reads_examined': 1}
+        distributions = qc_report.parse_tsv(['fragment_median\t220', 'fragment_mad\t10', 'fragment_p5\t200', 'fragment_p25\t210', 'fragment_p75\t230', 'fragment_p95\t2001', 'read_median\t100', 'read_mad\t0'])
+        out = StringIO.StringIO()
+        qc_report.generate_report(summary, karyotype, meta, 20, {}, 'GOOD:95:GREEN,PASS:80:ORANGE,FAIL:0:RED', metrics, {}, False, None, None, out=out, distributions=distributions)
+        assert '**Median fragment size (MAD)** | 220 (10)\n' in out.getvalue()
+        assert '**Fragment size 25th-75th percentile** | 210 - 230\n' in out.getvalue()
+
     def test_parse_date(self):
         d = ''
         assert qc_report.parse_date(d) == 'N/A'
@@ -130,3 +182,64 @@ class QCReportTest(unittest.TestCase):
         assert qc_report.group_number(123) == '123'
         assert qc_report.group_number(1234) == '1,234'
         assert qc_report.group_number(1234567) == '1,234,567'
+
+    def test_summarize_gene_histograms(self):
+        cov = ['chr1\t100\t200\tA\t1\t5', 'chr1\t100\t200\tA\t2\t5', 'chr1\t100\t200\tA\t3\t15', 'chr1\t100\t200\tA\t4\t40']
+        log = StringIO.StringIO()
+        s = qc_report.summarize_coverage(qc_report.calculate_gene_histograms(cov, log), 20, qc_report.COVERAGE_LEVELS, log)
+        assert s['mean'] == 16.25
+        assert s['median'] == 10
+        assert s['genes']['A']['median'] == 10
+        assert s['genes']['A']['ok'] == 25.0
+        assert s['mean_stats'] == qc_report.calculate_summary(cov, 20, log)['mean_stats']
+
+    def test_update_gene_histograms(self):
+        cache = StringIO.StringIO()
+        qc_report.write_gene_histograms(cache, {'A': coverage_store.CoverageHistogram([(5, 2), (15, 1)]), 'B': coverage_store.CoverageHistogram([(0, 3)])})
+        histograms = qc_report.read_gene_histograms(cache.getvalue().split('\n'))
+        assert cache.getvalue() == 'A\t5:2,15:1\nB\t0:3\n'
+        assert dict([(gene, histogram.items()) for gene, histogram in histograms.items()]) == {'A': [(5, 2), (15, 1)], 'B': [(0, 3)]}
+        exome = ['chr2\t100\t102\t1\t30', 'chr2\t100\t102\t2\t50']
+        bed = ['chr2\t100\t200\tC']
+        log = StringIO.StringIO()
+        updated = qc_report.update_gene_histograms(histograms, exome, bed, set(['C']), set(['B']), log)
+        assert sorted(updated.keys()) == ['A', 'C']
+        assert updated['C'].items() == [(30, 1), (50, 1)]
+
+    def test_generate_batch(self):
+        directory = tempfile.mkdtemp()
+        try:
+            metrics = '## METRICS CLASS\tnet.sf.picard.sam.DuplicationMetrics\nLIBRARY\tUNPAIRED_READS_EXAMINED\tREAD_PAIRS_EXAMINED\tUNMAPPED_READS\nnull\t10\t1000\t20\n'
+            batch = ['study\toutput\treport_cov\texome_cov\tontarget\tmetrics\tchromosomes\n']
+            for study, depth in (('S1', 30), ('S2', 10)):
+                for name, content in (('cov', ''.join(['chr1\t100\t104\t{0}\t{1}\t{2}\n'.format(gene, offset, depth + offset) for gene in ('A', 'B') for offset in xrange(1, 5)])), ('ontarget', '1500\n'), ('metrics', metrics), ('chromosomes', '#chrom\treads\tbases\tdepth\tmean_depth\nchr1\t10\t100\t{0}\t1\nchrX\t10\t100\t{0}\t1\n'.format(depth * 100))):
+                    with open(os.path.join(directory, '{0}.{1}'.format(study, name)), 'w') as target:
+                        target.write(content)
+                batch.append('\t'.join([study, os.path.join(directory, study)] + [os.path.join(directory, '{0}.{1}'.format(study, name)) for name in ('cov', 'cov', 'ontarget', 'metrics', 'chromosomes')]) + '\n')
+            samples = qc_report.read_batch(batch)
+            meta = sample_metadata.parse(['Sample_ID\tSex\tPrioritised_Genes\n', 'S1\tFemale\t1:B\n', 'S2\tMale\t\n'])
+            matrix = StringIO.StringIO()
+            qc_report.generate_batch(samples, meta, {'a': 2}, {'a': 100.}, 20, [1, 20], 'GOOD:95:GREEN,FAIL:0:RED', False, None, None, matrix=matrix)
+            assert matrix.getvalue() == 'Gene\tS1\tS2\nA\t32\t12\nB\t32\t12\n'
+
+            # the same report as for a single sample
+            summary = qc_report.calculate_summary(open(os.path.join(directory, 'S1.cov'), 'r'), 20, None, [1, 20])
+            karyotype = qc_report.karyotype_from_depths(qc_report.read_chromosome_depths(open(os.path.join(directory, 'S1.chromosomes'), 'r')))
+            metrics = qc_report.build_metrics(open(os.path.join(directory, 'S1.metrics'), 'r'), open(os.path.join(directory, 'S1.ontarget'), 'r'), None)
+            sample = qc_report.parse_metadata(['Sample_ID\tSex\tPrioritised_Genes\n', 'S1\tFemale\t1:B\n'], 'S1')
+            out = StringIO.StringIO()
+            qc_report.generate_report(summary, karyotype, sample, 20, qc_report.build_categories(['A\t2\n'], sample['prioritised_genes'], None), 'GOOD:95:GREEN,FAIL:0:RED', metrics, {'a': 100.}, False, None, None, out=out)
+            assert open(os.path.join(directory, 'S1.md'), 'r').read() == out.getvalue()
+            html = open(os.path.join(directory, 'S1.htm'), 'r').read()
+            assert html.startswith('<html>')
+            assert '<table class="pure-table pure-table-bordered">' in html
+            assert open(os.path.join(directory, 'S2.karyotype.tsv'), 'r').readline() == 'Sex\tMALE\n'
+        finally:
+            shutil.rmtree(directory)
+
+    def test_read_batch(self):
+        try:
+            qc_report.read_batch(['study\toutput\treport_cov\n'])
+            assert False
+        except ValueError:
+            pass
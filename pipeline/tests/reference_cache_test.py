@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+###########################################################################
+#
+# This file is part of Cpipe.
+#
+# Cpipe is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, under version 3 of the License, subject
+# to additional terms compatible with the GNU General Public License version 3,
+# specified in the LICENSE file that is part of the Cpipe distribution.
+#
+# Cpipe is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cpipe.  If not, see <http:#www.gnu.org/licenses/>.
+#
+###########################################################################
+
+import unittest
+import os
+import shutil
+import sys
+import tempfile
+import StringIO
+
+sys.path.append('../scripts/')
+import reference_cache
+
+class ReferenceCacheTest(unittest.TestCase):
+
+    def test_cached(self):
+        directory = tempfile.mkdtemp()
+        try:
+            source = os.path.join(directory, 'source.bed')
+            with open(source, 'w') as target:
+                target.write('chr1\t1\t10\n')
+            cache = os.path.join(directory, 'cache')
+            calls = []
+            def compute(target):
+                calls.append(1)
+                target.write(open(source, 'r').read().upper())
+
+            out = StringIO.StringIO()
+            assert not reference_cache.cached(cache, 'step', '1', [source], compute, out)
+            assert out.getvalue() == 'CHR1\t1\t10\n'
+            out = StringIO.StringIO()
+            assert reference_cache.cached(cache, 'step', '1', [source], compute, out)
+            assert out.getvalue() == 'CHR1\t1\t10\n'
+            assert len(calls) == 1
+
+            # a new version or changed content is calculated again
+            assert not reference_cache.cached(cache, 'step', '2', [source], compute, StringIO.StringIO())
+            with open(source, 'w') as target:
+                target.write('chr2\t1\t10\n')
+            out = StringIO.StringIO()
+            assert not reference_cache.cached(cache, 'step', '1', [source], compute, out)
+            assert out.getvalue() == 'CHR2\t1\t10\n'
+            assert len(calls) == 3
+            assert len(os.listdir(cache)) == 3
+
+            def fail(target):
+                target.write('partial')
+                raise IOError('failed')
+            try:
+                reference_cache.cached(cache, 'other', '1', [source], fail, StringIO.StringIO())
+                assert False
+            except IOError:
+                pass
+            assert len(os.listdir(cache)) == 3
+        finally:
+            shutil.rmtree(directory)
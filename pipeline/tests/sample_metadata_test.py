@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+###########################################################################
+#
+# This file is part of Cpipe.
+#
+# Cpipe is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, under version 3 of the License, subject
+# to additional terms compatible with the GNU General Public License version 3,
+# specified in the LICENSE file that is part of the Cpipe distribution.
+#
+# Cpipe is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cpipe.  If not, see <http:#www.gnu.org/licenses/>.
+#
+###########################################################################
+
+import unittest
+import csv
+import os
+import shutil
+import sys
+import tempfile
+import StringIO
+
+sys.path.append('../scripts/')
+import sample_metadata
+import update_metadata
+
+METADATA = 'Sample_ID\tCohort\tSex \tDNA_Concentration\n001\tCS\tMale\t12.5\n002\tEPIL\tFemale\t\n001\tCS\tMale\t3\n'
+
+class SampleMetadataTest(unittest.TestCase):
+
+    def test_parse(self):
+        metadata = sample_metadata.parse(StringIO.StringIO(METADATA))
+        assert metadata.samples() == ['001', '002']
+        assert '002' in metadata
+        assert metadata.record('002') == {'sample_id': '002', 'cohort': 'EPIL', 'sex': 'Female', 'dna_concentration': ''}
+        assert metadata.record('003') is None
+        assert metadata.value('001', 'sex') == 'Male'
+        assert metadata.value('001', 'DNA_CONCENTRATION', convert=float) == 12.5
+        assert metadata.value('002', 'dna_concentration', default=0.) == 0.
+        out = StringIO.StringIO()
+        metadata.write(out)
+        assert out.getvalue() == METADATA
+
+    def test_csv_rows(self):
+        lines = ['Sample_ID\tHospital_Centre\tNotes\n', '001\t"Royal Children\'s"\t"a\tb"\n', '\n']
+        metadata = sample_metadata.parse(lines)
+        assert metadata.csv_rows() == [row for row in csv.reader(lines, delimiter='\t')]
+        assert metadata.csv_rows()[1] == ['001', 'Royal Children\'s', 'a\tb']
+
+    def test_update(self):
+        metadata = sample_metadata.parse(StringIO.StringIO(METADATA))
+        log = StringIO.StringIO()
+        assert update_metadata.update_metadata(metadata, log, '001', 'cohort', 'AML') == 0
+        assert [metadata.get(fields, 'Cohort') for fields in metadata.rows] == ['AML', 'EPIL', 'AML']
+        assert update_metadata.update_metadata(metadata, log, '004', 'cohort', 'AML') == 1
+        assert update_metadata.update_metadata(metadata, log, '001', 'unknown', 'AML') == 1
+        metadata.add_column('Pipeline_Run_ID', 'run_1', 0)
+        assert metadata.value('002', 'cohort') == 'EPIL'
+        assert metadata.rows[1][0] == 'run_1'
+
+    def test_load(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'samples.txt')
+            with open(filename, 'w') as target:
+                target.write(METADATA)
+            metadata = sample_metadata.load(filename)
+            assert os.path.exists(sample_metadata.cache_filename(filename))
+            log = StringIO.StringIO()
+            assert sample_metadata.load(filename, log).samples() == ['001', '002']
+            assert 'using cached metadata' in log.getvalue()
+
+            metadata.set('002', 'Sex', 'Unknown')
+            sample_metadata.save(metadata, filename)
+            assert open(filename, 'r').read() == METADATA.replace('Female', 'Unknown')
+            assert sorted(os.listdir(directory)) == ['.samples.txt.cache', 'samples.txt']
+
+            with open(filename, 'a') as target: # a change to the file invalidates the cache
+                target.write('003\tCS\tFemale\t1\n')
+            log = StringIO.StringIO()
+            assert sample_metadata.load(filename, log).samples() == ['001', '002', '003']
+            assert 'using cached metadata' not in log.getvalue()
+        finally:
+            shutil.rmtree(directory)
@@ -42,3 +42,5 @@ class UpdateGenesListsTest(unittest.TestCase):
       update_gene_lists.update_gene_lists( '.', '.', log )
       lines = open( 'CS/CS.genes.txt', 'r' ).readlines()
       assert lines[1:] == [ '#notes 1 gene(s) added: GHI\n', 'ABC\t1\n', 'DEF\t2\n', 'GHI\t1\n' ]
+      assert open( 'CS.added.genes.txt', 'r' ).readlines() == [ 'GHI\n' ]
+      os.remove( 'CS.added.genes.txt' )